@@ -0,0 +1,78 @@
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Pyhole Traffic Capture
+
+A capture file holds the raw lines received from an IRC server, one per
+line, each prefixed with the milliseconds elapsed since the previous one:
+
+    # pyhole-capture 1 1339012345.678
+    0 :irc.example.net NOTICE * :*** Looking up your hostname...
+    12 :irc.example.net 001 pyhole :Welcome to the network
+
+Every session appended to the file starts with a header giving its start
+time.  Files whose name ends in .gz are compressed.
+"""
+
+import gzip
+import time
+
+
+HEADER = "# pyhole-capture 1"
+
+
+def _open(path, mode):
+    """Open a capture file, compressed or not"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class CaptureWriter(object):
+    """Record raw inbound lines, as set on ServerConnection.capture"""
+
+    # Seconds between flushes to disk.
+    flush_interval = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.file = _open(path, "ab")
+        self.last = self.flushed = time.time()
+        self.file.write("%s %.3f\n" % (HEADER, self.last))
+
+    def record(self, line):
+        """Append a line received from the server"""
+        now = time.time()
+        self.file.write("%d %s\n" % ((now - self.last) * 1000, line))
+        self.last = now
+        if now - self.flushed >= self.flush_interval:
+            self.file.flush()
+            self.flushed = now
+
+    def close(self):
+        """Flush and close the capture file"""
+        self.file.close()
+
+
+def read_capture(path):
+    """Yield a (delay in seconds, line) tuple for each captured line"""
+    capture = _open(path, "rb")
+    try:
+        for record in capture:
+            if record.startswith(HEADER):
+                continue
+            delay, _sep, line = record.rstrip("\n").partition(" ")
+            yield int(delay) / 1000.0, line
+    finally:
+        capture.close()
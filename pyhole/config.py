@@ -54,6 +54,8 @@ class Config(object):
         try:
             if _type == "int":
                 return self.config_parser.getint(self.section, option)
+            elif _type == "float":
+                return self.config_parser.getfloat(self.section, option)
             elif _type == "bool":
                 return self.config_parser.getboolean(self.section, option)
             elif _type == "list":
@@ -0,0 +1,169 @@
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Pyhole Event Loop Engines"""
+
+import functools
+
+import greenlet
+
+from eventlet import hubs
+
+import irclib
+import utils
+
+
+class EventletPoller(object):
+    """irclib poller backend built on the eventlet hub.
+
+    Sockets are handed to the hub once, as long-lived listeners, and the
+    IRC loop sleeps in the hub like any other greenthread until one of
+    them is ready.  The select backend, the only one left once eventlet
+    has patched the select module, hands every socket to the hub again
+    on each pass of the loop.
+    """
+
+    name = "eventlet"
+
+    def __init__(self):
+        self._hub = hubs.get_hub()
+        self._sockets = {}
+        # (event type, fd) -> hub listener.
+        self._listeners = {}
+        # fd -> socket, for sockets found ready since the last poll().
+        self._readable = {}
+        self._writable = {}
+        self._waiter = None
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def register(self, sock, readable=True, writable=False):
+        """Start watching a socket."""
+        self.modify(sock, readable, writable)
+
+    def modify(self, sock, readable=True, writable=False):
+        """Change the events watched for on a socket."""
+        fd = sock.fileno()
+        if fd not in self._sockets:
+            # Drop listeners left behind by a socket that was closed
+            # while still watched and whose file descriptor was reused.
+            self._hub.mark_as_reopened(fd)
+        self._sockets[fd] = sock
+        self._listen(self._hub.READ, fd, readable, self._readable)
+        self._listen(self._hub.WRITE, fd, writable, self._writable)
+
+    def unregister(self, sock):
+        """Stop watching a socket."""
+        for fd, s in self._sockets.items():
+            if s is sock:
+                del self._sockets[fd]
+                self._listen(self._hub.READ, fd, False, self._readable)
+                self._listen(self._hub.WRITE, fd, False, self._writable)
+
+    def poll(self, timeout=None):
+        """Wait for events.
+
+        Returns a tuple of two lists: readable sockets and writable
+        sockets.  A timeout of None blocks until an event arrives.
+        """
+        self._waiter = greenlet.getcurrent()
+        timer = None
+        if timeout is not None:
+            timer = self._hub.schedule_call_global(max(timeout, 0),
+                    self._expire)
+        try:
+            self._hub.switch()
+        finally:
+            self._waiter = None
+            if timer is not None:
+                timer.cancel()
+            if self._wakeup is not None:
+                self._wakeup.cancel()
+                self._wakeup = None
+
+        i = self._readable.values()
+        o = self._writable.values()
+        self._readable.clear()
+        self._writable.clear()
+        return i, o
+
+    def _listen(self, evtype, fd, wanted, ready):
+        """Add or remove the hub listener for one event on a socket"""
+        key = (evtype, fd)
+        listener = self._listeners.get(key)
+        if wanted and listener is None:
+            self._listeners[key] = self._hub.add(evtype, fd,
+                    functools.partial(self._ready, ready),
+                    functools.partial(self._obsolete, key), None)
+        elif not wanted:
+            if listener is not None:
+                del self._listeners[key]
+                self._hub.remove(listener)
+            ready.pop(fd, None)
+
+    def _ready(self, ready, fd):
+        """Note a ready socket and wake the IRC loop up.  Called by the
+        hub, which may report several sockets before the loop runs.
+
+        Sockets are only noted while the loop waits in poll(): the hub
+        reports them again on its next pass if they are still ready,
+        while a note taken as the loop runs may be stale by the time
+        it polls.
+        """
+        sock = self._sockets.get(fd)
+        if sock is None or self._waiter is None:
+            return
+        ready[fd] = sock
+        self._expire()
+
+    def _expire(self):
+        """Resume the IRC loop after the hub has polled the sockets once
+        more, so an expired timeout still reports ready sockets
+        """
+        if self._wakeup is None:
+            self._wakeup = self._hub.schedule_call_global(0, self._wake)
+
+    def _wake(self):
+        """Resume the IRC loop"""
+        self._wakeup = None
+        if self._waiter is not None:
+            self._waiter.switch()
+
+    def _obsolete(self, key, exc):
+        """Forget a listener the hub dropped because its file descriptor
+        was closed and reused
+        """
+        self._listeners.pop(key, None)
+
+
+irclib.pollers["eventlet"] = EventletPoller
+
+# The pollers that work once eventlet has patched the select module.
+engines = ["select", "eventlet"]
+
+
+def create_irc(engine=None):
+    """Return an IRC object running on an engine, by default the one
+    configured: "select" for the select loop or "eventlet" for the
+    eventlet hub
+    """
+    if engine is None:
+        engine = utils.get_config().get("engine", default="select")
+
+    if engine not in engines:
+        raise ValueError("Unknown engine: %s" % engine)
+
+    return irclib.IRC(poller=engine)
@@ -15,12 +15,15 @@
 """Event-based IRC Class"""
 
 import multiprocessing
+import os
 import random
 import re
 import sys
 import time
 import urllib
 
+import capture
+import engine
 import irclib
 import log
 import plugin
@@ -35,10 +38,27 @@ CONFIG = utils.get_config()
 class IRC(irclib.SimpleIRCClient):
     """An IRClib connection."""
 
-    def __init__(self, network):
-        irclib.SimpleIRCClient.__init__(self)
+    # Seconds to wait for the end of the MOTD before joining anyway.
+    motd_timeout = 10
+
+    def __init__(self, network, ircobj=None):
+        shared = ircobj is not None
+        if not shared:
+            ircobj = engine.create_irc()
+        irclib.SimpleIRCClient.__init__(self, ircobj)
+        try:
+            self.setup(network, shared)
+        except Exception:
+            # Leave nothing behind on a shared event loop.
+            self.stop_capture()
+            self.close()
+            raise
+
+    def setup(self, network, shared):
+        """Read the network's settings and connect."""
         network_config = utils.get_config(network)
 
+        self.network = network
         self.log = log.get_logger(str(network))
         self.version = version.version_string()
         self.source = None
@@ -46,7 +66,7 @@ class IRC(irclib.SimpleIRCClient):
         self.addressed = False
         self.loaded_pollers = False
 
-        self.admins = CONFIG.get("admins", type="list")
+        self.admins = irclib.IRCSet(CONFIG.get("admins", type="list"))
         self.command_prefix = CONFIG.get("command_prefix")
         self.reconnect_delay = CONFIG.get("reconnect_delay", type="int")
         self.rejoin_delay = CONFIG.get("rejoin_delay", type="int")
@@ -61,21 +81,109 @@ class IRC(irclib.SimpleIRCClient):
         self.username = network_config.get("username", default=None)
         self.identify_password = network_config.get("identify_password",
                 default=None)
-        self.channels = network_config.get("channels", type="list")
-
-        self.load_plugins()
+        # SASL PLAIN authenticates with the identify password, so it is
+        # the default when there is one.
+        self.sasl_mechanism = network_config.get("sasl_mechanism",
+                default=None) or (self.identify_password and "PLAIN") or None
+        self.connect_started = None
+        # The channels are joined once per connection, at the end of
+        # the MOTD, or after motd_timeout if it never ends.
+        self.joins_due = False
+        self.join_timer = None
+        # Channels joined on connect that the server hasn't confirmed.
+        self.pending_joins = irclib.IRCSet()
+        # Channel -> key ("" if none).
+        self.channels = irclib.IRCDict()
+        for channel in network_config.get("channels", type="list"):
+            channel = channel.split(" ", 1)
+            self.channels[channel[0]] = channel[1:] and channel[1] or ""
+        self.flood_rate = network_config.get("flood_rate", type="float",
+                default=0.5)
+        self.flood_burst = network_config.get("flood_burst", type="int",
+                default=5)
+        self.keepalive_interval = network_config.get("keepalive_interval",
+                type="int", default=60)
+        self.keepalive_timeout = network_config.get("keepalive_timeout",
+                type="int", default=30)
+        self.capture_file = network_config.get("capture_file", default=None)
+        self.dcc_address = network_config.get("dcc_address", default=None)
+        self.dcc_rate = network_config.get("dcc_rate", type="int", default=0)
+
+        # Built once, so reconnects reuse the loaded CA data and keys.
+        self.ssl_context = None
+        if self.ssl:
+            ssl_ca_path = network_config.get("ssl_ca_path", default=None)
+            self.ssl_context = irclib.create_ssl_context(
+                    ca_path=ssl_ca_path or None,
+                    certfile=network_config.get("ssl_cert",
+                            default=None) or None,
+                    keyfile=network_config.get("ssl_key",
+                            default=None) or None,
+                    ciphers=network_config.get("ssl_ciphers",
+                            default=None) or None,
+                    verify=network_config.get("ssl_verify", type="bool",
+                            default=bool(ssl_ca_path)))
+
+        # Networks sharing an event loop share one set of plugins,
+        # loaded by whoever runs the loop.
+        if not shared:
+            self.load_plugins()
+
+        # Flood control and keepalive settings outlive reconnects.
+        self.connection.set_flood_control(self.flood_rate, self.flood_burst)
+        self.connection.keepalive_interval = self.keepalive_interval
+        self.connection.keepalive_timeout = self.keepalive_timeout
+        if self.capture_file:
+            self.start_capture()
 
         self.log.info("Connecting to %s:%d as %s" % (self.server, self.port,
                 self.nick))
+        self.connect_started = time.time()
         self.connect(self.server, self.port, self.nick, self.password,
                 ssl=self.ssl, ipv6=self.ipv6, localaddress=self.bind_to,
-                username=self.username)
+                username=self.username, ssl_context=self.ssl_context,
+                capabilities=irclib.supported_capabilities,
+                sasl_mechanism=self.sasl_mechanism,
+                sasl_password=self.identify_password)
+
+    def reconnect(self):
+        """Reconnect to the server, retrying later on failure."""
+        self.log.info("Connecting to %s:%d as %s" % (self.server, self.port,
+                self.nick))
+        if self.capture_file:
+            self.start_capture()
+        self.connect_started = time.time()
+        try:
+            self.connect(self.server, self.port, self.nick, self.password,
+                    ssl=self.ssl, ipv6=self.ipv6, localaddress=self.bind_to,
+                    username=self.username, ssl_context=self.ssl_context,
+                    capabilities=irclib.supported_capabilities,
+                    sasl_mechanism=self.sasl_mechanism,
+                    sasl_password=self.identify_password)
+        except irclib.ServerConnectionError, exc:
+            self.log.error(exc)
+            self.log.info("Reconnecting in %d seconds" %
+                    self.reconnect_delay)
+            self.connection.execute_delayed(self.reconnect_delay,
+                    self.reconnect)
+
+    def start_capture(self):
+        """Record inbound traffic to the capture file."""
+        self.stop_capture()
+        self.log.info("Capturing inbound traffic to %s" % self.capture_file)
+        self.connection.capture = capture.CaptureWriter(self.capture_file)
+
+    def stop_capture(self):
+        """Flush and close the capture file, if any."""
+        if self.connection.capture is not None:
+            self.connection.capture.close()
+            self.connection.capture = None
 
     def load_pollers(self, reload_pollers=False):
         """Load all the pollers."""
 
         try:
-            plugin.load_pollers()
+            plugin.load_pollers(self)
             self.loaded_pollers = True
         except Exception, e:
             self.log.error("ERROR WHILE LOADING POLLERS")
@@ -84,7 +192,7 @@ class IRC(irclib.SimpleIRCClient):
     def terminate_pollers(self):
         self.log.info("Terminating pollers")
         self.loaded_pollers = False
-        plugin.terminate_pollers()
+        plugin.terminate_pollers(self)
 
     def load_plugins(self, reload_plugins=False):
         """Load plugins and their commands respectively."""
@@ -162,11 +270,16 @@ class IRC(irclib.SimpleIRCClient):
 
     def poll_messages(self, message, private=False):
         """Watch for known commands."""
-        self.addressed = False
+        previous = utils.get_network()
+        utils.set_network(self)
+        try:
+            self.addressed = False
 
-        self.run_command_hooks(message, private)
-        self.run_keyword_hooks(message, private)
-        self.run_msg_regexp_hooks(message, private)
+            self.run_command_hooks(message, private)
+            self.run_keyword_hooks(message, private)
+            self.run_msg_regexp_hooks(message, private)
+        finally:
+            utils.set_network(previous)
 
     def _mangle_msg(self, msg):
         """Prepare the message for sending."""
@@ -185,10 +298,14 @@ class IRC(irclib.SimpleIRCClient):
         return msg
 
     def notice(self, msg):
-        """Send a notice."""
+        """Send a notice.
+
+        Notices are bulk traffic: flood control sends them after any
+        pending replies.
+        """
         msg = self._mangle_msg(msg)
         for line in msg:
-            self.connection.notice(self.target, line)
+            self.connection.notice(self.target, line, irclib.PRIORITY_BULK)
             if irclib.is_channel(self.target):
                 self.log.info("-%s- <%s> %s" % (self.target, self.nick, line))
             else:
@@ -215,6 +332,21 @@ class IRC(irclib.SimpleIRCClient):
         """Send a privmsg."""
         self.connection.privmsg(target, msg)
 
+    def announce(self, msg, channels=None):
+        """Send a privmsg to several channels, all configured channels
+        by default.
+
+        Channels are addressed together, as many per line as the
+        server allows.
+        """
+        if channels is None:
+            channels = list(self.channels)
+        msg = self._mangle_msg(msg)
+        for line in msg:
+            self.connection.privmsg_many(channels, line, irclib.PRIORITY_BULK)
+            self.log.info("-%s- <%s> %s" % (",".join(channels), self.nick,
+                    line))
+
     def op_user(self, params):
         """Op a user."""
         params = params.split(" ", 1)
@@ -235,7 +367,7 @@ class IRC(irclib.SimpleIRCClient):
         channel = params.split(" ", 1)
         self.reply("Joining %s" % channel[0])
         if irclib.is_channel(channel[0]):
-            self.channels.append(channel[0])
+            self.channels[channel[0]] = channel[1:] and channel[1] or ""
             if len(channel) > 1:
                 self.connection.join(channel[0], channel[1])
             else:
@@ -243,10 +375,27 @@ class IRC(irclib.SimpleIRCClient):
 
     def part_channel(self, params):
         """Part a channel."""
-        self.channels.remove(params)
+        self.channels.pop(params, None)
         self.reply("Parting %s" % params)
         self.connection.part(params)
 
+    def send_file(self, nick, name):
+        """Offer a file from the dcc directory over DCC SEND."""
+        name = os.path.basename(name)
+        path = utils.get_directory("dcc") + name
+        if not os.path.isfile(path):
+            self.reply("No such file: %s" % name)
+            return
+
+        try:
+            self.dcc_send(nick, path, rate=self.dcc_rate or None,
+                    address=self.dcc_address or None)
+        except irclib.DCCConnectionError, exc:
+            self.log.error(exc)
+            self.reply("Unable to send %s" % name)
+            return
+        self.log.info("Offering %s to %s over DCC" % (name, nick))
+
     def fetch_url(self, url, name):
         """Fetch a URL."""
         class PyholeURLopener(urllib.FancyURLopener):
@@ -268,21 +417,72 @@ class IRC(irclib.SimpleIRCClient):
         self.nick = "%s%d" % (self.nick, random_int)
         self.log.info("Setting IRC nick to '%s'" % self.nick)
         connection.nick("%s" % self.nick)
-        # Try to prevent nick flooding
-        time.sleep(1)
 
     def on_welcome(self, connection, _event):
-        """Join channels upon successful connection."""
-        if self.identify_password:
+        """Log the connection and identify, if needed."""
+        timings = connection.connect_timings
+        self.log.info("Connected to %s:%d (%s)" % (self.server, self.port,
+                ", ".join("%s %.3fs" % (phase, timings[phase])
+                        for phase in ("dns", "tcp", "tls", "sasl",
+                                "registration")
+                        if phase in timings)))
+        if connection.sasl_authenticated:
+            self.log.info("Authenticated with SASL %s" %
+                    connection.sasl_mechanism)
+        elif self.identify_password:
+            if self.sasl_mechanism:
+                self.log.info("SASL unavailable, identifying with NickServ")
             self.privmsg("NickServ", "IDENTIFY %s" % self.identify_password)
 
-        for channel in self.channels:
-            channel = channel.split(" ", 1)
-            if irclib.is_channel(channel[0]):
-                if len(channel) > 1:
-                    connection.join(channel[0], channel[1])
-                else:
-                    connection.join(channel[0])
+        self.joins_due = True
+        self.join_timer = connection.execute_delayed(self.motd_timeout,
+                self.join_channels, (connection,))
+
+    def on_endofmotd(self, connection, _event):
+        """Join channels, now that the server has announced its limits."""
+        self.join_channels(connection)
+
+    def on_nomotd(self, connection, _event):
+        """Join channels, now that the server has announced its limits."""
+        self.join_channels(connection)
+
+    def join_channels(self, connection):
+        """Join the current channel set, several channels per JOIN."""
+        if not self.joins_due:
+            return
+        self.joins_due = False
+        self.cancel_join_timer()
+
+        channels = dict((channel, key) for channel, key in
+                self.channels.items() if irclib.is_channel(channel))
+        left_out = connection.join_many(channels)
+        for channel in left_out:
+            self.log.warning("Not joining %s, the server's channel limit "
+                    "has been reached" % channel)
+        self.pending_joins = irclib.IRCSet((channel for channel in channels
+                if channel not in left_out),
+                casemapping=connection.get_casemapping())
+
+    def cancel_join_timer(self):
+        """Cancel the join fallback scheduled on welcome, if any."""
+        if self.join_timer is not None:
+            self.join_timer.cancel()
+            self.join_timer = None
+
+    def on_cap(self, connection, event):
+        """Log the IRCv3 capabilities in effect."""
+        if event.arguments()[:1] == ["ACK"]:
+            self.log.info("Capabilities: %s" % ", ".join(sorted(
+                    connection.capabilities)))
+
+    def on_featurelist(self, connection, _event):
+        """Compare channels and admins the way the server does."""
+        casemapping = connection.get_casemapping()
+        if casemapping != self.channels.casemapping:
+            self.channels.set_casemapping(casemapping)
+            self.admins.set_casemapping(casemapping)
+        if casemapping != self.pending_joins.casemapping:
+            self.pending_joins.set_casemapping(casemapping)
 
     def on_disconnect(self, _connection, _event):
         """Attempt to reconnect after disconnection."""
@@ -290,15 +490,14 @@ class IRC(irclib.SimpleIRCClient):
         self.log.info("Disconnected from %s:%d" % (self.server, self.port))
         self.log.info("Reconnecting in %d seconds" % self.reconnect_delay)
         self.terminate_pollers()
-        time.sleep(self.reconnect_delay)
-        self.log.info("Connecting to %s:%d as %s" % (self.server, self.port,
-                self.nick))
-        self.connect(self.server, self.port, self.nick, self.password,
-                ssl=self.ssl, username=self.username)
+        self.stop_capture()
+        self.joins_due = False
+        self.cancel_join_timer()
+        self.connection.execute_delayed(self.reconnect_delay, self.reconnect)
 
     def on_kick(self, connection, event):
         """Automatically rejoin channel if kicked."""
-        source = irclib.nm_to_n(event.source())
+        source = event.source_nick()
         target = event.target()
         nick, reason = event.arguments()
 
@@ -306,8 +505,8 @@ class IRC(irclib.SimpleIRCClient):
             self.log.info("-%s- kicked by %s: %s" % (target, source, reason))
             self.log.info("-%s- rejoining in %d seconds" % (target,
                     self.rejoin_delay))
-            time.sleep(self.rejoin_delay)
-            connection.join(target)
+            connection.execute_delayed(self.rejoin_delay, connection.join,
+                    (target,))
         else:
             self.log.info("-%s- %s was kicked by %s: %s" % (target, nick,
                     source, reason))
@@ -320,7 +519,7 @@ class IRC(irclib.SimpleIRCClient):
 
     def on_ctcp(self, connection, event):
         """Respond to CTCP events."""
-        source = irclib.nm_to_n(event.source())
+        source = event.source_nick()
         ctcp = event.arguments()[0]
 
         if ctcp == "VERSION":
@@ -332,37 +531,51 @@ class IRC(irclib.SimpleIRCClient):
                 connection.ctcp_reply(source,
                         "PING %s" % event.arguments()[1])
 
-    def on_join(self, _connection, event):
+    def on_dcc_disconnect(self, connection, event):
+        """Log the end of DCC SEND transfers."""
+        if isinstance(connection, irclib.DCCSendConnection):
+            self.log.info("DCC SEND of %s to %s: %s (%d bytes)" % (
+                    connection.name, connection.nick, event.arguments()[0],
+                    connection.bytes_sent))
+
+    def on_join(self, connection, event):
         """Handle joins."""
         target = event.target()
-        source = irclib.nm_to_n(event.source())
+        source = event.source_nick()
         self.log.info("-%s- %s joined" % (target, source))
 
+        if self.pending_joins and source == connection.get_nickname() and \
+           target in self.pending_joins:
+            self.pending_joins.discard(target)
+            if not self.pending_joins and self.connect_started is not None:
+                self.log.info("Joined channels %.3fs after connecting" % (
+                        time.time() - self.connect_started))
+
         if not self.loaded_pollers:
             self.load_pollers()
 
     def on_part(self, _connection, event):
         """Handle parts."""
         target = event.target()
-        source = irclib.nm_to_n(event.source())
+        source = event.source_nick()
         self.log.info("-%s- %s left" % (target, source))
 
     def on_quit(self, _connection, event):
         """Handle quits."""
-        source = irclib.nm_to_n(event.source())
+        source = event.source_nick()
         self.log.info("%s quit" % source)
 
     def on_action(self, _connection, event):
         """Handle IRC actions."""
         target = event.target()
-        source = irclib.nm_to_n(event.source())
+        source = event.source_nick()
         msg = event.arguments()[0]
         self.log.info(unicode("-%s- * %s %s" % (target, source, msg), "utf-8"))
 
     def on_privnotice(self, _connection, event):
         """Handle private notices."""
         if event.source() is not None:
-            source = irclib.nm_to_n(event.source())
+            source = event.source_nick()
         else:
             source = None
         msg = event.arguments()[0]
@@ -372,7 +585,7 @@ class IRC(irclib.SimpleIRCClient):
         """Handle public notices."""
         target = event.target()
         if event.source() is not None:
-            source = irclib.nm_to_n(event.source())
+            source = event.source_nick()
         else:
             source = None
         msg = event.arguments()[0]
@@ -382,7 +595,7 @@ class IRC(irclib.SimpleIRCClient):
     def on_privmsg(self, _connection, event):
         """Handle private messages."""
         self.source = event.source().split("@", 1)[0]
-        self.target = irclib.nm_to_n(event.source())
+        self.target = event.source_nick()
         msg = event.arguments()[0]
 
         if self.target != self.nick:
@@ -393,7 +606,7 @@ class IRC(irclib.SimpleIRCClient):
         """Handle public messages."""
         self.source = event.source().split("@", 1)[0]
         self.target = event.target()
-        nick = irclib.nm_to_n(event.source())
+        nick = event.source_nick()
         msg = event.arguments()[0]
 
         self.log.info(unicode("-%s- <%s> %s" % (self.target, nick, msg),
@@ -422,8 +635,10 @@ class IRCProcess(multiprocessing.Process):
             try:
                 connection.start()
             except KeyboardInterrupt:
+                connection.stop_capture()
                 sys.exit(0)
             except Exception, exc:
+                connection.stop_capture()
                 LOG.error(exc)
                 LOG.error("Retrying in %d seconds" % self.reconnect_delay)
                 time.sleep(self.reconnect_delay)
@@ -445,6 +660,46 @@ def active_keywords():
     return ", ".join(sorted(plugin.active_keywords()))
 
 
+def connect_network(ircobj, network, networks):
+    """Connect to a network on a shared event loop, retrying on failure."""
+    try:
+        networks.append(IRC(network, ircobj))
+    except Exception, exc:
+        LOG.error(exc)
+        LOG.error("Retrying in %d seconds" % CONFIG.get("reconnect_delay",
+                type="int"))
+        ircobj.execute_delayed(CONFIG.get("reconnect_delay", type="int"),
+                connect_network, (ircobj, network, networks))
+
+
+def run_single_process(network_names):
+    """Drive every network from this process and one event loop.
+
+    The plugins are loaded once and answer on whichever network the
+    message came from.
+    """
+    ircobj = engine.create_irc()
+    networks = []
+    for network in network_names:
+        connect_network(ircobj, network, networks)
+
+    if networks:
+        networks[0].load_plugins()
+    else:
+        plugin.load_plugins(irc=None)
+
+    while True:
+        try:
+            ircobj.process_forever()
+        except KeyboardInterrupt:
+            LOG.info("Caught KeyboardInterrupt, shutting down")
+            for network in networks:
+                network.stop_capture()
+            sys.exit(0)
+        except Exception, exc:
+            LOG.exception(exc)
+
+
 def main():
     """Main IRC loop."""
     networks = CONFIG.get("networks", type="list")
@@ -452,6 +707,10 @@ def main():
     LOG.info("Starting %s" % version.version_string())
     LOG.info("Connecting to IRC Networks: %s" % ", ".join(networks))
 
+    if CONFIG.get("single_process", type="bool", default=False):
+        run_single_process(networks)
+        return
+
     procs = []
     for network in networks:
         proc = IRCProcess(network)
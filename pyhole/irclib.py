@@ -39,8 +39,8 @@ The main features of the IRC client framework are:
   * Messages from an IRC server triggers events, which can be caught
     by event handlers.
   * Reading from and writing to IRC server sockets are normally done
-    by an internal select() loop, but the select()ing may be done by
-    an external main loop.
+    by an internal epoll/poll/select loop, but the polling may be done
+    by an external main loop.
   * Functions can be registered to execute at specified times by the
     event-loop.
   * Decodes CTCP tagging correctly (hopefully); I haven't seen any
@@ -52,7 +52,7 @@ The main features of the IRC client framework are:
 Current limitations:
 
   * The IRC protocol shines through the abstraction a bit too much.
-  * Data is not written asynchronously to the server, i.e. the write()
+  * Data is not written asynchronously to DCC peers, i.e. the write()
     may block if the TCP buffers are stuffed.
   * There are no support for DCC file transfers.
   * The author haven't even read RFC 2810, 2811, 2812 and 2813.
@@ -61,24 +61,60 @@ Current limitations:
 .. [IRC specifications] http://www.irchelp.org/irchelp/rfc/
 """
 
+import base64
 import bisect
+import calendar
+import collections
+import errno
+import heapq
+import itertools
+import os
 import re
 import select
 import socket
 import string
+import struct
+import threading
 import time
 import types
 
+try:
+    import ssl as _ssl
+except ImportError:
+    _ssl = None
+
+# Zero-copy file transmission, where the platform provides it.
+_sendfile = getattr(os, "sendfile", None)
+
 VERSION = 0, 4, 8
 DEBUG = 0
 
+# Priority classes for outgoing server traffic, most urgent first.
+# Protocol traffic is never held back by flood control.
+PRIORITY_PROTOCOL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# IRCv3 capabilities irclib makes use of when they are requested, see
+# ServerConnection.connect:
+#
+#   multi-prefix -- NAMES replies list every mode prefix of a member.
+#   userhost-in-names -- NAMES replies give nick!user@host.
+#   batch -- Related events are grouped, see Batch.
+#   server-time -- Events carry the time the server saw them, see
+#                  Event.server_time.
+#   cap-notify -- The server announces capabilities coming and going.
+supported_capabilities = frozenset(["multi-prefix", "userhost-in-names",
+                                    "batch", "server-time", "cap-notify"])
+
 # TODO
 # ----
 # (maybe) thread safety
 # (maybe) color parser convenience functions
 # documentation (including all event types)
 # (maybe) add awareness of different types of ircds
-# send data asynchronously to the server (and DCC connections)
+# send data asynchronously to DCC connections
+# connect DCC connections asynchronously
 # (maybe) automatically close unused, passive DCC connections after a while
 
 # NOTES
@@ -93,6 +129,224 @@ class IRCError(Exception):
     pass
 
 
+def _would_block(error):
+    """[Internal] Check if a socket error only means "try again later"."""
+    if _ssl and isinstance(error, _ssl.SSLError):
+        return error.args[0] in (_ssl.SSL_ERROR_WANT_READ,
+                                 _ssl.SSL_ERROR_WANT_WRITE)
+    return error.args and error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                            errno.EINTR)
+
+
+class SelectPoller:
+    """Poller backend built on select.select().
+
+    This is the portable fallback.  It is also the backend used when
+    the select module has been monkey patched (e.g. by eventlet), since
+    the patched module only provides select() and it is the only call
+    that lets other green threads run while the loop is idle.
+    """
+
+    name = "select"
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+
+    def __len__(self):
+        return len(self._readers) + len(self._writers)
+
+    def register(self, sock, readable=True, writable=False):
+        """Start watching a socket."""
+        self.modify(sock, readable, writable)
+
+    def modify(self, sock, readable=True, writable=False):
+        """Change the events watched for on a socket."""
+        fd = sock.fileno()
+        self._readers.pop(fd, None)
+        self._writers.pop(fd, None)
+        if readable:
+            self._readers[fd] = sock
+        if writable:
+            self._writers[fd] = sock
+
+    def unregister(self, sock):
+        """Stop watching a socket."""
+        for fd, s in self._readers.items() + self._writers.items():
+            if s is sock:
+                self._readers.pop(fd, None)
+                self._writers.pop(fd, None)
+
+    def poll(self, timeout=None):
+        """Wait for events.
+
+        Returns a tuple of two lists: readable sockets and writable
+        sockets.  A timeout of None blocks until an event arrives.
+        """
+        if not self:
+            if timeout is not None:
+                time.sleep(timeout)
+            return [], []
+        (i, o, e) = select.select(self._readers.values(),
+                                  self._writers.values(), [], timeout)
+        return i, o
+
+
+class PollPoller:
+    """Poller backend built on select.poll()."""
+
+    name = "poll"
+
+    _read_mask = getattr(select, "POLLIN", 0) | getattr(select, "POLLPRI", 0)
+    _write_mask = getattr(select, "POLLOUT", 0)
+    _error_mask = (getattr(select, "POLLERR", 0) |
+                   getattr(select, "POLLHUP", 0) |
+                   getattr(select, "POLLNVAL", 0))
+
+    def __init__(self):
+        self._poller = self._create()
+        self._sockets = {}
+
+    def __len__(self):
+        return len(self._sockets)
+
+    def _create(self):
+        """[Internal]"""
+        return select.poll()
+
+    def _mask(self, readable, writable):
+        """[Internal]"""
+        mask = 0
+        if readable:
+            mask |= self._read_mask
+        if writable:
+            mask |= self._write_mask
+        return mask
+
+    def _timeout(self, timeout):
+        """[Internal] poll() wants milliseconds."""
+        if timeout is None:
+            return None
+        return max(int(timeout * 1000), 0)
+
+    def register(self, sock, readable=True, writable=False):
+        """Start watching a socket."""
+        fd = sock.fileno()
+        if fd in self._sockets:
+            self.modify(sock, readable, writable)
+            return
+        self._sockets[fd] = sock
+        self._poller.register(fd, self._mask(readable, writable))
+
+    def modify(self, sock, readable=True, writable=False):
+        """Change the events watched for on a socket."""
+        fd = sock.fileno()
+        if fd not in self._sockets:
+            self.register(sock, readable, writable)
+            return
+        self._poller.modify(fd, self._mask(readable, writable))
+
+    def unregister(self, sock):
+        """Stop watching a socket."""
+        for fd, s in self._sockets.items():
+            if s is sock:
+                del self._sockets[fd]
+                try:
+                    self._poller.unregister(fd)
+                except (KeyError, IOError, ValueError):
+                    pass
+
+    def poll(self, timeout=None):
+        """Wait for events.
+
+        Returns a tuple of two lists: readable sockets and writable
+        sockets.  A timeout of None blocks until an event arrives.
+        """
+        if not self._sockets:
+            if timeout is not None:
+                time.sleep(timeout)
+            return [], []
+        i = []
+        o = []
+        for fd, event in self._poller.poll(self._timeout(timeout)):
+            sock = self._sockets.get(fd)
+            if sock is None:
+                continue
+            if event & self._error_mask or event & self._read_mask:
+                # Errors and hangups are reported as readable so that
+                # the connection notices them on its next recv().
+                i.append(sock)
+            if event & self._write_mask:
+                o.append(sock)
+        return i, o
+
+
+class EpollPoller(PollPoller):
+    """Poller backend built on select.epoll() (Linux only)."""
+
+    name = "epoll"
+
+    _read_mask = getattr(select, "EPOLLIN", 0) | getattr(select, "EPOLLPRI", 0)
+    _write_mask = getattr(select, "EPOLLOUT", 0)
+    _error_mask = (getattr(select, "EPOLLERR", 0) |
+                   getattr(select, "EPOLLHUP", 0))
+
+    def _create(self):
+        """[Internal]"""
+        return select.epoll()
+
+    def _timeout(self, timeout):
+        """[Internal] epoll() wants seconds, -1 blocks."""
+        if timeout is None:
+            return -1
+        return max(timeout, 0)
+
+
+pollers = {
+    "select": SelectPoller,
+    "poll": PollPoller,
+    "epoll": EpollPoller,
+}
+
+
+def default_poller():
+    """Return a new instance of the best poller backend available.
+
+    epoll is preferred, then poll, then select.  The lookup is done on
+    the select module as it is at call time, so a monkey patched module
+    (which only offers select) is honored.
+    """
+    if hasattr(select, "epoll"):
+        return EpollPoller()
+    elif hasattr(select, "poll"):
+        return PollPoller()
+    return SelectPoller()
+
+
+class Timer:
+    """A command scheduled to run later by an IRC object.
+
+    Timer objects are returned by IRC.execute_at, IRC.execute_delayed
+    and IRC.execute_every.  Call cancel() to stop the command from
+    running (again).
+    """
+
+    def __init__(self, at, function, arguments=(), interval=None):
+        self.at = at
+        self.function = function
+        self.arguments = arguments
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop the timer."""
+        self.cancelled = True
+
+    def is_repeating(self):
+        """Return true if the timer runs every interval seconds."""
+        return self.interval is not None
+
+
 class IRC:
     """Class that handles one or several IRC server connections.
 
@@ -100,13 +354,13 @@ class IRC:
     Connection objects that represent the IRC connections.  The
     responsibility of the IRC object is to provide an event-driven
     framework for the connections and to keep the connections alive.
-    It runs a select loop to poll each connection's TCP socket and
-    hands over the sockets with incoming data for processing by the
-    corresponding connection.
+    It runs a poller loop (epoll, poll or select, see default_poller)
+    over each connection's TCP socket and hands over the sockets with
+    incoming data for processing by the corresponding connection.
 
     The methods of most interest for an IRC client writer are server,
     add_global_handler, remove_global_handler, execute_at,
-    execute_delayed, process_once and process_forever.
+    execute_delayed, execute_every, process_once and process_forever.
 
     Here is an example:
 
@@ -121,23 +375,29 @@ class IRC:
     to the nickname a_nickname.
     """
 
+    # Seconds process_once waits when told to wait for events while
+    # there is neither a socket nor a timer to wait for.
+    idle_timeout = 0.2
+
     def __init__(self, fn_to_add_socket=None,
                  fn_to_remove_socket=None,
-                 fn_to_add_timeout=None):
+                 fn_to_add_timeout=None,
+                 poller=None,
+                 parser="fast"):
         """Constructor for IRC objects.
 
-        Optional arguments are fn_to_add_socket, fn_to_remove_socket
-        and fn_to_add_timeout.  The first two specify functions that
-        will be called with a socket object as argument when the IRC
-        object wants to be notified (or stop being notified) of data
-        coming on a new socket.  When new data arrives, the method
-        process_data should be called.  Similarly, fn_to_add_timeout
-        is called with a number of seconds (a floating point number)
-        as first argument when the IRC object wants to receive a
-        notification (by calling the process_timeout method).  So, if
-        e.g. the argument is 42.17, the object wants the
-        process_timeout method to be called after 42 seconds and 170
-        milliseconds.
+        Optional arguments are fn_to_add_socket, fn_to_remove_socket,
+        fn_to_add_timeout, poller and parser.  The first two specify
+        functions that will be called with a socket object as argument
+        when the IRC object wants to be notified (or stop being
+        notified) of data coming on a new socket.  When new data
+        arrives, the method process_data should be called.
+        Similarly, fn_to_add_timeout is called with a number of
+        seconds (a floating point number) as first argument when the
+        IRC object wants to receive a notification (by calling the
+        process_timeout method).  So, if e.g. the argument is 42.17,
+        the object wants the process_timeout method to be called
+        after 42 seconds and 170 milliseconds.
 
         The three arguments mainly exist to be able to use an external
         main loop (for example Tkinter's or PyGTK's main app loop)
@@ -145,6 +405,14 @@ class IRC:
 
         An alternative is to just call ServerConnection.process_once()
         once in a while.
+
+        poller selects the backend used by process_once: either one
+        of the names in the pollers dictionary ("epoll", "poll" or
+        "select"), a poller instance, or None for default_poller().
+
+        parser names the function used to parse lines from the server,
+        one of the keys of the parsers dictionary: "fast" (parse_line)
+        or "regexp" (parse_line_regexp).
         """
 
         if fn_to_add_socket and fn_to_remove_socket:
@@ -155,10 +423,29 @@ class IRC:
             self.fn_to_remove_socket = None
 
         self.fn_to_add_timeout = fn_to_add_timeout
+        if poller is None:
+            self.poller = default_poller()
+        elif isinstance(poller, basestring):
+            self.poller = pollers[poller]()
+        else:
+            self.poller = poller
+        self.parse_line = parsers[parser]
         self.connections = []
+        # Maps socket file descriptors to the owning connection.
+        self.fd_to_connection = {}
         self.handlers = {}
-        # list of tuples in the format (time, function, arguments)
+        # Event types with at least one handler.
+        self.subscribed_events = set()
+        # Event type -> tuple of handler functions in calling order,
+        # built on demand from self.handlers.
+        self._dispatch_table = {}
+        # heap of tuples in the format (time, sequence, Timer); the
+        # sequence number keeps equal deadlines in scheduling order.
         self.delayed_commands = []
+        self._timer_sequence = itertools.count()
+        # Functions queued by other threads, see execute_threadsafe.
+        self._thread_calls = collections.deque()
+        self._waker = None
 
         self.add_global_handler("ping", _ping_ponger, -42)
 
@@ -179,60 +466,110 @@ class IRC:
         See documentation for IRC.__init__.
         """
         for s in sockets:
-            for c in self.connections:
-                if s == c._get_socket():
-                    c.process_data()
+            try:
+                c = self.fd_to_connection.get(s.fileno())
+            except socket.error:
+                # Closed while handling an earlier socket in this batch.
+                continue
+            # The descriptor may have been reused by a new socket since
+            # the poller reported it.
+            if c is not None and c._get_socket() is s:
+                c.process_data()
+
+    def process_write(self, sockets):
+        """Called when connection sockets with pending output are
+        writable.
+
+        Arguments:
+
+            sockets -- A list of socket objects.
+        """
+        for s in sockets:
+            try:
+                c = self.fd_to_connection.get(s.fileno())
+            except socket.error:
+                continue
+            if c is not None and c._get_socket() is s:
+                c.flush()
 
     def process_timeout(self):
         """Called when a timeout notification is due.
 
         See documentation for IRC.__init__.
+
+        If a command raises, the due commands that haven't run yet stay
+        scheduled.
         """
         t = time.time()
-        while self.delayed_commands:
-            if t >= self.delayed_commands[0][0]:
-                self.delayed_commands[0][1](*self.delayed_commands[0][2])
-                del self.delayed_commands[0]
-            else:
-                break
+        due = collections.deque()
+        while self.delayed_commands and self.delayed_commands[0][0] <= t:
+            due.append(heapq.heappop(self.delayed_commands))
+        try:
+            while due:
+                at, _seq, timer = due.popleft()
+                if timer.cancelled:
+                    continue
+                if timer.interval is not None:
+                    # Reschedule first so the command may cancel itself.
+                    self._schedule(timer, max(at + timer.interval, t))
+                timer.function(*timer.arguments)
+        finally:
+            for at, _seq, timer in due:
+                self._schedule(timer, at)
 
     def process_once(self, timeout=0):
         """Process data from connections once.
 
         Arguments:
 
-            timeout -- How long the select() call should wait if no
-                       data is available.
+            timeout -- How long the poller should wait if no data is
+                       available.  None means wait until the next
+                       socket event or the next scheduled deadline.
+
+        The wait is cut short when a delayed command (such as a
+        connection's keepalive check) is due before the timeout
+        expires.  With nothing at all to wait for, it waits
+        idle_timeout seconds instead of returning at once.
 
         This method should be called periodically to check and process
         incoming data, if there are any.  If that seems boring, look
         at the process_forever method.
         """
-        sockets = map(lambda x: x._get_socket(), self.connections)
-        sockets = filter(lambda x: x != None, sockets)
-        if sockets:
-            (i, o, e) = select.select(sockets, [], [], timeout)
+        timeout = self._next_timeout(timeout)
+        if timeout is None and not len(self.poller):
+            timeout = self.idle_timeout
+        (i, o) = self.poller.poll(timeout)
+        if o:
+            self.process_write(o)
+        if i:
             self.process_data(i)
-        else:
-            time.sleep(timeout)
-
-        for conn in self.connections:
-            conn._check_last_event()
 
         self.process_timeout()
 
-    def process_forever(self, timeout=0.2):
+    def process_forever(self, timeout=None):
         """Run an infinite loop, processing data from connections.
 
         This method repeatedly calls process_once.
 
         Arguments:
 
-            timeout -- Parameter to pass to process_once.
+            timeout -- Parameter to pass to process_once.  The default
+                       sleeps until there is something to do.
         """
         while 1:
             self.process_once(timeout)
 
+    def _next_timeout(self, timeout):
+        """[Internal] Clamp timeout to the next pending deadline."""
+        while self.delayed_commands and self.delayed_commands[0][2].cancelled:
+            heapq.heappop(self.delayed_commands)
+        if not self.delayed_commands:
+            return timeout
+        wait = max(self.delayed_commands[0][0] - time.time(), 0)
+        if timeout is None or wait < timeout:
+            return wait
+        return timeout
+
     def disconnect_all(self, message=""):
         """Disconnects all connections."""
         for c in self.connections:
@@ -258,10 +595,16 @@ class IRC:
         The handler functions are called in priority order (lowest
         number is highest priority).  If a handler function returns
         \"NO MORE\", no more handlers will be called.
+
+        Handlers for \"all_events\" receive every event except
+        \"all_raw_messages\", which is only generated when a handler
+        is registered for it explicitly.
         """
         if not event in self.handlers:
             self.handlers[event] = []
         bisect.insort(self.handlers[event], ((priority, handler)))
+        self.subscribed_events.add(event)
+        self._dispatch_table.clear()
 
     def remove_global_handler(self, event, handler):
         """Removes a global handler function.
@@ -276,11 +619,25 @@ class IRC:
         """
         if not event in self.handlers:
             return 0
-        for h in self.handlers[event]:
+        for h in self.handlers[event][:]:
             if handler == h[1]:
                 self.handlers[event].remove(h)
+        if not self.handlers[event]:
+            self.subscribed_events.discard(event)
+        self._dispatch_table.clear()
         return 1
 
+    def has_subscribers(self, event):
+        """Check whether any global handler will receive an event type.
+
+        Connections use this to avoid building events nobody listens
+        to.
+        """
+        if event in self.subscribed_events:
+            return True
+        return ("all_events" in self.subscribed_events and
+                event != "all_raw_messages")
+
     def execute_at(self, at, function, arguments=()):
         """Execute a function at a specified time.
 
@@ -291,8 +648,12 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+        Returns a Timer object that can be used to cancel the call.
         """
-        self.execute_delayed(at - time.time(), function, arguments)
+        timer = Timer(at, function, arguments)
+        self._schedule(timer, at)
+        return timer
 
     def execute_delayed(self, delay, function, arguments=()):
         """Execute a function after a specified time.
@@ -304,11 +665,62 @@ class IRC:
             function -- Function to call.
 
             arguments -- Arguments to give the function.
+
+        Returns a Timer object that can be used to cancel the call.
+        """
+        return self.execute_at(delay + time.time(), function, arguments)
+
+    def execute_every(self, interval, function, arguments=()):
+        """Execute a function repeatedly.
+
+        Arguments:
+
+            interval -- How many seconds to wait between calls.  The
+                        first call happens after one interval.
+
+            function -- Function to call.
+
+            arguments -- Arguments to give the function.
+
+        Returns a Timer object; cancel it to stop the calls.
         """
-        bisect.insort(self.delayed_commands,
-            (delay + time.time(), function, arguments))
+        timer = Timer(interval + time.time(), function, arguments, interval)
+        self._schedule(timer, timer.at)
+        return timer
+
+    def execute_threadsafe(self, function, arguments=()):
+        """Execute a function in the thread running the event loop.
+
+        This is the only IRC method that may be called from another
+        thread.  The function is run by process_once as soon as
+        possible; a loop waiting on the poller is woken up.
+        """
+        self._thread_calls.append((function, arguments))
+        waker = self._waker
+        if waker is not None:
+            waker.wake()
+
+    def _ensure_waker(self):
+        """[Internal] Set up the socket other threads wake the loop
+        with.
+        """
+        if self._waker is None:
+            self._waker = _Waker(self)
+
+    def _run_thread_calls(self):
+        """[Internal]"""
+        calls = self._thread_calls
+        while calls:
+            function, arguments = calls.popleft()
+            function(*arguments)
+
+    def _schedule(self, timer, at):
+        """[Internal]"""
+        timer.at = at
+        heapq.heappush(self.delayed_commands,
+            (at, self._timer_sequence.next(), timer))
         if self.fn_to_add_timeout:
-            self.fn_to_add_timeout(delay)
+            self.fn_to_add_timeout(max(at - time.time(), 0))
 
     def dcc(self, dcctype="chat"):
         """Creates and returns a DCCConnection object.
@@ -324,22 +736,172 @@ class IRC:
         self.connections.append(c)
         return c
 
+    def dcc_send(self, filename, rate=None):
+        """Creates and returns a DCCSendConnection object that serves
+        a file to one DCC SEND peer.
+
+        Arguments:
+
+            filename -- Path of the file to serve.
+
+            rate -- Maximum throughput in bytes per second, or None
+                    for no limit.
+        """
+        c = DCCSendConnection(self, filename, rate)
+        self.connections.append(c)
+        return c
+
     def _handle_event(self, connection, event):
         """[Internal]"""
-        h = self.handlers
-        for handler in h.get("all_events", []) + h.get(event.eventtype(), []):
-            if handler[1](connection, event) == "NO MORE":
+        try:
+            handlers = self._dispatch_table[event.eventtype()]
+        except KeyError:
+            handlers = self._build_dispatch(event.eventtype())
+        for handler in handlers:
+            if handler(connection, event) == "NO MORE":
                 return
 
+    def _build_dispatch(self, eventtype):
+        """[Internal] Merge the handlers that receive an event type."""
+        h = self.handlers
+        if eventtype == "all_raw_messages":
+            handlers = h.get(eventtype, [])
+        else:
+            handlers = h.get("all_events", []) + h.get(eventtype, [])
+        handlers = tuple([handler for _priority, handler in handlers])
+        self._dispatch_table[eventtype] = handlers
+        return handlers
+
     def _remove_connection(self, connection):
         """[Internal]"""
         self.connections.remove(connection)
+        for fd, c in self.fd_to_connection.items():
+            if c is connection:
+                del self.fd_to_connection[fd]
         if self.fn_to_remove_socket:
             self.fn_to_remove_socket(connection._get_socket())
 
+    def _add_socket(self, connection, sock):
+        """[Internal] Start watching a connection socket."""
+        self.fd_to_connection[sock.fileno()] = connection
+        self.poller.register(sock)
+        if self.fn_to_add_socket:
+            self.fn_to_add_socket(sock)
+
+    def _remove_socket(self, connection, sock):
+        """[Internal] Stop watching a connection socket."""
+        try:
+            fd = sock.fileno()
+        except socket.error:
+            fd = None
+        if self.fd_to_connection.get(fd) is connection:
+            del self.fd_to_connection[fd]
+        self.poller.unregister(sock)
+
 _rfc_1459_command_regexp = re.compile(
     "^(:(?P<prefix>[^ ]+) +)?(?P<command>[^ ]+)( *(?P<argument> .+))?")
 
+_tag_value_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+# Raw command -> event type, filled in as commands are seen.
+_command_names = {}
+
+
+def _command_name(command):
+    """[Internal] Lowercase a command and translate numerics."""
+    try:
+        return _command_names[command]
+    except KeyError:
+        name = command.lower()
+        name = numeric_events.get(name, name)
+        if len(_command_names) < 1024:
+            _command_names[command] = name
+        return name
+
+
+def _parse_tags(tags):
+    """[Internal] Parse an IRCv3 message tag string into a dictionary."""
+    result = {}
+    for tag in tags.split(";"):
+        if not tag:
+            continue
+        key, sep, value = tag.partition("=")
+        if "\\" in value:
+            chars = []
+            i = 0
+            while i < len(value):
+                ch = value[i]
+                if ch == "\\":
+                    i += 1
+                    if i < len(value):
+                        ch = _tag_value_escapes.get(value[i], value[i])
+                    else:
+                        ch = ""
+                chars.append(ch)
+                i += 1
+            value = "".join(chars)
+        result[key] = value
+    return result
+
+
+def _split_tags(line):
+    """[Internal] Split the IRCv3 tags off a line."""
+    if line[:1] != "@":
+        return None, line
+    tags, _sep, line = line.partition(" ")
+    return _parse_tags(tags[1:]), line.lstrip(" ")
+
+
+def parse_line(line):
+    """Parse a line received from an IRC server.
+
+    Returns a tuple (tags, prefix, command, arguments).  tags is a
+    dictionary of IRCv3 message tags or None, prefix is None when the
+    line has no prefix, command is lowercased with numerics translated
+    through numeric_events, and arguments is a list of strings.
+    """
+    tags, line = _split_tags(line)
+
+    prefix = None
+    if line[:1] == ":":
+        prefix, _sep, line = line.partition(" ")
+        prefix = prefix[1:]
+        line = line.lstrip(" ")
+
+    command, sep, rest = line.partition(" ")
+    if not sep:
+        return tags, prefix, _command_name(command), []
+
+    if rest[:1] == ":":
+        return tags, prefix, _command_name(command), [rest[1:]]
+    middle, sep, trailing = rest.partition(" :")
+    arguments = middle.split()
+    if sep:
+        arguments.append(trailing)
+    return tags, prefix, _command_name(command), arguments
+
+
+def parse_line_regexp(line):
+    """Parse a line like parse_line, using the RFC 1459 regexp.
+
+    This is the original irclib parser, kept for comparison.
+    """
+    tags, line = _split_tags(line)
+    m = _rfc_1459_command_regexp.match(line)
+    arguments = []
+    if m.group("argument"):
+        a = m.group("argument").split(" :", 1)
+        arguments = a[0].split()
+        if len(a) == 2:
+            arguments.append(a[1])
+    return tags, m.group("prefix"), _command_name(m.group("command")), \
+        arguments
+
+parsers = {
+    "fast": parse_line,
+    "regexp": parse_line_regexp,
+}
+
 
 class Connection:
     """Base class for IRC connections.
@@ -353,14 +915,114 @@ class Connection:
     def _get_socket():
         raise IRCError("Not overridden")
 
+    def flush(self):
+        """Write buffered output, if the connection buffers any."""
+        pass
+
     ##############################
     ### Convenience wrappers.
 
     def execute_at(self, at, function, arguments=()):
-        self.irclibobj.execute_at(at, function, arguments)
+        return self.irclibobj.execute_at(at, function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
-        self.irclibobj.execute_delayed(delay, function, arguments)
+        return self.irclibobj.execute_delayed(delay, function, arguments)
+
+    def execute_every(self, interval, function, arguments=()):
+        return self.irclibobj.execute_every(interval, function, arguments)
+
+
+class _Waker(Connection):
+    """[Internal] A socket pair that wakes the event loop up when
+    another thread has queued work for it.
+    """
+
+    def __init__(self, irclibobj):
+        Connection.__init__(self, irclibobj)
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(0)
+        self._writer.setblocking(0)
+        irclibobj._add_socket(self, self._reader)
+
+    def _get_socket(self):
+        """[Internal]"""
+        return self._reader
+
+    def wake(self):
+        """[Internal]"""
+        try:
+            self._writer.send("x")
+        except socket.error:
+            # The pair is full, so a wake-up is pending anyway.
+            pass
+
+    def process_data(self):
+        """[Internal]"""
+        try:
+            while self._reader.recv(2 ** 12):
+                pass
+        except socket.error:
+            pass
+        self.irclibobj._run_thread_calls()
+
+
+class _ConnectAttempt(Connection):
+    """[Internal] A non-blocking TCP connect to one of the addresses
+    of a server.  Reports back to the ServerConnection when the socket
+    is connected or has failed.
+    """
+
+    def __init__(self, owner, family, address):
+        Connection.__init__(self, owner.irclibobj)
+        self.owner = owner
+        self.address = address
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+
+    def start(self, localaddress, localport):
+        """[Internal]"""
+        if localaddress or localport:
+            self.socket.bind((localaddress or "", localport))
+        error = self.socket.connect_ex(self.address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(error, os.strerror(error))
+        self.irclibobj._add_socket(self, self.socket)
+        self.irclibobj.poller.modify(self.socket, False, True)
+
+    def _get_socket(self):
+        """[Internal]"""
+        return self.socket
+
+    def process_data(self):
+        """[Internal]"""
+        self.owner._attempt_ready(self)
+
+    flush = process_data
+
+    def close(self):
+        """[Internal]"""
+        self.irclibobj._remove_socket(self, self.socket)
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+def _interleave_addresses(infos):
+    """[Internal] Order getaddrinfo() results for connecting, Happy
+    Eyeballs style (RFC 6555): alternate between address families,
+    starting with the family of the first result.
+
+    Returns a list of (family, address) tuples.
+    """
+    families = collections.OrderedDict()
+    for family, _socktype, _proto, _name, address in infos:
+        if (family, address) not in families.get(family, ()):
+            families.setdefault(family, []).append((family, address))
+    return [candidate
+            for candidates in itertools.izip_longest(*families.values())
+            for candidate in candidates
+            if candidate is not None]
 
 
 class ServerConnectionError(IRCError):
@@ -372,8 +1034,148 @@ class ServerNotConnectedError(ServerConnectionError):
 
 
 # Huh!?  Crrrrazy EFNet doesn't follow the RFC: their ircd seems to
-# use \n as message separator!  :P
-_linesep_regexp = re.compile("\r?\n")
+# use \n as message separator!  :P  LineBuffer accepts both.
+class LineBuffer:
+    """Incremental line framer for data read from a socket.
+
+    Data is appended to a bytearray with feed() and complete lines are
+    found by scanning for LF (optionally preceded by CR) in place, so
+    the unfinished tail is never re-joined with new data and nothing is
+    split until it is complete.  The consumed part of the buffer is
+    dropped on the next feed().
+
+    Iterating over the buffer yields each complete line, without its
+    terminator, as a memoryview slice of the buffer.  The slices are
+    only valid until the next call to feed(); use lines() to get
+    strings instead.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._start = 0
+
+    def __len__(self):
+        """Number of bytes not yet returned as part of a line."""
+        return len(self._buffer) - self._start
+
+    def feed(self, data):
+        """Append data read from the socket."""
+        self._compact()
+        try:
+            self._buffer.extend(data)
+        except BufferError:
+            # A line view from an earlier pass is still alive.
+            self._buffer = bytearray(self._buffer)
+            self._buffer.extend(data)
+
+    def _compact(self):
+        """[Internal] Drop the lines that have already been returned."""
+        if not self._start:
+            return
+        if self._start == len(self._buffer):
+            self._buffer = bytearray()
+        else:
+            try:
+                del self._buffer[:self._start]
+            except BufferError:
+                self._buffer = self._buffer[self._start:]
+        self._start = 0
+
+    def __iter__(self):
+        buf = self._buffer
+        view = memoryview(buf)
+        while True:
+            start = self._start
+            end = buf.find("\n", start)
+            if end < 0:
+                break
+            self._start = end + 1
+            if end > start and buf[end - 1] == 13:
+                end -= 1
+            yield view[start:end]
+
+    def lines(self):
+        """Yield the complete lines as strings."""
+        for line in self:
+            yield line.tobytes()
+
+
+class Channel(object):
+    """The state of a channel we are on, as tracked by a
+    ServerConnection (see its channels attribute).
+
+    Members are kept in a dictionary from the lowercased nick, interned
+    and shared with the other channels, to the status modes the member
+    has (e.g. "o" or "ov"), so checks are O(1).
+    """
+
+    __slots__ = ("name", "modes", "synced", "_members", "_names",
+                 "_table")
+
+    def __init__(self, name, names, table):
+        self.name = name
+        # Mode -> argument (None for modes without one).  List modes,
+        # like bans, aren't tracked.
+        self.modes = {}
+        # False while a NAMES reply is coming in.
+        self.synced = False
+        self._members = {}
+        # Shared lowercased nick -> nick as last seen.
+        self._names = names
+        self._table = table
+
+    def __repr__(self):
+        return "<Channel %s: %d users>" % (self.name, len(self._members))
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, nick):
+        return nick.translate(self._table) in self._members
+
+    has_user = __contains__
+
+    def users(self):
+        """Get the nicks on the channel."""
+        names = self._names
+        return [names.get(lowered, lowered) for lowered in self._members]
+
+    def user_modes(self, nick):
+        """Get the status modes of a nick on the channel (e.g. "ov"),
+        or None if the nick isn't on it.
+        """
+        return self._members.get(nick.translate(self._table))
+
+    def is_oper(self, nick):
+        """Check if a nick is a channel operator."""
+        return "o" in (self.user_modes(nick) or "")
+
+    def is_voiced(self, nick):
+        """Check if a nick has voice."""
+        return "v" in (self.user_modes(nick) or "")
+
+    def has_mode(self, mode):
+        """Check if a channel mode is set."""
+        return mode in self.modes
+
+    def _add(self, lowered, modes=""):
+        """[Internal]"""
+        self._members[lowered] = intern(modes)
+
+    def _remove(self, lowered):
+        """[Internal]"""
+        return self._members.pop(lowered, None) is not None
+
+    def _set_user_mode(self, lowered, sign, mode):
+        """[Internal]"""
+        modes = self._members.get(lowered)
+        if modes is None:
+            return
+        if sign == "+" and mode not in modes:
+            modes += mode
+        elif sign == "-":
+            modes = modes.replace(mode, "")
+        self._members[lowered] = intern(modes)
 
 
 class ServerConnection(Connection):
@@ -383,14 +1185,66 @@ class ServerConnection(Connection):
     method on an IRC object.
     """
 
+    # Seconds of silence from the server before we PING it, and
+    # seconds to wait for traffic after that before giving up.
+    keepalive_interval = 60
+    keepalive_timeout = 30
+
+    # Seconds allowed for looking the server up, connecting and the
+    # SSL handshake.
+    connect_timeout = 60
+
+    # Maximum number of queued bytes written with one send() call.
+    send_chunk_size = 2 ** 14
+
+    # Flood control: lines per second and burst size, see
+    # set_flood_control().  A rate of None disables it.
+    flood_rate = None
+    flood_burst = 5
+
+    # Bytes of text a message line always has room for; messages to
+    # many targets at once are sent in smaller groups to keep it.
+    min_text_length = 100
+
+    # Seconds to wait for a connect attempt before also trying the
+    # next address of the server.
+    connect_attempt_delay = 0.25
+
+    # Keep track of channel members and modes in self.channels.
+    track_channels = True
+
     def __init__(self, irclibobj):
         Connection.__init__(self, irclibobj)
         self.connected = 0  # Not connected yet.
         self.socket = None
         self.ssl = None
+        # None once the connection is established (or down), otherwise
+        # "resolving", "connecting" or "handshaking".
+        self._connect_state = None
+        self._connect_generation = 0
+        self._candidates = collections.deque()
+        self._attempts = []
+        self._attempt_timer = None
+        self._connect_timer = None
+        self._keepalive_timer = None
+        self._ping_token = None
+        self._ping_time = None
+        self.lag = None
+        self.connect_timings = {}
+        self.features = {}
+        self._reset_capabilities()
+        self._reset_channels()
+        self.ssl_context = None
+        self._reset_send_queue()
+        self._reset_flood_queue()
+        # If set, an object whose record(line) method is called with
+        # every line received from the server.
+        self.capture = None
 
     def connect(self, server, port, nickname, password=None, username=None,
-        ircname=None, localaddress="", localport=0, ssl=False, ipv6=False):
+        ircname=None, localaddress="", localport=0, ssl=False, ipv6=False,
+        ssl_context=None, capabilities=None, sasl_mechanism=None,
+        sasl_username=None, sasl_password=None):
         """Connect/reconnect to a server.
 
         Arguments:
@@ -413,19 +1267,75 @@ class ServerConnection(Connection):
 
             ssl -- Enable support for ssl.
 
-            ipv6 -- Enable support for ipv6.
+            ipv6 -- Enable support for ipv6: the server's IPv6 and IPv4
+                    addresses are both tried.  Otherwise only IPv4 is
+                    used.
+
+            ssl_context -- The SSLContext to use (see
+                           create_ssl_context).  By default a context
+                           is created on the first SSL connect and kept
+                           for reconnects.
+
+            capabilities -- IRCv3 capabilities to request, such as
+                            supported_capabilities.  Those the server
+                            offers are negotiated (CAP LS, REQ and END)
+                            before registration completes, and the
+                            ones it acknowledges end up in
+                            self.capabilities.  By default there is no
+                            negotiation.
+
+            sasl_mechanism -- Authenticate with SASL during capability
+                              negotiation, before registration
+                              completes: "PLAIN" (with sasl_username,
+                              the nickname by default, and
+                              sasl_password) or "EXTERNAL" (with the
+                              SSL client certificate).  Whether it
+                              worked is in self.sasl_authenticated.
 
         This function can be called to reconnect a closed connection.
 
+        The connection is set up in the background by the event loop:
+        the server name is looked up in a separate thread, its
+        addresses are tried Happy Eyeballs style (a new attempt is
+        started every connect_attempt_delay seconds until one
+        succeeds) and the SSL handshake is done without blocking.
+        Commands sent in the meantime, starting with the registration,
+        are queued until the connection is established.  If it can't
+        be established, a "disconnect" event is generated.  The time
+        spent in each phase is recorded in connect_timings.
+
+        When the IRC object is driven by an external main loop
+        (fn_to_add_socket), connect blocks until the connection is
+        established, and raises ServerConnectionError on failure.
+
         Returns the ServerConnection object.
         """
         if self.connected:
             self.disconnect("Changing servers")
-
-        self.previous_buffer = ""
+        if ssl and _ssl is None:
+            raise ServerConnectionError("SSL is not supported")
+        if ssl_context is not None:
+            self.ssl_context = ssl_context
+        elif ssl and self.ssl_context is None:
+            self.ssl_context = create_ssl_context()
+
+        self.buffer = LineBuffer()
+        self._reset_send_queue()
+        self._reset_flood_queue()
+        self.ssl = None
         self.handlers = {}
         self.real_server_name = ""
         self.real_nickname = nickname
+        self.real_userhost = ""
+        self.features = {}
+        self._reset_capabilities()
+        self.wanted_capabilities = frozenset(capabilities or ())
+        self.sasl_mechanism = sasl_mechanism and sasl_mechanism.upper()
+        self.sasl_username = sasl_username or nickname
+        self.sasl_password = sasl_password
+        if self.sasl_mechanism:
+            self.wanted_capabilities |= frozenset(["sasl"])
+        self._reset_channels()
         self.server = server
         self.port = port
         self.nickname = nickname
@@ -434,38 +1344,337 @@ class ServerConnection(Connection):
         self.password = password
         self.localaddress = localaddress
         self.localport = localport
-        self.localhost = socket.gethostname()
+        self.use_ssl = ssl
+        self.ipv6 = ipv6
         self.last_event = time.time()
-
-        if ipv6:
-            self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        else:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.socket.bind((self.localaddress, self.localport))
-            self.socket.connect((self.server, self.port))
-            if ssl:
-                try:
-                    import ssl
-                    ssl_wrap = ssl.wrap_socket
-                except ImportError:
-                    ssl_wrap = socket.ssl
-                self.ssl = ssl_wrap(self.socket)
-        except socket.error, x:
-            self.socket.close()
-            self.socket = None
-            raise ServerConnectionError("Couldn't connect to socket: %s" % x)
+        self.connect_timings = {}
+        self._connect_generation += 1
+        self._connect_error = None
+        self._phase_started = time.time()
+        self._registration_started = None
+        self._connect_state = "resolving"
         self.connected = 1
-        if self.irclibobj.fn_to_add_socket:
-            self.irclibobj.fn_to_add_socket(self.socket)
+        self.lag = None
+        self._ping_token = None
+        self._ping_time = None
 
         # Log on...
+        if self.wanted_capabilities:
+            self._cap_negotiating = True
+            self.send_raw("CAP LS 302")
         if self.password:
             self.pass_(self.password)
         self.nick(self.nickname)
         self.user(self.username, self.ircname)
+
+        if self.irclibobj.fn_to_add_socket:
+            # An external main loop only reports readable sockets.
+            self._connect_blocking()
+        else:
+            self._connect_timer = self.execute_delayed(
+                self.connect_timeout, self._connect_timed_out)
+            self._resolve()
         return self
 
+    def _connect_timed_out(self):
+        """[Internal]"""
+        self._connect_timer = None
+        if self._connect_state is not None:
+            self._connect_failed("Connection timed out")
+
+    def _address_family(self):
+        """[Internal]"""
+        if self.ipv6:
+            return socket.AF_UNSPEC
+        return socket.AF_INET
+
+    def _resolve(self):
+        """[Internal] Look the server up, in a thread unless it is an
+        address already.
+        """
+        generation = self._connect_generation
+        family = self._address_family()
+        try:
+            infos = socket.getaddrinfo(self.server, self.port, family,
+                                       socket.SOCK_STREAM, 0,
+                                       socket.AI_NUMERICHOST)
+        except socket.error:
+            pass
+        else:
+            self._resolved(generation, infos, None)
+            return
+
+        self.irclibobj._ensure_waker()
+        resolver = threading.Thread(target=self._resolve_thread,
+                                    args=(generation, family))
+        resolver.daemon = True
+        resolver.start()
+
+    def _resolve_thread(self, generation, family):
+        """[Internal] Runs in the resolver thread."""
+        try:
+            infos = socket.getaddrinfo(self.server, self.port, family,
+                                       socket.SOCK_STREAM)
+            error = None
+        except socket.error, x:
+            infos, error = [], x
+        self.irclibobj.execute_threadsafe(self._resolved,
+                                          (generation, infos, error))
+
+    def _resolved(self, generation, infos, error):
+        """[Internal]"""
+        if (generation != self._connect_generation or
+            self._connect_state != "resolving"):
+            # Disconnected (or reconnected) during the lookup.
+            return
+        self._end_phase("dns")
+        if not infos:
+            self._connect_failed("Couldn't resolve %s: %s" % (self.server,
+                                                               error))
+            return
+        self._candidates = collections.deque(_interleave_addresses(infos))
+        self._connect_state = "connecting"
+        self._start_attempt()
+
+    def _start_attempt(self):
+        """[Internal] Start connecting to the next address."""
+        self._attempt_timer = None
+        while self._candidates:
+            family, address = self._candidates.popleft()
+            try:
+                attempt = _ConnectAttempt(self, family, address)
+            except socket.error, x:
+                self._connect_error = x
+                continue
+            try:
+                attempt.start(self.localaddress, self.localport)
+            except socket.error, x:
+                attempt.close()
+                self._connect_error = x
+                continue
+            self._attempts.append(attempt)
+            if self._candidates:
+                self._attempt_timer = self.execute_delayed(
+                    self.connect_attempt_delay, self._start_attempt)
+            return
+        if not self._attempts:
+            self._connect_failed("Couldn't connect to socket: %s" %
+                                 self._connect_error)
+
+    def _attempt_ready(self, attempt):
+        """[Internal] A connect attempt finished, one way or another."""
+        if attempt not in self._attempts:
+            return
+        error = attempt.socket.getsockopt(socket.SOL_SOCKET,
+                                          socket.SO_ERROR)
+        self._attempts.remove(attempt)
+        if error:
+            attempt.close()
+            self._connect_error = socket.error(error, os.strerror(error))
+            # Don't wait for the timer to try the next address.
+            if self._attempt_timer is not None:
+                self._attempt_timer.cancel()
+            self._start_attempt()
+            return
+
+        self._abort_attempts()
+        self.irclibobj._remove_socket(attempt, attempt.socket)
+        self.socket = attempt.socket
+        self.irclibobj._add_socket(self, self.socket)
+        self._end_phase("tcp")
+        if self.use_ssl:
+            self._start_handshake()
+        else:
+            self._established()
+
+    def _abort_attempts(self):
+        """[Internal]"""
+        if self._attempt_timer is not None:
+            self._attempt_timer.cancel()
+            self._attempt_timer = None
+        for attempt in self._attempts:
+            attempt.close()
+        self._attempts = []
+        self._candidates = collections.deque()
+
+    def _wrap_ssl(self, sock):
+        """[Internal]"""
+        if self.ssl_context is None:
+            # No SSLContext in this Python.
+            return _ssl.wrap_socket(sock, do_handshake_on_connect=False)
+        kwargs = {"do_handshake_on_connect": False}
+        if _ssl.HAS_SNI:
+            kwargs["server_hostname"] = self.server
+        return self.ssl_context.wrap_socket(sock, **kwargs)
+
+    def _start_handshake(self):
+        """[Internal]"""
+        try:
+            self.ssl = self._wrap_ssl(self.socket)
+        except socket.error, x:
+            self._connect_failed("Couldn't connect to socket: %s" % x)
+            return
+        self._connect_state = "handshaking"
+        self._continue_handshake()
+
+    def _continue_handshake(self):
+        """[Internal] Drive the SSL handshake as the socket allows."""
+        try:
+            self.ssl.do_handshake()
+        except _ssl.SSLError, x:
+            if x.args[0] == _ssl.SSL_ERROR_WANT_READ:
+                self.irclibobj.poller.modify(self.socket, True, False)
+                return
+            if x.args[0] == _ssl.SSL_ERROR_WANT_WRITE:
+                self.irclibobj.poller.modify(self.socket, True, True)
+                return
+            self._connect_failed("SSL handshake failed: %s" % x)
+            return
+        except socket.error, x:
+            self._connect_failed("SSL handshake failed: %s" % x)
+            return
+        self._end_phase("tls")
+        self._established()
+
+    def _connect_blocking(self):
+        """[Internal] Connect without the help of the event loop."""
+        try:
+            infos = socket.getaddrinfo(self.server, self.port,
+                                       self._address_family(),
+                                       socket.SOCK_STREAM)
+        except socket.error, x:
+            self._connect_cleanup()
+            raise ServerConnectionError("Couldn't resolve %s: %s" %
+                                        (self.server, x))
+        self._end_phase("dns")
+        for family, address in _interleave_addresses(infos):
+            try:
+                sock = socket.socket(family, socket.SOCK_STREAM)
+            except socket.error, x:
+                self._connect_error = x
+                continue
+            try:
+                if self.localaddress or self.localport:
+                    sock.bind((self.localaddress or "", self.localport))
+                sock.connect(address)
+            except socket.error, x:
+                sock.close()
+                self._connect_error = x
+                continue
+            self.socket = sock
+            break
+        else:
+            self._connect_cleanup()
+            raise ServerConnectionError("Couldn't connect to socket: %s" %
+                                        self._connect_error)
+        self._end_phase("tcp")
+        if self.use_ssl:
+            try:
+                self.ssl = self._wrap_ssl(self.socket)
+                self.ssl.do_handshake()
+            except socket.error, x:
+                self._connect_cleanup()
+                raise ServerConnectionError("SSL handshake failed: %s" % x)
+            self._end_phase("tls")
+        # Writes are queued and flushed when the socket is writable.
+        (self.ssl or self.socket).setblocking(0)
+        self.irclibobj._add_socket(self, self.socket)
+        self._established()
+
+    def _end_phase(self, phase):
+        """[Internal] Record how long a phase of connecting took."""
+        now = time.time()
+        self.connect_timings[phase] = now - self._phase_started
+        self._phase_started = now
+
+    def _established(self):
+        """[Internal]"""
+        self._connect_state = None
+        if self._connect_timer is not None:
+            self._connect_timer.cancel()
+            self._connect_timer = None
+        self._registration_started = time.time()
+        self.last_event = time.time()
+        self._want_write = False
+        self.irclibobj.poller.modify(self.socket, True, False)
+        self._keepalive_timer = self.execute_at(
+            self.last_event + self.keepalive_interval, self._keepalive)
+        self.flush()
+
+    def _keepalive(self):
+        """[Internal] Timer: PING the server when it has been quiet for
+        keepalive_interval seconds, and hang up if it then stays quiet
+        for keepalive_timeout seconds.
+
+        Incoming data only updates last_event; this runs once per
+        interval, not on every pass of the event loop.
+        """
+        self._keepalive_timer = None
+        if not self.is_established():
+            return
+        now = time.time()
+        if self._ping_time is not None and self.last_event <= self._ping_time:
+            self.disconnect("Ping timeout")
+            return
+        idle_until = self.last_event + self.keepalive_interval
+        if idle_until > now:
+            self._keepalive_timer = self.execute_at(idle_until,
+                                                    self._keepalive)
+            return
+        self._ping_token = "LAG%d" % int(now * 1000)
+        self._ping_time = now
+        self.ping(self._ping_token)
+        self._keepalive_timer = self.execute_at(now + self.keepalive_timeout,
+                                                self._keepalive)
+
+    def _keepalive_pong(self, arguments):
+        """[Internal] Measure the lag from the answer to our PING."""
+        if self._ping_token is not None and \
+           arguments[-1:] == [self._ping_token]:
+            self.lag = time.time() - self._ping_time
+            self._ping_token = None
+
+    def get_lag(self):
+        """Get the round trip time of the last keepalive PING, in
+        seconds, or None if it hasn't been measured yet.
+        """
+        return self.lag
+
+    def _stop_timers(self):
+        """[Internal]"""
+        for timer in (self._connect_timer, self._keepalive_timer):
+            if timer is not None:
+                timer.cancel()
+        self._connect_timer = self._keepalive_timer = None
+
+    def _connect_cleanup(self):
+        """[Internal]"""
+        self._stop_timers()
+        self._abort_attempts()
+        if self.socket is not None:
+            self.irclibobj._remove_socket(self, self.socket)
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+        self.socket = None
+        self.ssl = None
+        self._connect_state = None
+        self.connected = 0
+        self._reset_send_queue()
+        self._reset_flood_queue()
+
+    def _connect_failed(self, message):
+        """[Internal]"""
+        self._connect_cleanup()
+        self._handle_event(Event("disconnect", self.server, "", [message]))
+
+    def is_established(self):
+        """Return true once the connection to the server is up (even
+        if registration isn't complete yet).
+        """
+        return self.connected and self._connect_state is None
+
     def close(self):
         """Close the connection.
 
@@ -501,17 +1710,40 @@ class ServerConnection(Connection):
 
         return self.real_nickname
 
+    def get_nickmask(self):
+        """Get the nickmask the server relays our messages with.
+
+        The user@host part is learned from the welcome message or our
+        own JOINs; until then it is estimated at its maximum length.
+        """
+        userhost = self.real_userhost
+        if not userhost:
+            userhost = "%s@%s" % ("x" * (int(self.features.get("USERLEN")
+                                             or 10) + 1),
+                                  "x" * int(self.features.get("HOSTLEN")
+                                            or 63))
+        return "%s!%s" % (self.real_nickname, userhost)
+
     def process_data(self):
         """[Internal]"""
         if not self.is_connected():
             return
+        if self._connect_state == "handshaking":
+            self._continue_handshake()
+            return
 
         try:
             if self.ssl:
                 new_data = self.ssl.read(2 ** 14)
+                # Drain records already decrypted by the SSL layer; the
+                # poller won't report them.
+                while getattr(self.ssl, "pending", int)():
+                    new_data += self.ssl.read(2 ** 14)
             else:
                 new_data = self.socket.recv(2 ** 14)
         except socket.error, x:
+            if _would_block(x):
+                return
             # The server hung up.
             self.disconnect("Connection reset by peer")
             return
@@ -520,47 +1752,40 @@ class ServerConnection(Connection):
             self.disconnect("Connection reset by peer")
             return
 
-        lines = _linesep_regexp.split(self.previous_buffer + new_data)
-
-        # Save the last, unfinished line.
-        self.previous_buffer = lines.pop()
+        self.buffer.feed(new_data)
 
         # Record the time of this event
         self.last_event = time.time()
 
-        for line in lines:
+        # Replies sent by the handlers are written out together.
+        self._corked = True
+        try:
+            self._process_lines()
+        finally:
+            self._corked = False
+            self.flush()
+
+    def _process_lines(self):
+        """[Internal]"""
+        for line in self.buffer.lines():
             if DEBUG:
                 print "FROM SERVER:", line
 
             if not line:
                 continue
 
-            prefix = None
-            command = None
-            arguments = None
-            self._handle_event(Event("all_raw_messages",
-                                     self.get_server_name(),
-                                     None,
-                                     [line]))
-
-            m = _rfc_1459_command_regexp.match(line)
-            if m.group("prefix"):
-                prefix = m.group("prefix")
-                if not self.real_server_name:
-                    self.real_server_name = prefix
-
-            if m.group("command"):
-                command = m.group("command").lower()
-
-            if m.group("argument"):
-                a = m.group("argument").split(" :", 1)
-                arguments = a[0].split()
-                if len(a) == 2:
-                    arguments.append(a[1])
-
-            # Translate numerics into more readable strings.
-            if command in numeric_events:
-                command = numeric_events[command]
+            if self.capture is not None:
+                self.capture.record(line)
+
+            if self._has_subscribers("all_raw_messages"):
+                self._handle_event(Event("all_raw_messages",
+                                         self.get_server_name(),
+                                         None,
+                                         [line]))
+
+            tags, prefix, command, arguments = self.irclibobj.parse_line(line)
+            if prefix and not self.real_server_name:
+                self.real_server_name = prefix
 
             if command == "nick":
                 if nm_to_n(prefix) == self.real_nickname:
@@ -569,19 +1794,63 @@ class ServerConnection(Connection):
                 # Record the nickname in case the client changed nick
                 # in a nicknameinuse callback.
                 self.real_nickname = arguments[0]
+                if self._registration_started is not None:
+                    self.connect_timings["registration"] = (
+                        time.time() - self._registration_started)
+                    self._registration_started = None
+                mask = arguments[-1].split(" ")[-1]
+                if "!" in mask and "@" in mask:
+                    self.real_userhost = nm_to_uh(mask)
+                # The server ends capability negotiation by itself if
+                # it doesn't know CAP.
+                self._cap_negotiating = False
+                self._cap_requests = 0
+                self._sasl_started = None
+            elif command == "join":
+                if prefix and "!" in prefix and \
+                   nm_to_n(prefix) == self.real_nickname:
+                    self.real_userhost = nm_to_uh(prefix)
+            elif command == "featurelist":
+                self._parse_featurelist(arguments[1:-1])
+            elif command == "pong":
+                self._keepalive_pong(arguments)
+            elif command == "cap":
+                self._process_cap(arguments)
+            elif command == "authenticate":
+                if arguments == ["+"] and self._sasl_started is not None:
+                    self._sasl_respond()
+            elif command in ("saslsuccess", "saslalready"):
+                self._sasl_done(True)
+            elif command in ("saslfail", "sasltoolong", "saslaborted"):
+                self._sasl_done(False)
+            elif command == "batch":
+                self._process_batch(tags, prefix, arguments)
+                continue
+
+            if command in _tracked_commands and self.track_channels:
+                self._track_channels(command, prefix, arguments)
 
             if command in ["privmsg", "notice"]:
                 target, message = arguments[0], arguments[1]
-                messages = _ctcp_dequote(message)
 
                 if command == "privmsg":
                     if is_channel(target):
                         command = "pubmsg"
+                    wanted = (command, "ctcp", "action")
                 else:
                     if is_channel(target):
                         command = "pubnotice"
                     else:
                         command = "privnotice"
+                    wanted = (command, "ctcpreply")
+
+                for eventtype in wanted:
+                    if self._has_subscribers(eventtype):
+                        break
+                else:
+                    continue
+
+                messages = _ctcp_dequote(message)
 
                 for m in messages:
                     if type(m) is types.TupleType:
@@ -594,24 +1863,29 @@ class ServerConnection(Connection):
                         if DEBUG:
                             print "command: %s, source: %s, target: %s, " \
                                 "arguments: %s" % (command, prefix, target, m)
-                        self._handle_event(Event(command, prefix, target, m))
-                        if command == "ctcp" and m[0] == "ACTION":
+                        if self._has_subscribers(command):
+                            self._handle_event(
+                                Event(command, prefix, target, m, tags))
+                        if (command == "ctcp" and m[0] == "ACTION" and
+                            self._has_subscribers("action")):
                             self._handle_event(
-                                Event("action", prefix, target, m[1:]))
+                                Event("action", prefix, target, m[1:], tags))
                     else:
                         if DEBUG:
                             print "command: %s, source: %s, target: %s, " \
                                 "arguments: %s" % (
                                 command, prefix, target, [m])
-                        self._handle_event(Event(command, prefix, target, [m]))
+                        if self._has_subscribers(command):
+                            self._handle_event(
+                                Event(command, prefix, target, [m], tags))
             else:
                 target = None
 
                 if command == "quit":
-                    arguments = [arguments[0]]
+                    arguments = arguments[:1]
                 elif command == "ping":
-                    target = arguments[0]
-                else:
+                    target = arguments and arguments[0] or None
+                elif arguments:
                     target = arguments[0]
                     arguments = arguments[1:]
 
@@ -622,20 +1896,394 @@ class ServerConnection(Connection):
                 if DEBUG:
                     print "command: %s, source: %s, target: %s, " \
                         "arguments: %s" % (command, prefix, target, arguments)
-                self._handle_event(Event(command, prefix, target, arguments))
+                if self._has_subscribers(command):
+                    self._handle_event(
+                        Event(command, prefix, target, arguments, tags))
+
+    def _parse_featurelist(self, tokens):
+        """[Internal] Record the ISUPPORT tokens of a 005 reply in
+        self.features.
+        """
+        for token in tokens:
+            if token.startswith("-"):
+                self.features.pop(token[1:], None)
+            else:
+                name, _, value = token.partition("=")
+                self.features[name] = value or None
+        self._update_channel_features()
+
+    def _reset_capabilities(self):
+        """[Internal]"""
+        self.wanted_capabilities = frozenset()
+        # Capability -> value (or None), as offered by the server.
+        self.server_capabilities = {}
+        # The capabilities in effect.
+        self.capabilities = set()
+        self._cap_negotiating = False
+        self._cap_requests = 0
+        self.sasl_mechanism = None
+        self.sasl_authenticated = False
+        self._sasl_started = None
+        # Reference -> Batch, for the batches still open.
+        self._batches = {}
+
+    def _process_cap(self, arguments):
+        """[Internal] Negotiate capabilities from a CAP reply.
+
+        The arguments are [me, subcommand, capabilities], with "*"
+        before the capabilities when more lines follow.
+        """
+        if len(arguments) < 3:
+            return
+        subcommand = arguments[1].upper()
+        more = len(arguments) > 3 and arguments[2] == "*"
+        names = arguments[-1].split()
+        if subcommand in ("LS", "NEW"):
+            for name in names:
+                name, _, value = name.partition("=")
+                self.server_capabilities[name] = value or None
+            if not more:
+                self._request_capabilities()
+        elif subcommand == "ACK":
+            for name in names:
+                if name.startswith("-"):
+                    self.capabilities.discard(name[1:])
+                else:
+                    self.capabilities.add(name)
+            if "sasl" in names and self.sasl_mechanism and \
+               self._cap_negotiating:
+                self._sasl_started = time.time()
+                self.send_raw("AUTHENTICATE %s" % self.sasl_mechanism,
+                              PRIORITY_PROTOCOL)
+            if not more:
+                self._cap_answered()
+        elif subcommand == "NAK":
+            self._cap_answered()
+        elif subcommand == "DEL":
+            for name in names:
+                self.server_capabilities.pop(name, None)
+                self.capabilities.discard(name)
+
+    def _request_capabilities(self):
+        """[Internal] Request the wanted capabilities the server
+        offers, if any.
+        """
+        wanted = sorted(name for name in self.wanted_capabilities
+                        if name in self.server_capabilities and
+                        name not in self.capabilities)
+        mechanisms = self.server_capabilities.get("sasl")
+        if mechanisms and \
+           self.sasl_mechanism not in mechanisms.upper().split(","):
+            # Don't bother with a mechanism the server won't take.
+            wanted = [name for name in wanted if name != "sasl"]
+        if wanted:
+            self._cap_requests += 1
+            self.send_raw("CAP REQ :%s" % " ".join(wanted),
+                          PRIORITY_PROTOCOL)
+        else:
+            self._end_capabilities()
+
+    def _cap_answered(self):
+        """[Internal]"""
+        self._cap_requests = max(self._cap_requests - 1, 0)
+        self._end_capabilities()
+
+    def _end_capabilities(self):
+        """[Internal] Let registration complete once nothing is
+        being negotiated any more.
+        """
+        if self._cap_negotiating and not self._cap_requests and \
+           self._sasl_started is None:
+            self._cap_negotiating = False
+            self.send_raw("CAP END", PRIORITY_PROTOCOL)
+
+    def _sasl_respond(self):
+        """[Internal] Answer the server's AUTHENTICATE challenge."""
+        if self.sasl_mechanism == "PLAIN":
+            response = base64.b64encode("%s\0%s\0%s" % (
+                self.sasl_username, self.sasl_username,
+                self.sasl_password or ""))
+        else:
+            response = ""
+        # Responses are sent in chunks of 400 bytes, and a full last
+        # chunk is followed by an empty one.
+        for i in xrange(0, len(response), 400):
+            self.send_raw("AUTHENTICATE %s" % response[i:i + 400],
+                          PRIORITY_PROTOCOL)
+        if len(response) % 400 == 0:
+            self.send_raw("AUTHENTICATE +", PRIORITY_PROTOCOL)
+
+    def _sasl_done(self, authenticated):
+        """[Internal] Finish SASL and with it capability negotiation."""
+        if self._sasl_started is None:
+            return
+        self.sasl_authenticated = authenticated
+        self.connect_timings["sasl"] = time.time() - self._sasl_started
+        self._sasl_started = None
+        self._end_capabilities()
+
+    def _process_batch(self, tags, prefix, arguments):
+        """[Internal] Open or close a batch."""
+        if not arguments or len(arguments[0]) < 2:
+            return
+        reference = arguments[0][1:]
+        if arguments[0][0] == "+":
+            self._batches[reference] = Batch(
+                reference, arguments[1:2] and arguments[1] or "",
+                arguments[2:], prefix, tags)
+            return
+
+        batch = self._batches.pop(reference, None)
+        if batch is None:
+            return
+        event = Event("batch", batch.source, batch.type, batch.parameters,
+                      batch.tags, batch)
+        parent = self._batches.get(batch.tags and batch.tags.get("batch"))
+        if parent is not None:
+            parent.events.append(event)
+        else:
+            self._deliver_batch(event)
+
+    def _deliver_batch(self, event):
+        """[Internal] Hand out a batch that has ended."""
+        batch = event.batch()
+        if self._has_subscribers("batch"):
+            self._dispatch(event)
+        if batch.handled:
+            return
+        for member in batch.events:
+            if member.eventtype() == "batch":
+                self._deliver_batch(member)
+            else:
+                self._dispatch(member)
+
+    def _reset_channels(self):
+        """[Internal]"""
+        self._nick_table = casemappings[self.get_casemapping()]
+        self.channels = IRCDict(casemapping=self.get_casemapping())
+        # Lowercased nick -> nick, for everyone on our channels.
+        self._nick_names = {}
+        self._update_channel_features()
+
+    def _update_channel_features(self):
+        """[Internal] Pick up PREFIX, CHANMODES and CASEMAPPING."""
+        prefix = self.features.get("PREFIX") or "(ov)@+"
+        if prefix.startswith("(") and ")" in prefix:
+            modes, symbols = prefix[1:].split(")", 1)
+        else:
+            modes, symbols = "", ""
+        self._prefix_modes = modes
+        self._prefix_symbols = dict(zip(symbols, modes))
+
+        chanmodes = (self.features.get("CHANMODES") or
+                     "b,k,l,imnpst").split(",") + ["", "", ""]
+        self._list_modes = chanmodes[0]
+        self._argument_modes = chanmodes[0] + chanmodes[1] + modes
+        self._set_argument_modes = chanmodes[2]
+
+        casemapping = self.get_casemapping()
+        if casemapping != self.channels.casemapping:
+            table = self._nick_table = casemappings[casemapping]
+            self.channels.set_casemapping(casemapping)
+            self._nick_names = dict((name.translate(table), name)
+                                    for name in self._nick_names.values())
+            for channel in self.channels.values():
+                members = channel._members
+                channel._table = table
+                channel._names = self._nick_names
+                channel._members = {}
+                for lowered, modes in members.items():
+                    channel._add(intern(
+                        self._nick_names.get(lowered, lowered).translate(
+                            table)), modes)
+
+    def _lower_nick(self, nick):
+        """[Internal] Lowercase and intern a nick, remembering how it
+        is spelled.
+        """
+        lowered = intern(nick.translate(self._nick_table))
+        self._nick_names[lowered] = nick
+        return lowered
+
+    def _forget_nick(self, lowered):
+        """[Internal] Drop a nick that is on none of our channels."""
+        for channel in self.channels.itervalues():
+            if lowered in channel._members:
+                return
+        self._nick_names.pop(lowered, None)
+
+    def _track_channels(self, command, prefix, arguments):
+        """[Internal] Keep self.channels up to date.
+
+        Called before the event is handed to the handlers.
+        """
+        nick = prefix and "!" in prefix and nm_to_n(prefix) or prefix
+        if command == "namreply":
+            # [me, "=", channel, "@nick +nick nick ..."]
+            channel = len(arguments) > 3 and self.channels.get(arguments[2])
+            if not channel:
+                return
+            if channel.synced:
+                # A new NAMES reply replaces what we know.
+                channel._members.clear()
+                channel.synced = False
+            symbols = self._prefix_symbols
+            for name in arguments[3].split():
+                modes = ""
+                while name and name[0] in symbols:
+                    modes += symbols[name[0]]
+                    name = name[1:]
+                if name:
+                    # userhost-in-names gives nick!user@host.
+                    name = name.split("!", 1)[0]
+                    channel._add(self._lower_nick(name), modes)
+        elif command == "endofnames":
+            channel = len(arguments) > 1 and self.channels.get(arguments[1])
+            if channel:
+                channel.synced = True
+        elif command == "join":
+            if not arguments or not nick:
+                return
+            name = arguments[0]
+            if nick == self.real_nickname:
+                self.channels[name] = Channel(name, self._nick_names,
+                                              self._nick_table)
+            channel = self.channels.get(name)
+            if channel is not None:
+                channel._add(self._lower_nick(nick))
+        elif command == "part":
+            if arguments and nick:
+                self._track_leave(arguments[0], nick)
+        elif command == "kick":
+            if len(arguments) > 1:
+                self._track_leave(arguments[0], arguments[1])
+        elif command == "quit":
+            if nick:
+                lowered = nick.translate(self._nick_table)
+                for channel in self.channels.itervalues():
+                    channel._remove(lowered)
+                self._nick_names.pop(lowered, None)
+        elif command == "nick":
+            if not arguments or not nick:
+                return
+            old = nick.translate(self._nick_table)
+            new = self._lower_nick(arguments[0])
+            if old != new:
+                self._nick_names.pop(old, None)
+            for channel in self.channels.itervalues():
+                modes = channel._members.pop(old, None)
+                if modes is not None:
+                    channel._add(new, modes)
+        elif command == "mode":
+            if len(arguments) > 1:
+                self._track_modes(arguments[0], arguments[1:])
+        elif command == "channelmodeis":
+            # [me, channel, modes, arguments...]
+            if len(arguments) > 2:
+                channel = self.channels.get(arguments[1])
+                if channel is not None:
+                    channel.modes.clear()
+                    self._track_modes(arguments[1], arguments[2:])
+
+    def _track_leave(self, name, nick):
+        """[Internal]"""
+        channel = self.channels.get(name)
+        if channel is None:
+            return
+        if nick == self.real_nickname:
+            del self.channels[name]
+            for lowered in channel._members:
+                self._forget_nick(lowered)
+            return
+        lowered = nick.translate(self._nick_table)
+        channel._remove(lowered)
+        self._forget_nick(lowered)
+
+    def _track_modes(self, name, mode_arguments):
+        """[Internal]"""
+        channel = self.channels.get(name)
+        if channel is None:
+            return
+        for sign, mode, argument in _parse_modes(" ".join(mode_arguments),
+                                                 self._argument_modes,
+                                                 self._set_argument_modes):
+            if mode in self._prefix_modes:
+                if argument:
+                    channel._set_user_mode(
+                        argument.translate(self._nick_table), sign, mode)
+            elif mode in self._list_modes:
+                continue
+            elif sign == "+":
+                channel.modes[mode] = argument
+            else:
+                channel.modes.pop(mode, None)
+
+    def get_casemapping(self):
+        """Get the casemapping the server announced, see casemappings.
+
+        Defaults to rfc1459, also for mappings irclib doesn't know.
+        """
+        casemapping = self.features.get("CASEMAPPING")
+        if casemapping in casemappings:
+            return casemapping
+        return "rfc1459"
+
+    def get_target_limit(self, command):
+        """Get how many targets the server accepts for a command.
+
+        Returns None if there is no limit.  Based on the TARGMAX or
+        MAXTARGETS features; if the server advertised neither, one
+        target at a time is assumed.
+        """
+        targmax = self.features.get("TARGMAX")
+        if targmax:
+            for item in targmax.split(","):
+                name, _, limit = item.partition(":")
+                if name.upper() == command:
+                    return limit and int(limit) or None
+            return 1
+        return int(self.features.get("MAXTARGETS") or 1)
+
+    def get_channel_limit(self, channel):
+        """Get how many channels like channel (by prefix) the server
+        lets us be on at once, from the CHANLIMIT or MAXCHANNELS
+        features.
+
+        Returns None if there is no known limit.
+        """
+        chanlimit = self.features.get("CHANLIMIT")
+        if chanlimit:
+            for item in chanlimit.split(","):
+                prefixes, _, limit = item.partition(":")
+                if channel[:1] in prefixes:
+                    return limit and int(limit) or None
+            return None
+        maxchannels = self.features.get("MAXCHANNELS")
+        return maxchannels and int(maxchannels) or None
+
+    def _has_subscribers(self, eventtype):
+        """[Internal]"""
+        return (self.irclibobj.has_subscribers(eventtype) or
+                eventtype in self.handlers)
 
     def _handle_event(self, event):
+        """[Internal] Dispatch an event, or hold it back until the
+        end of its batch.
+        """
+        if self._batches and event._tags:
+            batch = self._batches.get(event._tags.get("batch"))
+            if batch is not None:
+                batch.events.append(event)
+                return
+        self._dispatch(event)
+
+    def _dispatch(self, event):
         """[Internal]"""
         self.irclibobj._handle_event(self, event)
         if event.eventtype() in self.handlers:
             for fn in self.handlers[event.eventtype()]:
                 fn(self, event)
 
-    def _check_last_event(self, timeout=300):
-        """Disconnect if last event was too long ago"""
-        if self.is_connected() and self.last_event + timeout < time.time():
-            self.disconnect("Ping timeout")
-
     def is_connected(self):
         """Return connection status.
 
@@ -685,15 +2333,24 @@ class ServerConnection(Connection):
         if not self.connected:
             return
 
+        if self._connect_state is not None:
+            self._connect_failed(message)
+            return
+
         self.connected = 0
+        self._stop_timers()
 
         self.quit(message)
+        self.flush()
 
+        self.irclibobj._remove_socket(self, self.socket)
         try:
             self.socket.close()
         except socket.error, x:
             pass
         self.socket = None
+        self._reset_send_queue()
+        self._reset_flood_queue()
         self._handle_event(Event("disconnect", self.server, "", [message]))
 
     def globops(self, text):
@@ -721,6 +2378,67 @@ class ServerConnection(Connection):
         """Send a JOIN command."""
         self.send_raw("JOIN %s%s" % (channel, (key and (" " + key))))
 
+    def join_many(self, channels, priority=PRIORITY_NORMAL):
+        """Join several channels with as few JOIN commands as possible.
+
+        Arguments:
+
+            channels -- A dictionary of channel -> key ("" if none), or
+                        a list of channels.
+
+        Each line lists as many channels, keyed ones first, as fit in
+        512 bytes and the server's TARGMAX for JOIN allows.  Channels
+        beyond the server's CHANLIMIT, counting those we're already
+        on, are left out.
+
+        Returns the channels left out.
+        """
+        if not hasattr(channels, "items"):
+            channels = dict((channel, "") for channel in channels)
+        # Keys go with the first channels of a line.
+        ordered = sorted(channels.items(), key=lambda item: not item[1])
+
+        left_out = []
+        room = {}
+        wanted = []
+        for channel, key in ordered:
+            limit = self.get_channel_limit(channel)
+            if limit is not None:
+                prefix = channel[:1]
+                if prefix not in room:
+                    room[prefix] = limit - len([name for name in self.channels
+                                                if name[:1] == prefix])
+                if room[prefix] <= 0:
+                    left_out.append(channel)
+                    continue
+                room[prefix] -= 1
+            wanted.append((channel, key))
+
+        limit = None
+        if "JOIN:" in (self.features.get("TARGMAX") or "").upper():
+            limit = self.get_target_limit("JOIN")
+        names, keys = [], []
+        length = len("JOIN")
+        for channel, key in wanted:
+            extra = len(channel) + 1 + (key and len(key) + 1 or 0)
+            if names and (length + extra > 510 or len(names) == limit):
+                self._send_join(names, keys, priority)
+                names, keys = [], []
+                length = len("JOIN")
+            names.append(channel)
+            if key:
+                keys.append(key)
+            length += extra
+        if names:
+            self._send_join(names, keys, priority)
+        return left_out
+
+    def _send_join(self, names, keys, priority):
+        """[Internal]"""
+        self.send_raw("JOIN %s%s" % (",".join(names),
+                                     keys and " " + ",".join(keys) or ""),
+                      priority)
+
     def kick(self, channel, nick, comment=""):
         """Send a KICK command."""
         self.send_raw("KICK %s %s%s" % (
@@ -765,10 +2483,12 @@ class ServerConnection(Connection):
         """Send a NICK command."""
         self.send_raw("NICK " + newnick)
 
-    def notice(self, target, text):
-        """Send a NOTICE command."""
-        # Should limit len(text) here!
-        self.send_raw("NOTICE %s :%s" % (target, text))
+    def notice(self, target, text, priority=PRIORITY_NORMAL):
+        """Send a NOTICE command.
+
+        Text too long for one line is split, see privmsg().
+        """
+        self._send_message("NOTICE", target, text, priority)
 
     def oper(self, nick, password):
         """Send an OPER command."""
@@ -784,49 +2504,290 @@ class ServerConnection(Connection):
 
     def pass_(self, password):
         """Send a PASS command."""
-        self.send_raw("PASS " + password)
+        self.send_raw("PASS " + password, PRIORITY_PROTOCOL)
 
     def ping(self, target, target2=""):
         """Send a PING command."""
-        self.send_raw("PING %s%s" % (target, target2 and (" " + target2)))
+        self.send_raw("PING %s%s" % (target, target2 and (" " + target2)),
+                      PRIORITY_PROTOCOL)
 
     def pong(self, target, target2=""):
         """Send a PONG command."""
-        self.send_raw("PONG %s%s" % (target, target2 and (" " + target2)))
+        self.send_raw("PONG %s%s" % (target, target2 and (" " + target2)),
+                      PRIORITY_PROTOCOL)
+
+    def privmsg(self, target, text, priority=PRIORITY_NORMAL):
+        """Send a PRIVMSG command.
+
+        Text that wouldn't fit in one 512 byte line, once the server
+        has added our nickmask, is sent as several messages.  It is
+        split between words where possible and never inside a UTF-8
+        character.  CTCP messages are never split.
+        """
+        self._send_message("PRIVMSG", target, text, priority)
 
-    def privmsg(self, target, text):
-        """Send a PRIVMSG command."""
-        # Should limit len(text) here!
-        self.send_raw("PRIVMSG %s :%s" % (target, text))
+    def privmsg_many(self, targets, text, priority=PRIORITY_NORMAL):
+        """Send a PRIVMSG command to multiple targets.
 
-    def privmsg_many(self, targets, text):
-        """Send a PRIVMSG command to multiple targets."""
-        # Should limit len(text) here!
-        self.send_raw("PRIVMSG %s :%s" % (",".join(targets), text))
+        The targets are sent in groups as large as the server accepts
+        (see get_target_limit()), as long as each line keeps room for
+        min_text_length bytes of text.
+        """
+        limit = self.get_target_limit("PRIVMSG") or len(targets)
+        # ":<nickmask> PRIVMSG <targets> :<text>" must fit in 510 bytes.
+        room = (510 - len(":%s PRIVMSG  :" % self.get_nickmask()) -
+                self.min_text_length)
+        group = []
+        for target in targets:
+            if group and (len(group) >= limit or
+                          len(",".join(group + [target])) > room):
+                self._send_message("PRIVMSG", ",".join(group), text,
+                                   priority)
+                group = []
+            group.append(target)
+        if group:
+            self._send_message("PRIVMSG", ",".join(group), text, priority)
+
+    def _send_message(self, command, target, text, priority):
+        """[Internal]"""
+        if text.startswith("\001"):
+            pieces = [text]
+        else:
+            # The server relays ":<nickmask> <command> <target> :<text>".
+            budget = 510 - len(":%s %s %s :" % (self.get_nickmask(),
+                                                command, target))
+            pieces = split_message(text, max(budget, self.min_text_length))
+        for piece in pieces:
+            self.send_raw("%s %s :%s" % (command, target, piece), priority,
+                          target)
 
     def quit(self, message=""):
         """Send a QUIT command."""
         # Note that many IRC servers don't use your QUIT message
         # unless you've been connected for at least 5 minutes!
-        self.send_raw("QUIT" + (message and (" :" + message)))
+        self.send_raw("QUIT" + (message and (" :" + message)),
+                      PRIORITY_PROTOCOL)
 
-    def send_raw(self, string):
+    def send_raw(self, string, priority=PRIORITY_NORMAL, target=None):
         """Send raw string to the server.
 
         The string will be padded with appropriate CR LF.
+
+        Arguments:
+
+            string -- The line to send.
+
+            priority -- PRIORITY_PROTOCOL, PRIORITY_NORMAL or
+                        PRIORITY_BULK.  Only used by flood control.
+
+            target -- The nick or channel the line is addressed to, if
+                      any.  Flood control takes turns between targets
+                      of the same priority.
+
+        With flood control enabled, lines other than protocol traffic
+        wait for a token; see set_flood_control().
+
+        The line is then appended to the connection's output queue,
+        which is written without blocking: whatever the socket doesn't
+        accept right away is sent when the poller reports it writable.
+        Lines queued while incoming data is being handled are written
+        together once the handlers have run.  Unicode lines are sent
+        encoded as UTF-8.
         """
-        if self.socket is None:
+        if self.socket is None and self._connect_state is None:
             raise ServerNotConnectedError("Not connected.")
-        try:
-            if self.ssl:
-                self.ssl.write(string + "\r\n")
-            else:
-                self.socket.send(string + "\r\n")
-            if DEBUG:
-                print "TO SERVER:", string
-        except socket.error, x:
-            # Ouch!
-            self.disconnect("Connection reset by peer")
+        if isinstance(string, unicode):
+            # The output queue only holds bytes.
+            string = string.encode("utf-8")
+        if self.flood_rate is None:
+            self._queue_line(string)
+            return
+        self._refill_tokens()
+        if priority == PRIORITY_PROTOCOL:
+            # Never delayed, but still counts against the bucket.
+            self._flood_tokens -= 1
+            self._queue_line(string)
+            return
+        if self._flood_tokens >= 1 and not self._flood_pending:
+            self._flood_tokens -= 1
+            self._queue_line(string)
+            return
+        targets = self._flood_queues[priority]
+        if target not in targets:
+            targets[target] = collections.deque()
+        targets[target].append(string)
+        self._flood_pending += 1
+        self._schedule_flood_drain()
+
+    def set_flood_control(self, rate, burst=5):
+        """Limit the rate of outgoing lines with a token bucket.
+
+        Arguments:
+
+            rate -- Lines per second, or None (or anything not above
+                    zero) to disable flood control.
+
+            burst -- Number of lines that may be sent back to back
+                     after a quiet period.
+
+        Held back lines are released in priority order; within a
+        priority the targets take turns, so a long reply to one
+        channel doesn't starve another.
+        """
+        if rate is not None and rate <= 0:
+            rate = None
+        self.flood_rate = rate
+        self.flood_burst = burst
+        self._flood_tokens = float(burst)
+        self._flood_updated = time.time()
+        if rate is None:
+            queues = self._flood_queues
+            self._reset_flood_queue()
+            if self.connected:
+                for targets in queues:
+                    for lines in targets.values():
+                        for line in lines:
+                            self._queue_line(line)
+        else:
+            self._drain_flood_queue()
+
+    def get_flood_queue_depth(self):
+        """Get the number of lines held back by flood control."""
+        return self._flood_pending
+
+    def _refill_tokens(self):
+        """[Internal]"""
+        now = time.time()
+        self._flood_tokens = min(float(self.flood_burst), self._flood_tokens +
+                                 (now - self._flood_updated) * self.flood_rate)
+        self._flood_updated = now
+
+    def _drain_flood_queue(self):
+        """[Internal] Release as many held back lines as the bucket
+        allows.
+        """
+        self._flood_timer = None
+        if not self.connected or not self._flood_pending:
+            return
+        self._refill_tokens()
+        for targets in self._flood_queues:
+            while targets and self._flood_tokens >= 1:
+                # Round robin: serve the first target, then move it to
+                # the back of the line.
+                target, lines = targets.popitem(last=False)
+                self._queue_line(lines.popleft())
+                self._flood_tokens -= 1
+                self._flood_pending -= 1
+                if lines:
+                    targets[target] = lines
+        self._schedule_flood_drain()
+
+    def _schedule_flood_drain(self):
+        """[Internal]"""
+        if not self._flood_pending or self._flood_timer is not None:
+            return
+        at = self._flood_updated + ((1 - self._flood_tokens) /
+                                    self.flood_rate)
+        self._flood_timer = self.irclibobj.execute_at(
+            at, self._drain_flood_queue)
+
+    def _reset_flood_queue(self):
+        """[Internal]"""
+        timer = getattr(self, "_flood_timer", None)
+        if timer is not None:
+            timer.cancel()
+        self._flood_queues = tuple(collections.OrderedDict()
+                                   for i in range(PRIORITY_BULK + 1))
+        self._flood_pending = 0
+        self._flood_timer = None
+        self._flood_tokens = float(self.flood_burst)
+        self._flood_updated = time.time()
+
+    def _queue_line(self, string):
+        """[Internal]"""
+        line = string + "\r\n"
+        self._send_queue.append(line)
+        self._send_pending += len(line)
+        if DEBUG:
+            print "TO SERVER:", string
+        if not self._corked:
+            self.flush()
+
+    def flush(self):
+        """Write as much of the output queue as the socket accepts.
+
+        Queued lines are coalesced into writes of up to
+        send_chunk_size bytes.
+        """
+        if self._connect_state is not None:
+            if self._connect_state == "handshaking":
+                self._continue_handshake()
+            return
+        queue = self._send_queue
+        while queue and self.socket is not None:
+            chunk = [queue[0][self._send_offset:]]
+            size = len(chunk[0])
+            for line in itertools.islice(queue, 1, None):
+                if size + len(line) > self.send_chunk_size:
+                    break
+                chunk.append(line)
+                size += len(line)
+            data = "".join(chunk)
+            if self._ssl_retry:
+                # OpenSSL wants a retried write to be the same length.
+                data = data[:self._ssl_retry]
+
+            try:
+                if self.ssl:
+                    sent = self.ssl.write(data)
+                else:
+                    sent = self.socket.send(data)
+            except socket.error, x:
+                if _would_block(x):
+                    if self.ssl:
+                        self._ssl_retry = len(data)
+                    break
+                # Ouch!
+                self.disconnect("Connection reset by peer")
+                return
+
+            self._ssl_retry = 0
+            self._send_pending -= sent
+            sent += self._send_offset
+            while queue and sent >= len(queue[0]):
+                sent -= len(queue.popleft())
+            self._send_offset = sent
+            if self._send_offset:
+                # Partial write; wait for the socket to drain.
+                break
+        self._update_write_interest()
+
+    def _update_write_interest(self):
+        """[Internal] Ask the poller for writability only while output
+        is pending.
+        """
+        want_write = bool(self._send_queue) and self.socket is not None
+        if want_write != self._want_write:
+            self._want_write = want_write
+            if self.socket is not None:
+                self.irclibobj.poller.modify(self.socket, True, want_write)
+
+    def _reset_send_queue(self):
+        """[Internal]"""
+        self._send_queue = collections.deque()
+        self._send_pending = 0
+        self._send_offset = 0
+        self._ssl_retry = 0
+        self._want_write = False
+        self._corked = False
+
+    def get_send_queue_depth(self):
+        """Get the number of lines waiting to be written."""
+        return len(self._send_queue)
+
+    def get_send_pending_bytes(self):
+        """Get the number of bytes waiting to be written."""
+        return self._send_pending
 
     def squit(self, server, comment=""):
         """Send an SQUIT command."""
@@ -918,7 +2879,7 @@ class DCCConnection(Connection):
         self.peeraddress = socket.gethostbyname(address)
         self.peerport = port
         self.socket = None
-        self.previous_buffer = ""
+        self.buffer = LineBuffer()
         self.handlers = {}
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.passive = 0
@@ -927,13 +2888,17 @@ class DCCConnection(Connection):
         except socket.error, x:
             raise DCCConnectionError("Couldn't connect to socket: %s" % x)
         self.connected = 1
-        if self.irclibobj.fn_to_add_socket:
-            self.irclibobj.fn_to_add_socket(self.socket)
+        self.irclibobj._add_socket(self, self.socket)
         return self
 
-    def listen(self):
+    def listen(self, address=None):
         """Wait for a connection/reconnection from a DCC peer.
 
+        Arguments:
+
+            address -- Local address to listen on.  Defaults to the
+                       address the local host name resolves to.
+
         Returns the DCCConnection object.
 
         The local IP address and port are available as
@@ -941,16 +2906,23 @@ class DCCConnection(Connection):
         peer, the peer address and port are available as
         self.peeraddress and self.peerport.
         """
-        self.previous_buffer = ""
+        if address is None:
+            address = socket.gethostbyname(socket.gethostname())
+        if ":" in address:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+        self.buffer = LineBuffer()
         self.handlers = {}
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
         self.passive = 1
         try:
-            self.socket.bind((socket.gethostbyname(socket.gethostname()), 0))
+            self.socket.bind((address, 0))
             self.localaddress, self.localport = self.socket.getsockname()
             self.socket.listen(10)
         except socket.error, x:
             raise DCCConnectionError("Couldn't bind socket: %s" % x)
+        self.irclibobj._add_socket(self, self.socket)
         return self
 
     def disconnect(self, message=""):
@@ -964,6 +2936,7 @@ class DCCConnection(Connection):
             return
 
         self.connected = 0
+        self.irclibobj._remove_socket(self, self.socket)
         try:
             self.socket.close()
         except socket.error, x:
@@ -979,9 +2952,11 @@ class DCCConnection(Connection):
 
         if self.passive and not self.connected:
             conn, (self.peeraddress, self.peerport) = self.socket.accept()
+            self.irclibobj._remove_socket(self, self.socket)
             self.socket.close()
             self.socket = conn
             self.connected = 1
+            self.irclibobj._add_socket(self, self.socket)
             if DEBUG:
                 print "DCC connection from %s:%d" % (
                     self.peeraddress, self.peerport)
@@ -1004,19 +2979,20 @@ class DCCConnection(Connection):
         if self.dcctype == "chat":
             # The specification says lines are terminated with LF, but
             # it seems safer to handle CR LF terminations too.
-            chunks = _linesep_regexp.split(self.previous_buffer + new_data)
+            self.buffer.feed(new_data)
+            chunks = list(self.buffer.lines())
 
-            # Save the last, unfinished line.
-            self.previous_buffer = chunks[-1]
-            if len(self.previous_buffer) > 2 ** 14:
+            # Check the last, unfinished line.
+            if len(self.buffer) > 2 ** 14:
                 # Bad peer! Naughty peer!
                 self.disconnect()
                 return
-            chunks = chunks[:-1]
         else:
             chunks = [new_data]
 
         command = "dccmsg"
+        if not self.irclibobj.has_subscribers(command):
+            return
         prefix = self.peeraddress
         target = None
         for chunk in chunks:
@@ -1051,6 +3027,281 @@ class DCCConnection(Connection):
             self.disconnect("Connection reset by peer")
 
 
+class DCCSendConnection(DCCConnection):
+    """This class represents an outgoing DCC SEND file transfer.
+
+    DCCSendConnection objects are instantiated by calling the dcc_send
+    method on an IRC object, and serve one file to one peer: offer()
+    listens for the peer and sends it the DCC SEND request.  A DCC
+    RESUME from the peer is answered with DCC ACCEPT, and the transfer
+    then starts at the requested position.
+
+    The file is written from the event loop whenever the socket can
+    take more, with os.sendfile where the platform provides it and
+    chunked non-blocking sends otherwise, so transfers never block the
+    IRC connections.  If a rate is set, the transfer is paused with a
+    timer whenever it gets ahead of it.
+
+    The transfer ends with a dcc_disconnect event, whose argument is
+    "Transfer complete" if the whole file was sent.
+    """
+
+    # Most bytes written per send call.
+    chunk_size = 2 ** 16
+
+    # Seconds to wait for the peer to connect.
+    offer_timeout = 300
+
+    # Seconds to wait for the final acknowledgement or hang-up.
+    ack_timeout = 30
+
+    def __init__(self, irclibobj, filename, rate=None):
+        DCCConnection.__init__(self, irclibobj, "send")
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.rate = rate
+        self.position = 0
+        self.acked = 0
+        self.bytes_sent = 0
+        self.started = None
+        self.socket = None
+        self.server = None
+        self.nick = None
+        self.name = None
+        self._acks = ""
+        self._allowance = 0.0
+        self._refilled = None
+        self._timer = None
+        self._want_write = False
+
+    def offer(self, connection, nick, address=None, name=None):
+        """Offer the file to a nick.
+
+        Arguments:
+
+            connection -- The ServerConnection to send the offer over.
+
+            nick -- The nick to send the file to.
+
+            address -- The address the peer should connect to.
+                       Defaults to the local address of the server
+                       connection.
+
+            name -- The file name to announce.  Defaults to the base
+                    name of the file.
+
+        Returns the DCCSendConnection object.
+        """
+        try:
+            if address is None:
+                if connection.socket is None:
+                    raise DCCConnectionError("Not connected to a server")
+                address = connection.socket.getsockname()[0]
+            self.listen(address)
+        except DCCConnectionError:
+            self._abandon()
+            raise
+        self.server = connection
+        self.nick = nick
+        self.name = name or os.path.basename(self.filename)
+        self.irclibobj.add_global_handler("ctcp", self._on_ctcp, -10)
+        self._timer = self.execute_delayed(self.offer_timeout,
+                                           self._offer_expired)
+        if ":" in self.localaddress:
+            host = self.localaddress
+        else:
+            host = ip_quad_to_numstr(self.localaddress)
+        connection.ctcp("DCC", nick, "SEND %s %s %d %d" % (
+            _dcc_quote(self.name), host, self.localport, self.size))
+        return self
+
+    def disconnect(self, message=""):
+        """Abort or finish the transfer and close the object.
+
+        Arguments:
+
+            message -- Reason given in the dcc_disconnect event.
+        """
+        if self.socket is None:
+            return
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.server is not None and not self.connected:
+            self.irclibobj.remove_global_handler("ctcp", self._on_ctcp)
+        self.connected = 0
+        self.irclibobj._remove_socket(self, self.socket)
+        try:
+            self.socket.close()
+        except socket.error, x:
+            pass
+        self.socket = None
+        self.file.close()
+        self.irclibobj._handle_event(
+            self,
+            Event("dcc_disconnect", self.peeraddress, "", [message]))
+        self.irclibobj._remove_connection(self)
+
+    def is_complete(self):
+        """Return true if the whole file has been sent."""
+        return self.position >= self.size
+
+    def process_data(self):
+        """[Internal]"""
+
+        if self.passive and not self.connected:
+            DCCConnection.process_data(self)
+            if self._timer is not None:
+                self.irclibobj.remove_global_handler("ctcp", self._on_ctcp)
+                self._timer.cancel()
+                self._timer = None
+            self.socket.setblocking(0)
+            self.started = self._refilled = time.time()
+            self._allowance = float(min(self.chunk_size, self.rate or 0))
+            self.flush()
+            return
+
+        try:
+            new_data = self.socket.recv(2 ** 14)
+        except socket.error, x:
+            if _would_block(x):
+                return
+            self.disconnect("Connection reset by peer")
+            return
+        if not new_data:
+            if self.is_complete():
+                self.disconnect("Transfer complete")
+            else:
+                self.disconnect("Connection reset by peer")
+            return
+
+        # The peer acknowledges with the total received so far, as
+        # 32-bit big-endian integers.  Only the latest one matters.
+        acks = self._acks + new_data
+        end = len(acks) - len(acks) % 4
+        if end:
+            self.acked = struct.unpack("!I", acks[end - 4:end])[0]
+        self._acks = acks[end:]
+        if self.is_complete() and self.acked == self.size & 0xffffffff:
+            self.disconnect("Transfer complete")
+
+    def flush(self):
+        """Send as much of the file as the socket and rate allow."""
+        if not self.connected or self.socket is None:
+            return
+
+        while self.position < self.size:
+            count = min(self.chunk_size, self.size - self.position)
+            if self.rate:
+                count = min(count, self._refill_allowance())
+                if count <= 0:
+                    self._throttle()
+                    return
+            try:
+                sent = self._send_chunk(count)
+            except (socket.error, OSError), x:
+                if _would_block(x):
+                    break
+                self.disconnect("Connection reset by peer")
+                return
+            if not sent:
+                break
+            self.position += sent
+            self.bytes_sent += sent
+            if self.rate:
+                self._allowance -= sent
+
+        if self.is_complete() and self._timer is None:
+            self._timer = self.execute_delayed(
+                self.ack_timeout, self.disconnect, ("Transfer complete",))
+        self._set_write_interest(not self.is_complete())
+
+    def _send_chunk(self, count):
+        """[Internal]"""
+        if _sendfile is not None:
+            return _sendfile(self.socket.fileno(), self.file.fileno(),
+                             self.position, count)
+        self.file.seek(self.position)
+        return self.socket.send(self.file.read(count))
+
+    def _refill_allowance(self):
+        """[Internal] Top up the byte allowance for the time passed,
+        up to one second's worth.
+        """
+        now = time.time()
+        self._allowance = min(
+            self._allowance + (now - self._refilled) * self.rate, self.rate)
+        self._refilled = now
+        return int(self._allowance)
+
+    def _throttle(self):
+        """[Internal] Stop writing until the allowance covers a chunk."""
+        self._set_write_interest(False)
+        wanted = min(self.chunk_size, self.rate, self.size - self.position)
+        self._timer = self.execute_delayed(
+            max(wanted - self._allowance, 1) / float(self.rate),
+            self._unthrottle)
+
+    def _unthrottle(self):
+        """[Internal]"""
+        self._timer = None
+        self.flush()
+
+    def _set_write_interest(self, want_write):
+        """[Internal]"""
+        if want_write != self._want_write and self.socket is not None:
+            self._want_write = want_write
+            self.irclibobj.poller.modify(self.socket, True, want_write)
+
+    def _abandon(self):
+        """[Internal] Drop a transfer that was never offered."""
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self.file.close()
+        self.irclibobj._remove_connection(self)
+
+    def _offer_expired(self):
+        """[Internal]"""
+        self._timer = None
+        self.disconnect("DCC SEND offer timed out")
+
+    def _on_ctcp(self, connection, event):
+        """[Internal] Accept a DCC RESUME for this offer."""
+        if connection is not self.server or self.connected:
+            return
+        arguments = event.arguments()
+        if arguments[0] != "DCC" or len(arguments) < 2:
+            return
+        nick = event.source_nick()
+        lower = connection.get_casemapping()
+        if irc_lower(nick, lower) != irc_lower(self.nick, lower):
+            return
+        command, _, rest = arguments[1].partition(" ")
+        if command.upper() != "RESUME":
+            return
+        try:
+            name, port, position = rest.rsplit(" ", 2)
+            port, position = int(port), int(position)
+        except ValueError:
+            return
+        if port != self.localport or not 0 <= position <= self.size:
+            return
+        self.position = position
+        connection.ctcp("DCC", nick, "ACCEPT %s %d %d" % (
+            name, port, position))
+        return "NO MORE"
+
+
+def _dcc_quote(name):
+    """[Internal] Quote a file name for a DCC request if needed."""
+    if " " in name:
+        return '"%s"' % name
+    return name
+
+
 class SimpleIRCClient:
     """A simple single-server IRC client class.
 
@@ -1064,6 +3315,15 @@ class SimpleIRCClient:
     handler methods get two arguments: the connection object (same as
     self.connection) and the event object.
 
+    The on_* methods are looked up when the object is constructed and
+    only those event types are subscribed to, so events the client
+    has no method for are never built.  Raw lines are delivered to
+    on_all_raw_messages, if defined.
+
+    Several clients can share one IRC object, and so one event loop,
+    by passing it to the constructor.  Each client is only handed the
+    events of its own server and DCC connections.
+
     Instance attributes that can be used by sub classes:
 
         ircobj -- The IRC instance.
@@ -1073,26 +3333,50 @@ class SimpleIRCClient:
         dcc_connections -- A list of DCCConnection instances.
     """
 
-    def __init__(self):
-        self.ircobj = IRC()
+    def __init__(self, ircobj=None):
+        if ircobj is None:
+            ircobj = IRC()
+        self.ircobj = ircobj
         self.connection = self.ircobj.server()
         self.dcc_connections = []
-        self.ircobj.add_global_handler("all_events", self._dispatcher, -10)
+        # Event type -> bound on_* method.
+        self._on_handlers = {}
+        for name in dir(self):
+            method = getattr(self, name)
+            if name.startswith("on_") and callable(method):
+                self._on_handlers[name[3:]] = method
+                self.ircobj.add_global_handler(name[3:], self._dispatcher,
+                                               -10)
         self.ircobj.add_global_handler(
             "dcc_disconnect", self._dcc_disconnect, -10)
 
     def _dispatcher(self, c, e):
         """[Internal]"""
-        m = "on_" + e.eventtype()
-        if hasattr(self, m):
-            getattr(self, m)(c, e)
+        if c is not self.connection and c not in self.dcc_connections:
+            return
+        method = self._on_handlers.get(e.eventtype())
+        if method is not None:
+            method(c, e)
 
     def _dcc_disconnect(self, c, e):
-        self.dcc_connections.remove(c)
+        if c in self.dcc_connections:
+            self.dcc_connections.remove(c)
+
+    def close(self):
+        """Close the server connection for good and stop handling
+        events, leaving a shared IRC object as it was before this
+        client was created.
+        """
+        for event in self._on_handlers:
+            self.ircobj.remove_global_handler(event, self._dispatcher)
+        self.ircobj.remove_global_handler("dcc_disconnect",
+                                          self._dcc_disconnect)
+        self.connection.close()
 
     def connect(self, server, port, nickname, password=None, username=None,
             ircname=None, localaddress="", localport=0, ssl=False,
-            ipv6=False):
+            ipv6=False, ssl_context=None, capabilities=None,
+            sasl_mechanism=None, sasl_username=None, sasl_password=None):
         """Connect/reconnect to a server.
 
         Arguments:
@@ -1117,11 +3401,24 @@ class SimpleIRCClient:
 
             ipv6 -- Enable support for ipv6.
 
+            ssl_context -- The SSLContext to use.
+
+            capabilities -- IRCv3 capabilities to request.
+
+            sasl_mechanism -- "PLAIN" or "EXTERNAL" to authenticate
+                              with SASL.
+
+            sasl_username -- The SASL PLAIN account name.
+
+            sasl_password -- The SASL PLAIN password.
+
         This function can be called to reconnect a closed connection.
         """
         self.connection.connect(server, port, nickname,
                                 password, username, ircname,
-                                localaddress, localport, ssl, ipv6)
+                                localaddress, localport, ssl, ipv6,
+                                ssl_context, capabilities, sasl_mechanism,
+                                sasl_username, sasl_password)
 
     def dcc_connect(self, address, port, dcctype="chat"):
         """Connect to a DCC peer.
@@ -1149,15 +3446,39 @@ class SimpleIRCClient:
         dcc.listen()
         return dcc
 
+    def dcc_send(self, nick, filename, rate=None, address=None):
+        """Offer a file to a nick over DCC SEND.
+
+        Returns a DCCSendConnection instance.
+        """
+        dcc = self.ircobj.dcc_send(filename, rate)
+        self.dcc_connections.append(dcc)
+        try:
+            dcc.offer(self.connection, nick, address)
+        except DCCConnectionError:
+            self.dcc_connections.remove(dcc)
+            raise
+        return dcc
+
     def start(self):
         """Start the IRC client."""
         self.ircobj.process_forever()
 
 
-class Event:
-    """Class representing an IRC event."""
+class Event(object):
+    """Class representing an IRC event.
+
+    One Event is created for every message the client handles, so
+    instances use __slots__ instead of a __dict__, nick and channel
+    names are interned, and derived values such as the source nick
+    are computed on first use.
+    """
+
+    __slots__ = ("_eventtype", "_source", "_target", "_arguments", "_tags",
+                 "_source_nick", "_batch")
 
-    def __init__(self, eventtype, source, target, arguments=None):
+    def __init__(self, eventtype, source, target, arguments=None, tags=None,
+                 batch=None):
         """Constructor of Event objects.
 
         Arguments:
@@ -1169,14 +3490,27 @@ class Event:
             target -- The target of the event (a nick or a channel).
 
             arguments -- Any event specific arguments.
+
+            tags -- IRCv3 message tags (a dictionary), if any.
+
+            batch -- The Batch delivered by a "batch" event.
         """
         self._eventtype = eventtype
         self._source = source
+        if type(target) is str:
+            target = intern(target)
         self._target = target
         if arguments:
             self._arguments = arguments
         else:
             self._arguments = []
+        self._tags = tags
+        self._source_nick = None
+        self._batch = batch
+
+    def __repr__(self):
+        return "<Event %s %s -> %s %r>" % (self._eventtype, self._source,
+                                           self._target, self._arguments)
 
     def eventtype(self):
         """Get the event type."""
@@ -1186,6 +3520,15 @@ class Event:
         """Get the event source."""
         return self._source
 
+    def source_nick(self):
+        """Get the nick part of the event source (see nm_to_n)."""
+        if self._source_nick is None and self._source:
+            nick = nm_to_n(self._source)
+            if type(nick) is str:
+                nick = intern(nick)
+            self._source_nick = nick
+        return self._source_nick
+
     def target(self):
         """Get the event target."""
         return self._target
@@ -1194,6 +3537,76 @@ class Event:
         """Get the event arguments."""
         return self._arguments
 
+    def tags(self):
+        """Get the IRCv3 message tags (a dictionary)."""
+        return self._tags or {}
+
+    def server_time(self):
+        """Get the time the server saw the event at (the server-time
+        capability), in seconds since the epoch, or None.
+        """
+        if not self._tags:
+            return None
+        return _parse_server_time(self._tags.get("time"))
+
+    def batch(self):
+        """Get the Batch of a "batch" event."""
+        return self._batch
+
+
+class Batch(object):
+    """A group of related events sent by the server (the IRCv3 batch
+    capability), such as the joins and quits of a netsplit.
+
+    The events of a batch are held back until it ends.  A "batch"
+    event is generated then, with the batch type as target, the batch
+    parameters as arguments and the Batch as event.batch().  Its
+    handlers may set handled to true after dealing with all of the
+    events at once; otherwise they are handed out one by one as usual.
+    Nested batches are delivered in place of their "batch" event.
+
+    Attributes:
+
+        reference -- The reference tag of the batch.
+
+        type -- The batch type, such as "netsplit" or "netjoin".
+
+        parameters -- The batch parameters.
+
+        events -- The Events of the batch.
+
+        handled -- Skip handing the events out one by one.
+    """
+
+    def __init__(self, reference, batchtype, parameters, source=None,
+                 tags=None):
+        self.reference = reference
+        self.type = batchtype
+        self.parameters = parameters
+        self.source = source
+        self.tags = tags
+        self.events = []
+        self.handled = False
+
+    def __repr__(self):
+        return "<Batch %s %s (%d events)>" % (self.reference, self.type,
+                                              len(self.events))
+
+
+def _parse_server_time(value):
+    """[Internal] Convert a server-time timestamp, such as
+    2012-06-01T12:30:45.123Z, to seconds since the epoch.
+    """
+    if not value:
+        return None
+    stamp, _sep, fraction = value.rstrip("Z").partition(".")
+    try:
+        seconds = calendar.timegm(time.strptime(stamp, "%Y-%m-%dT%H:%M:%S"))
+        return seconds + float("0." + (fraction.isdigit() and fraction or
+                                       "0"))
+    except ValueError:
+        return None
+
 _LOW_LEVEL_QUOTE = "\020"
 _CTCP_LEVEL_QUOTE = "\134"
 _CTCP_DELIMITER = "\001"
@@ -1207,34 +3620,277 @@ _low_level_mapping = {
 _low_level_regexp = re.compile(_LOW_LEVEL_QUOTE + "(.)")
 
 
+# Mask -> compiled matcher, least recently used first.
+_mask_cache = collections.OrderedDict()
+_mask_cache_size = 1024
+
+_mask_wildcards = {"*": ".*", "?": "."}
+
+
+def _mask_pattern(mask):
+    """[Internal] Translate a mask to a regular expression matching
+    irc_lower()ed nickmasks.
+    """
+    return "".join([_mask_wildcards.get(c) or re.escape(c)
+                    for c in irc_lower(mask)])
+
+
+def _mask_matcher(mask):
+    """[Internal] Get the compiled matcher for a mask."""
+    try:
+        matcher = _mask_cache.pop(mask)
+    except KeyError:
+        matcher = re.compile(_mask_pattern(mask) + r"\Z", re.DOTALL).match
+        if len(_mask_cache) >= _mask_cache_size:
+            _mask_cache.popitem(last=False)
+    _mask_cache[mask] = matcher
+    return matcher
+
+
 def mask_matches(nick, mask):
     """Check if a nick matches a mask.
 
+    The mask must match the whole nick.  Compiled masks are kept in a
+    bounded LRU cache, so checking the same masks over and over is
+    cheap.  To check a nick against many masks at once, use a MaskSet.
+
     Returns true if the nick matches, otherwise false.
     """
-    nick = irc_lower(nick)
-    mask = irc_lower(mask)
-    mask = mask.replace("\\", "\\\\")
-    for ch in ".$|[](){}+":
-        mask = mask.replace(ch, "\\" + ch)
-    mask = mask.replace("?", ".")
-    mask = mask.replace("*", ".*")
-    r = re.compile(mask, re.IGNORECASE)
-    return r.match(nick)
+    return _mask_matcher(mask)(irc_lower(nick)) is not None
+
+
+class MaskSet:
+    """A set of masks that a nickmask can be checked against in one
+    pass.
+
+    Masks without wildcards are looked up in a dictionary.  The others
+    are grouped by the literal text they start with, or else by the
+    literal text they end with (as in *!*@host), and each group is
+    compiled into a few alternations.  A check only runs the groups
+    that can match the nickmask, plus the masks that have wildcards at
+    both ends.
+    """
+
+    # Characters of literal prefix/suffix used to group masks.
+    key_length = 3
+
+    # Masks per compiled alternation.
+    chunk_size = 256
+
+    def __init__(self, masks=()):
+        self._masks = set()
+        # irc_lower()ed mask -> masks, for masks without wildcards.
+        self._exact = {}
+        # ("prefix" or "suffix", key) or ("other", None) -> masks.
+        self._groups = {}
+        # Group -> list of compiled alternations.
+        self._compiled = {}
+        for mask in masks:
+            self.add(mask)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __iter__(self):
+        return iter(self._masks)
+
+    def __contains__(self, mask):
+        return mask in self._masks
+
+    def _group(self, mask):
+        """[Internal] Find the group a mask belongs in."""
+        lowered = irc_lower(mask)
+        wildcards = [i for i, c in enumerate(lowered) if c in "*?"]
+        if not wildcards:
+            return "exact", lowered
+        if wildcards[0]:
+            return "prefix", lowered[:min(wildcards[0], self.key_length)]
+        suffix_length = len(lowered) - 1 - wildcards[-1]
+        if suffix_length:
+            return "suffix", lowered[-min(suffix_length, self.key_length):]
+        return "other", None
+
+    def add(self, mask):
+        """Add a mask."""
+        if mask in self._masks:
+            return
+        self._masks.add(mask)
+        kind, key = self._group(mask)
+        if kind == "exact":
+            self._exact.setdefault(key, set()).add(mask)
+        else:
+            self._groups.setdefault((kind, key), set()).add(mask)
+            self._compiled.pop((kind, key), None)
+
+    def discard(self, mask):
+        """Remove a mask if present."""
+        if mask not in self._masks:
+            return
+        self._masks.discard(mask)
+        kind, key = self._group(mask)
+        if kind == "exact":
+            groups = self._exact
+        else:
+            groups = self._groups
+            key = (kind, key)
+            self._compiled.pop(key, None)
+        groups[key].discard(mask)
+        if not groups[key]:
+            del groups[key]
+
+    def _matchers(self, group):
+        """[Internal] Get the compiled alternations for a group."""
+        try:
+            return self._compiled[group]
+        except KeyError:
+            pass
+        patterns = sorted(_mask_pattern(mask) for mask in self._groups[group])
+        size = self.chunk_size
+        matchers = self._compiled[group] = [
+            re.compile("(?:%s)\\Z" % "|".join(patterns[i:i + size]),
+                       re.DOTALL).match
+            for i in range(0, len(patterns), size)]
+        return matchers
+
+    def matches(self, nick):
+        """Check if a nick (a nick!user@host) matches any of the masks.
+
+        Returns true if it does, otherwise false.
+        """
+        nick = irc_lower(nick)
+        if nick in self._exact:
+            return True
+        groups = set()
+        for i in range(1, min(self.key_length, len(nick)) + 1):
+            groups.add(("prefix", nick[:i]))
+            groups.add(("suffix", nick[-i:]))
+        groups.add(("other", None))
+        for group in groups:
+            if group in self._groups:
+                for match in self._matchers(group):
+                    if match(nick):
+                        return True
+        return False
+
 
 _special = "-[]\\`^{}"
 nick_characters = string.ascii_letters + string.digits + _special
 _ircstring_translation = string.maketrans(string.ascii_uppercase + "[]\\^",
                                           string.ascii_lowercase + "{}|~")
 
+# CASEMAPPING (see ISUPPORT) -> translation table.
+casemappings = {
+    "ascii": string.maketrans(string.ascii_uppercase,
+                              string.ascii_lowercase),
+    "rfc1459": _ircstring_translation,
+    "strict-rfc1459": string.maketrans(string.ascii_uppercase + "[]\\",
+                                       string.ascii_lowercase + "{}|"),
+}
+
 
-def irc_lower(s):
+def irc_lower(s, casemapping="rfc1459"):
     """Returns a lowercased string.
 
     The definition of lowercased comes from the IRC specification (RFC
-    1459).
+    1459), or from the named casemapping (one of the keys of the
+    casemappings dictionary; unknown names mean rfc1459).
+    """
+    return s.translate(casemappings.get(casemapping, _ircstring_translation))
+
+
+class IRCDict(collections.MutableMapping):
+    """A dictionary keyed on nicks or channel names.
+
+    Keys that are equal when lowercased according to the casemapping
+    are the same key.  The key used when an item was first stored is
+    kept and returned when iterating.
+    """
+
+    def __init__(self, items=(), casemapping="rfc1459"):
+        self._table = casemappings.get(casemapping, _ircstring_translation)
+        self.casemapping = casemapping
+        # Lowercased key -> (key, value).
+        self._data = {}
+        self.update(items)
+
+    def __getitem__(self, key):
+        return self._data[key.translate(self._table)][1]
+
+    def __setitem__(self, key, value):
+        lowered = key.translate(self._table)
+        if lowered in self._data:
+            key = self._data[lowered][0]
+        self._data[lowered] = (key, value)
+
+    def __delitem__(self, key):
+        del self._data[key.translate(self._table)]
+
+    def __contains__(self, key):
+        return key.translate(self._table) in self._data
+
+    def __iter__(self):
+        return (key for key, _value in self._data.itervalues())
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self.items()))
+
+    def canonical_key(self, key):
+        """Get the key an item is stored under, as first given."""
+        return self._data[key.translate(self._table)][0]
+
+    def set_casemapping(self, casemapping):
+        """Switch to another casemapping, e.g. when the server's
+        ISUPPORT announces one.
+        """
+        items = self._data.values()
+        self._table = casemappings.get(casemapping, _ircstring_translation)
+        self.casemapping = casemapping
+        self._data = {}
+        for key, value in items:
+            self._data.setdefault(key.translate(self._table), (key, value))
+
+
+class IRCSet(collections.MutableSet):
+    """A set of nicks or channel names, compared according to a
+    casemapping.  See IRCDict.
     """
-    return s.translate(_ircstring_translation)
+
+    def __init__(self, items=(), casemapping="rfc1459"):
+        self._dict = IRCDict(casemapping=casemapping)
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return item in self._dict
+
+    def __iter__(self):
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, list(self))
+
+    def add(self, item):
+        """Add an item."""
+        if item not in self._dict:
+            self._dict[item] = None
+
+    def discard(self, item):
+        """Remove an item if present."""
+        self._dict.pop(item, None)
+
+    @property
+    def casemapping(self):
+        return self._dict.casemapping
+
+    def set_casemapping(self, casemapping):
+        """Switch to another casemapping."""
+        self._dict.set_casemapping(casemapping)
 
 
 def _ctcp_dequote(message):
@@ -1292,6 +3948,76 @@ def _ctcp_dequote(message):
         return messages
 
 
+def create_ssl_context(ca_path=None, certfile=None, keyfile=None,
+                       ciphers=None, verify=False):
+    """Create an SSLContext for server connections.
+
+    Arguments:
+
+        ca_path -- A file or directory of CA certificates.  The
+                   system's default CAs are used if not given.
+
+        certfile -- A client certificate (e.g. for CertFP).
+
+        keyfile -- The client certificate's private key, if not in
+                   certfile.
+
+        ciphers -- An OpenSSL cipher list.
+
+        verify -- Verify the server's certificate and hostname.
+
+    A context is meant to be created once and shared by all connects
+    to a network.  Returns None if the ssl module has no SSLContext
+    (before Python 2.7.9).
+    """
+    if _ssl is None or not hasattr(_ssl, "SSLContext"):
+        return None
+    if verify:
+        if ca_path and os.path.isdir(ca_path):
+            context = _ssl.create_default_context(capath=ca_path)
+        else:
+            context = _ssl.create_default_context(cafile=ca_path)
+    else:
+        context = _ssl.SSLContext(_ssl.PROTOCOL_SSLv23)
+        context.options |= _ssl.OP_NO_SSLv2 | _ssl.OP_NO_SSLv3
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    if ciphers:
+        context.set_ciphers(ciphers)
+    return context
+
+
+def split_message(text, limit):
+    """Split a message into pieces of at most limit bytes.
+
+    Pieces end at a space where possible; the space itself is dropped.
+    Otherwise the text is cut before the limit, at the start of a UTF-8
+    encoded character.  Unicode text is measured and cut in UTF-8, and
+    returned as unicode pieces.
+    """
+    if isinstance(text, unicode):
+        return [piece.decode("utf-8")
+                for piece in split_message(text.encode("utf-8"), limit)]
+    limit = max(limit, 1)
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind(" ", 0, limit + 1)
+        if cut > 0:
+            pieces.append(text[:cut])
+            text = text[cut + 1:]
+            continue
+        cut = limit
+        while cut > 0 and "\x80" <= text[cut] < "\xc0":
+            cut -= 1
+        if cut == 0:
+            # Not UTF-8 after all.
+            cut = limit
+        pieces.append(text[:cut])
+        text = text[cut:]
+    pieces.append(text)
+    return pieces
+
+
 def is_channel(string):
     """Check if a string is a channel name.
 
@@ -1386,8 +4112,11 @@ def parse_channel_modes(mode_string):
     return _parse_modes(mode_string, "bklvo")
 
 
-def _parse_modes(mode_string, unary_modes=""):
-    """[Internal]"""
+def _parse_modes(mode_string, unary_modes="", set_unary_modes=""):
+    """[Internal]
+
+    unary_modes take an argument; set_unary_modes only when set.
+    """
     modes = []
     arg_count = 0
 
@@ -1407,7 +4136,7 @@ def _parse_modes(mode_string, unary_modes=""):
             sign = ch
         elif ch == " ":
             collecting_arguments = 1
-        elif ch in unary_modes:
+        elif ch in unary_modes or (sign == "+" and ch in set_unary_modes):
             if len(args) >= arg_count + 1:
                 modes.append([sign, ch, args[arg_count]])
                 arg_count = arg_count + 1
@@ -1418,6 +4147,12 @@ def _parse_modes(mode_string, unary_modes=""):
     return modes
 
 
+# Commands that change channel state.
+_tracked_commands = frozenset(["namreply", "endofnames", "join", "part",
+                               "kick", "quit", "nick", "mode",
+                               "channelmodeis"])
+
+
 def _ping_ponger(connection, event):
     """[Internal]"""
     connection.pong(event.target())
@@ -1582,6 +4317,15 @@ numeric_events = {
     "492": "noservicehost",
     "501": "umodeunknownflag",
     "502": "usersdontmatch",
+    "900": "loggedin",
+    "901": "loggedout",
+    "902": "nicklocked",
+    "903": "saslsuccess",
+    "904": "saslfail",
+    "905": "sasltoolong",
+    "906": "saslaborted",
+    "907": "saslalready",
+    "908": "saslmechs",
 }
 
 generated_events = [
@@ -1590,6 +4334,7 @@ generated_events = [
     "dcc_disconnect",
     "dccmsg",
     "disconnect",
+    "batch",
     "ctcp",
     "ctcpreply",
 ]
@@ -1609,6 +4354,8 @@ protocol_events = [
     "quit",
     "invite",
     "pong",
+    "cap",
+    "authenticate",
 ]
 
 all_events = generated_events + protocol_events + numeric_events.values()
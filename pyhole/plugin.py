@@ -17,7 +17,6 @@
 import functools
 import os
 import sys
-import time
 
 import log
 import utils
@@ -65,16 +64,14 @@ def hook_get(hookname):
 
 
 def hook_in_poller(hookname, timer=60):
-    """Decorator to add poller hooks."""
+    """Decorator to add poller hooks.  The poller is run every 'timer'
+    seconds by the IRC event loop, each run in its own greenthread
+    """
 
     def wrap(f):
-        @utils.spawn
-        def _wrap(self, *args, **kwargs):
-            while True:
-                time.sleep(timer)
-                f(self, *args, **kwargs)
-
+        _wrap = utils.spawn(f)
         _wrap._is_poller = True
+        _wrap._poller_timer = timer
         return _wrap
     return wrap
 
@@ -126,6 +123,17 @@ class Plugin(object):
         self.irc = irc
         self.name = self.__class__.__name__
 
+    def _get_irc(self):
+        """The IRC network being answered on.  When several networks
+        share the plugins, this is the network of the running greenthread
+        """
+        return utils.get_network() or self._irc
+
+    def _set_irc(self, irc):
+        self._irc = irc
+
+    irc = property(_get_irc, _set_irc)
+
 
 def _init_plugins(*args, **kwargs):
     """Create instances of the plugin classes and create a cache
@@ -150,25 +158,36 @@ def _init_plugins(*args, **kwargs):
                     _plugin_hooks[hook_key].append((attr.__module__, attr,
                             hook_arg))
 
-def load_pollers():
+def load_pollers(irc=None):
+    """Schedule the poller hooks of every plugin instance on the timers
+    of an IRC network, by default the instance's own, to run on behalf
+    of that network
+    """
     for instance in _plugin_instances:
+        network = irc or instance.irc
         for attr_name in dir(instance):
             attr = getattr(instance, attr_name)
 
             if getattr(attr, "_is_poller", False):
                 LOG.info("Loading %s poller" % attr_name)
-                _loaded_pollers.append(attr())
+                _loaded_pollers.append((network,
+                        network.connection.execute_every(attr._poller_timer,
+                                utils.run_for_network, (network, attr))))
 
-def terminate_pollers():
+def terminate_pollers(irc=None):
+    """Cancel the timers of the pollers loaded for an IRC network, or of
+    all loaded pollers
+    """
     global _loaded_pollers
 
-    for poller in _loaded_pollers:
-        try:
-            poller.throw(KeyboardInterrupt)
-        except:
-            pass
+    remaining = []
+    for network, poller in _loaded_pollers:
+        if irc is None or network is irc:
+            poller.cancel()
+        else:
+            remaining.append((network, poller))
 
-    _loaded_pollers = []
+    _loaded_pollers = remaining
 
 
 def load_user_plugin(plugin, *args, **kwargs):
@@ -239,10 +258,16 @@ def reload_plugins(*args, **kwargs):
     # Load new plugins
     load_plugins(*args, **kwargs)
 
-    # Terminate and load new pollers
+    # Terminate and load new pollers, for every network that had them
+
+    networks = []
+    for network, _poller in _loaded_pollers:
+        if network not in networks:
+            networks.append(network)
 
     terminate_pollers()
-    load_pollers()
+    for network in networks or [None]:
+        load_pollers(network)
 
 
 def active_plugins():
@@ -44,6 +44,15 @@ class Admin(plugin.Plugin):
         """Display the current version"""
         self.irc.reply(self.irc.version)
 
+    @plugin.hook_add_command("lag")
+    def lag(self, params=None, **kwargs):
+        """Display the lag to the server, as of the last keepalive PING"""
+        lag = self.irc.connection.get_lag()
+        if lag is None:
+            self.irc.reply("Lag not measured yet")
+        else:
+            self.irc.reply("Lag: %.3fs" % lag)
+
     @plugin.hook_add_command("reload")
     @utils.admin
     def reload(self, params=None, **kwargs):
@@ -113,6 +122,16 @@ class Admin(plugin.Plugin):
         else:
             self.irc.reply(self.say.__doc__)
 
+    @plugin.hook_add_command("send")
+    @utils.admin
+    def send(self, params=None, **kwargs):
+        """Send a file from the dcc directory (ex: .send <nick> <file>)"""
+        if params and " " in params:
+            (nick, name) = params.split(" ", 1)
+            self.irc.send_file(nick, name)
+        else:
+            self.irc.reply(self.send.__doc__)
+
     def _find_doc_string(self, params):
         """Find the doc string for a plugin, command or keyword hook"""
         for p in plugin.active_plugin_classes():
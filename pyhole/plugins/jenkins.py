@@ -16,7 +16,6 @@
 
 import commands
 import json
-import time
 
 from lxml import etree
 
@@ -64,7 +63,6 @@ class Jenkins(plugin.Plugin):
             url = new_failures[new_failure]
             reply = "[BUILD FAILED] %s: %s" % (title, url)
             self.irc.notice(reply)
-            time.sleep(1)
 
         self._write_cache(new_failures)
 
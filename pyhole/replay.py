@@ -0,0 +1,229 @@
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Pyhole Traffic Replay
+
+Push a capture file (see capture.py) through a pyhole IRC client with
+the configured plugins loaded.  The client is connected to a local
+server that plays the capture, either as fast as the client takes it or
+at the original pace, and collects everything the client sends back.
+HTTP requests made through fetch_url, urllib and urllib2 fail
+immediately instead of reaching the network.
+
+Reports the lines replayed per second, the time spent in each plugin
+hook and the peak RSS of the process.
+"""
+
+import optparse
+import resource
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+import capture
+import utils
+import version
+
+
+DONE_TOKEN = "pyhole-replay-done"
+
+
+def build_options():
+    """Generate command line options"""
+    parser = optparse.OptionParser(usage="%prog [options] <capture file>",
+            version=version.version_string())
+    parser.add_option("-c", "--config", default=utils.get_conf_file_path(),
+            help="specify the path to a configuration file")
+    parser.add_option("-d", "--debug", action="store_true",
+            help="show debugging output")
+    parser.add_option("-n", "--network",
+            help="network section to take the bot settings from "
+                 "(default: the first configured network)")
+    parser.add_option("-p", "--paced", action="store_true",
+            help="replay at the pace the traffic was captured at")
+    parser.add_option("-o", "--output",
+            help="write the lines sent by the bot to a file")
+
+    return parser.parse_args()
+
+
+class ReplayServer(threading.Thread):
+    """Play a capture to one client and collect its replies"""
+
+    def __init__(self, path, paced=False, output=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.paced = paced
+        self.output = output
+        self.lines = 0
+        self.replies = 0
+        self.elapsed = None
+        self.done = threading.Event()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.client = None
+
+    def run(self):
+        self.client = client = self.listener.accept()[0]
+        self.listener.close()
+        reader = threading.Thread(target=self._read_replies, args=(client,))
+        reader.daemon = True
+        reader.start()
+
+        start = due = time.time()
+        batch = []
+        for delay, line in capture.read_capture(self.path):
+            if self.paced and delay:
+                client.sendall("".join(batch))
+                batch = []
+                due += delay
+                time.sleep(max(due - time.time(), 0))
+            batch.append(line + "\r\n")
+            self.lines += 1
+            if len(batch) >= 100:
+                client.sendall("".join(batch))
+                batch = []
+
+        # The client has handled every line once it answers this.
+        batch.append("PING :%s\r\n" % DONE_TOKEN)
+        client.sendall("".join(batch))
+        reader.join()
+        self.elapsed = time.time() - start
+        self.done.set()
+
+    def _read_replies(self, client):
+        """Count (and write out) the lines sent by the client until it
+        answers the final PING
+        """
+        output = self.output and open(self.output, "wb")
+        data = ""
+        while True:
+            new_data = client.recv(2 ** 16)
+            if not new_data:
+                break
+            data += new_data
+            lines = data.split("\r\n")
+            data = lines.pop()
+            self.replies += len(lines)
+            if output:
+                output.write("".join(line + "\n" for line in lines))
+            if "PONG %s" % DONE_TOKEN in lines or \
+               "PONG :%s" % DONE_TOKEN in lines:
+                break
+        if output:
+            output.close()
+
+
+def _no_http(*args, **kwargs):
+    """Stand-in for urlopen during replays"""
+    raise IOError("HTTP is disabled during replays")
+
+
+def _client_class():
+    """Return the IRC client class used for replays.  pyhole.irc reads
+    the configuration, and so the command line, when it is imported
+    """
+    import irc
+
+    class ReplayIRC(irc.IRC):
+        """A pyhole IRC client talking to the replay server"""
+
+        replay_port = None
+
+        def __init__(self, network):
+            # Hook name -> list of call durations.
+            self.hook_times = {}
+            irc.IRC.__init__(self, network)
+            self.connection.set_flood_control(None)
+
+        def connect(self, server, port, nickname, password=None, **kwargs):
+            irc.IRC.connect(self, "127.0.0.1", self.replay_port, nickname,
+                    password, username=kwargs.get("username"),
+                    capabilities=kwargs.get("capabilities"))
+
+        def start_capture(self):
+            """Never capture the replayed traffic."""
+            pass
+
+        def run_hook_command(self, mod_name, func, arg, **kwargs):
+            # Hooks decorated with utils.spawn are only timed up to the
+            # spawn.
+            start = time.time()
+            irc.IRC.run_hook_command(self, mod_name, func, arg, **kwargs)
+            self.hook_times.setdefault("%s.%s" % (mod_name, func.__name__),
+                    []).append(time.time() - start)
+
+        def fetch_url(self, url, name):
+            self.reply("Unable to fetch %s data" % name)
+            return None
+
+    return ReplayIRC
+
+
+def report(server, client):
+    """Print the results of a replay"""
+    mode = server.paced and "original pace" or "max speed"
+    print "Replayed %d lines in %.3fs at %s: %.0f lines/sec" % (
+            server.lines, server.elapsed, mode, server.lines / server.elapsed)
+    print "Bot sent %d lines" % server.replies
+    print "Peak RSS: %.1f MB" % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+    if not client.hook_times:
+        return
+
+    print
+    print "%-40s %8s %10s %10s" % ("hook", "calls", "mean ms", "max ms")
+    for name, times in sorted(client.hook_times.items(),
+            key=lambda item: -sum(item[1])):
+        print "%-40s %8d %10.3f %10.3f" % (name, len(times),
+                sum(times) / len(times) * 1000, max(times) * 1000)
+
+
+def main():
+    """Replay a capture file"""
+    options, args = build_options()
+    if len(args) != 1:
+        print "Usage: pyhole-replay [options] <capture file>"
+        sys.exit(1)
+
+    # Only the options pyhole itself knows about are left for it to
+    # parse.
+    sys.argv = sys.argv[:1] + ["--config", options.config]
+    if options.debug:
+        sys.argv.append("--debug")
+
+    network = options.network or \
+            utils.get_config().get("networks", type="list")[0]
+
+    urllib.urlopen = _no_http
+    urllib2.urlopen = _no_http
+
+    server = ReplayServer(args[0], options.paced, options.output)
+    server.start()
+
+    client_class = _client_class()
+    client_class.replay_port = server.port
+    client = client_class(network)
+
+    while not server.done.is_set():
+        client.ircobj.process_once(0.2)
+
+    report(server, client)
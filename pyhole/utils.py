@@ -20,6 +20,7 @@ import eventlet
 import optparse
 import os
 import re
+import threading
 
 from BeautifulSoup import BeautifulStoneSoup
 
@@ -29,6 +30,9 @@ import version
 
 eventlet.monkey_patch()
 
+# The IRC network the current greenthread is working for.
+_network = threading.local()
+
 
 def admin(func):
     """Administration Decorator"""
@@ -43,10 +47,34 @@ def admin(func):
     return wrap
 
 
+def get_network():
+    """Return the IRC network the current greenthread is working for"""
+    return getattr(_network, "irc", None)
+
+
+def set_network(irc):
+    """Set the IRC network the current greenthread is working for"""
+    _network.irc = irc
+
+
+def run_for_network(irc, func, *args, **kwargs):
+    """Run a function on behalf of an IRC network"""
+    previous = get_network()
+    set_network(irc)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        set_network(previous)
+
+
 def spawn(func):
-    """Greenthread Spawning Decorator"""
+    """Greenthread Spawning Decorator
+
+    The greenthread keeps working for the network of its spawner.
+    """
     def wrap(self, *args, **kwargs):
-        return eventlet.spawn_n(func, self, *args, **kwargs)
+        return eventlet.spawn_n(run_for_network, get_network(), func, self,
+                *args, **kwargs)
     wrap.__doc__ = func.__doc__
     wrap.__name__ = func.__name__
     wrap.__module__ = func.__module__
@@ -155,6 +183,8 @@ rejoin_delay: 5
 debug: False
 plugins: admin, calculator, search, urls
 networks: FreeNode, EFnet
+single_process: False
+engine: select
 
 [Wunderground]
 key: abcd1234
@@ -177,11 +207,24 @@ username:
 password:
 port: 7000
 ssl: True
+ssl_ca_path:
+ssl_verify: False
+ssl_cert:
+ssl_key:
+ssl_ciphers:
 ipv6: True
 bind_to: fe80::1
 nick: mynick
 identify_password: mypass
+sasl_mechanism: PLAIN
 channels: #mychannel key, #mychannel2
+flood_rate: 0.5
+flood_burst: 5
+keepalive_interval: 60
+keepalive_timeout: 30
+capture_file:
+dcc_address:
+dcc_rate: 0
 
 [EFnet]
 server: irc.efnet.net
@@ -193,7 +236,15 @@ ipv6: False
 bind_to:
 nick: mynick
 identify_password:
+sasl_mechanism:
 channels: #mychannel key, #mychannel2
+flood_rate: 0.5
+flood_burst: 5
+keepalive_interval: 60
+keepalive_timeout: 30
+capture_file:
+dcc_address:
+dcc_rate: 0
 """
 
     conf_file = get_conf_file()
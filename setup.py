@@ -41,6 +41,9 @@ setuptools.setup(
         "Programming Language :: Python",
     ],
     entry_points={
-        "console_scripts": ["pyhole = pyhole.irc:main"]
+        "console_scripts": [
+            "pyhole = pyhole.irc:main",
+            "pyhole-replay = pyhole.replay:main"
+        ]
     }
 )
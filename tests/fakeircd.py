@@ -0,0 +1,310 @@
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""A lightweight IRC server stand-in for tests and benchmarks.
+
+It runs on localhost in a single thread and understands just enough of
+the protocol to host a bot: registration (NICK/USER, with a welcome,
+ISUPPORT and end of MOTD), JOIN with NAMES, PART, PRIVMSG and NOTICE
+fan-out to channels and nicks, PING, and QUIT.  Anyone may talk to a
+channel without joining it.  Everything else is ignored.
+
+    server = FakeIRCd()
+    server.start()
+    ... connect to ("127.0.0.1", server.port) ...
+    server.stop()
+"""
+
+import errno
+import select
+import socket
+import threading
+
+
+SERVER_NAME = "fake.ircd"
+
+
+class FakeClient(object):
+    """A connection to the fake server"""
+
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.address = address
+        self.nick = None
+        self.user = None
+        self.registered = False
+        self.channels = set()
+        self.inbuf = ""
+        self.outbuf = []
+        self.pending = 0
+
+    def prefix(self):
+        return "%s!%s@%s" % (self.nick, self.user or self.nick,
+                             self.address[0])
+
+
+class FakeIRCd(threading.Thread):
+    """The fake server.  The port it listens on is available as
+    self.port as soon as it is created.
+    """
+
+    def __init__(self, port=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", port))
+        self.listener.listen(128)
+        self.listener.setblocking(0)
+        self.port = self.listener.getsockname()[1]
+        self.clients = {}
+        self.nicks = {}
+        # Channel (lowercased) -> set of clients.
+        self.channels = {}
+        self.lines_received = 0
+        self._running = False
+        self._waker, self._wakee = socket.socketpair()
+
+    def stop(self):
+        """Stop serving and close every connection."""
+        self._running = False
+        self._waker.send("x")
+        self.join(5)
+
+    def get_pending_bytes(self, nick):
+        """Bytes queued by the server for a nick but not yet sent."""
+        client = self.nicks.get(nick.lower())
+        return client and client.pending or 0
+
+    def get_channels(self, nick):
+        """The (lowercased) channels a nick is on."""
+        client = self.nicks.get(nick.lower())
+        return client and set(client.channels) or set()
+
+    def run(self):
+        self._running = True
+        try:
+            while self._running:
+                readers = [self.listener, self._wakee] + self.clients.keys()
+                writers = [s for s, c in self.clients.items() if c.outbuf]
+                i, o, _e = select.select(readers, writers, [], 1)
+                for sock in i:
+                    if sock is self.listener:
+                        self._accept()
+                    elif sock is self._wakee:
+                        self._wakee.recv(512)
+                    elif sock in self.clients:
+                        self._read(self.clients[sock])
+                for sock in o:
+                    if sock in self.clients:
+                        self._write(self.clients[sock])
+        finally:
+            for client in self.clients.values():
+                client.socket.close()
+            self.listener.close()
+            self._waker.close()
+            self._wakee.close()
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        # Lines are small and latency is what gets measured.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.clients[sock] = FakeClient(sock, address)
+
+    def _read(self, client):
+        try:
+            data = client.socket.recv(2 ** 16)
+        except socket.error, x:
+            if x.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self._drop(client, "Connection closed")
+            return
+
+        lines = (client.inbuf + data).split("\n")
+        client.inbuf = lines.pop()
+        for line in lines:
+            line = line.rstrip("\r")
+            if line:
+                self.lines_received += 1
+                self._handle(client, line)
+                if client.socket not in self.clients:
+                    return
+
+    def _write(self, client):
+        data = "".join(client.outbuf)
+        try:
+            sent = client.socket.send(data)
+        except socket.error, x:
+            if x.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._drop(client, "Connection reset by peer")
+            return
+        client.outbuf = sent < len(data) and [data[sent:]] or []
+        client.pending -= sent
+
+    def _send(self, client, line):
+        client.outbuf.append(line + "\r\n")
+        client.pending += len(line) + 2
+
+    def _reply(self, client, numeric, text):
+        self._send(client, ":%s %s %s %s" % (SERVER_NAME, numeric,
+                                             client.nick or "*", text))
+
+    def _drop(self, client, reason):
+        if client.registered:
+            self._fan_out(client, ":%s QUIT :%s" % (client.prefix(), reason),
+                          self._neighbours(client))
+        for name in client.channels:
+            self.channels[name].discard(client)
+            if not self.channels[name]:
+                del self.channels[name]
+        if client.nick and self.nicks.get(client.nick.lower()) is client:
+            del self.nicks[client.nick.lower()]
+        del self.clients[client.socket]
+        client.socket.close()
+
+    def _neighbours(self, client):
+        neighbours = set()
+        for name in client.channels:
+            neighbours |= self.channels[name]
+        neighbours.discard(client)
+        return neighbours
+
+    def _fan_out(self, sender, line, clients):
+        for client in clients:
+            if client is not sender:
+                self._send(client, line)
+
+    def _handle(self, client, line):
+        if line.startswith(":"):
+            line = line.split(" ", 1)[1:] and line.split(" ", 1)[1] or ""
+        if " :" in line:
+            line, trailing = line.split(" :", 1)
+            params = line.split() + [trailing]
+        else:
+            params = line.split()
+        if not params:
+            return
+        command = params.pop(0).upper()
+        handler = getattr(self, "_handle_%s" % command.lower(), None)
+        if handler is None:
+            return
+        if not client.registered and command not in ("NICK", "USER", "PASS",
+                                                     "PING", "QUIT", "CAP"):
+            self._reply(client, "451", ":You have not registered")
+            return
+        handler(client, params)
+
+    def _handle_nick(self, client, params):
+        if not params:
+            return
+        nick = params[0]
+        owner = self.nicks.get(nick.lower())
+        if owner is not None and owner is not client:
+            self._reply(client, "433", "%s :Nickname is already in use" % nick)
+            return
+        if client.nick:
+            self.nicks.pop(client.nick.lower(), None)
+        if client.registered:
+            line = ":%s NICK :%s" % (client.prefix(), nick)
+            self._send(client, line)
+            self._fan_out(client, line, self._neighbours(client))
+        client.nick = nick
+        self.nicks[nick.lower()] = client
+        self._register(client)
+
+    def _handle_user(self, client, params):
+        if params:
+            client.user = params[0]
+            self._register(client)
+
+    def _register(self, client):
+        if client.registered or not client.nick or not client.user:
+            return
+        client.registered = True
+        self._reply(client, "001", ":Welcome to the fake network %s" %
+                    client.prefix())
+        self._reply(client, "002", ":Your host is %s" % SERVER_NAME)
+        self._reply(client, "005", "CASEMAPPING=rfc1459 CHANTYPES=# "
+                    "PREFIX=(ov)@+ CHANLIMIT=#:100 TARGMAX=PRIVMSG:4,"
+                    "NOTICE:4,JOIN: :are supported by this server")
+        self._reply(client, "376", ":End of /MOTD command.")
+
+    def _handle_ping(self, client, params):
+        self._send(client, ":%s PONG %s :%s" % (SERVER_NAME, SERVER_NAME,
+                                                params and params[-1] or ""))
+
+    def _handle_join(self, client, params):
+        if not params:
+            return
+        for name in params[0].split(","):
+            if name == "0":
+                self._handle_part(client, [",".join(client.channels)])
+                continue
+            lowered = name.lower()
+            if not name.startswith("#") or lowered in client.channels:
+                continue
+            members = self.channels.setdefault(lowered, set())
+            first = not members
+            members.add(client)
+            client.channels.add(lowered)
+            line = ":%s JOIN %s" % (client.prefix(), name)
+            self._send(client, line)
+            self._fan_out(client, line, members)
+            names = " ".join((first and c is client and "@" or "") + c.nick
+                             for c in members)
+            self._reply(client, "353", "= %s :%s" % (name, names))
+            self._reply(client, "366", "%s :End of /NAMES list." % name)
+
+    def _handle_part(self, client, params):
+        if not params:
+            return
+        for name in params[0].split(","):
+            lowered = name.lower()
+            if lowered not in client.channels:
+                continue
+            line = ":%s PART %s" % (client.prefix(), name)
+            self._send(client, line)
+            self._fan_out(client, line, self.channels[lowered])
+            client.channels.discard(lowered)
+            self.channels[lowered].discard(client)
+            if not self.channels[lowered]:
+                del self.channels[lowered]
+
+    def _handle_privmsg(self, client, params, command="PRIVMSG"):
+        if len(params) < 2:
+            return
+        for target in params[0].split(","):
+            line = ":%s %s %s :%s" % (client.prefix(), command, target,
+                                      params[-1])
+            if target.startswith("#"):
+                self._fan_out(client, line,
+                              self.channels.get(target.lower(), ()))
+            elif target.lower() in self.nicks:
+                self._send(self.nicks[target.lower()], line)
+            elif command == "PRIVMSG":
+                self._reply(client, "401", "%s :No such nick/channel" %
+                            target)
+
+    def _handle_notice(self, client, params):
+        self._handle_privmsg(client, params, "NOTICE")
+
+    def _handle_quit(self, client, params):
+        self._drop(client, params and params[-1] or "Quit")
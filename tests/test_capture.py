@@ -0,0 +1,91 @@
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Pyhole Capture Unit Tests"""
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from pyhole import capture
+from pyhole import irclib
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory, name)
+        writer = capture.CaptureWriter(path)
+        for line in lines:
+            writer.record(line)
+        writer.close()
+        return path
+
+    def test_round_trip(self):
+        lines = [":srv 001 bot :Welcome", ":n!u@h PRIVMSG #c :a  b :c"]
+        path = self.write("capture", lines)
+        records = list(capture.read_capture(path))
+        self.assertEqual([line for delay, line in records], lines)
+        self.assertTrue(all(delay >= 0 for delay, line in records))
+
+    def test_compressed_sessions(self):
+        path = self.write("capture.gz", ["PING :a"])
+        self.write("capture.gz", ["PING :b"])
+        self.assertEqual([line for delay, line in
+                          capture.read_capture(path)],
+                         ["PING :a", "PING :b"])
+
+    def test_delays(self):
+        path = os.path.join(self.directory, "capture")
+        writer = capture.CaptureWriter(path)
+        writer.record("PING :a")
+        time.sleep(0.05)
+        writer.record("PING :b")
+        writer.close()
+        delays = [delay for delay, line in capture.read_capture(path)]
+        self.assertTrue(delays[1] >= 0.04)
+
+    def test_server_connection_records(self):
+        class Recorder(object):
+            def __init__(self):
+                self.lines = []
+
+            def record(self, line):
+                self.lines.append(line)
+
+        irc = irclib.IRC(poller="select")
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        connection = irc.server()
+        connection.capture = Recorder()
+        connection.connect("127.0.0.1", listener.getsockname()[1], "bot")
+        peer = listener.accept()[0]
+        listener.close()
+        peer.sendall(":srv NOTICE bot :hi\r\n:n!u@h PRIVMSG #c :yo\r\n")
+        deadline = time.time() + 5
+        while len(connection.capture.lines) < 2 and time.time() < deadline:
+            irc.process_once(0.1)
+        self.assertEqual(connection.capture.lines,
+                         [":srv NOTICE bot :hi", ":n!u@h PRIVMSG #c :yo"])
+        connection.close()
+        peer.close()
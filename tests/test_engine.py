@@ -0,0 +1,97 @@
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Pyhole Engine Unit Tests"""
+
+import socket
+import time
+import unittest
+
+import eventlet
+
+from pyhole import engine
+from pyhole import irclib
+
+
+class TestEventletPoller(unittest.TestCase):
+    def setUp(self):
+        self.poller = engine.EventletPoller()
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.poller.unregister(self.a)
+        self.a.close()
+        self.b.close()
+
+    def test_poll_readable(self):
+        self.poller.register(self.a)
+        self.b.send("PING :x\r\n")
+        self.assertEqual(self.poller.poll(1), ([self.a], []))
+        self.a.recv(512)
+        self.assertEqual(self.poller.poll(0), ([], []))
+
+    def test_poll_writable(self):
+        self.poller.register(self.a, readable=False, writable=True)
+        self.assertEqual(self.poller.poll(1), ([], [self.a]))
+        self.poller.modify(self.a, readable=True, writable=False)
+        self.assertEqual(self.poller.poll(0), ([], []))
+
+    def test_unregister(self):
+        self.poller.register(self.a)
+        self.poller.unregister(self.a)
+        self.assertEqual(len(self.poller), 0)
+        self.b.send("PING :x\r\n")
+        self.assertEqual(self.poller.poll(0), ([], []))
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertEqual(self.poller.poll(0.05), ([], []))
+        self.assertTrue(time.time() - start >= 0.05)
+
+    def test_other_greenthreads_run(self):
+        ran = []
+        eventlet.spawn_n(ran.append, 1)
+        self.poller.poll(0)
+        self.assertEqual(ran, [1])
+
+
+class TestCreateIRC(unittest.TestCase):
+    def test_engines(self):
+        irc = engine.create_irc("eventlet")
+        self.assertTrue(isinstance(irc.poller, engine.EventletPoller))
+        irc = engine.create_irc("select")
+        self.assertTrue(isinstance(irc.poller, irclib.SelectPoller))
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, engine.create_irc, "asyncio")
+
+    def test_server_connection(self):
+        irc = engine.create_irc("eventlet")
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        messages = []
+        irc.add_global_handler(
+            "pubmsg", lambda c, e: messages.append(e.arguments()[0]))
+        connection = irc.server()
+        connection.connect("127.0.0.1", listener.getsockname()[1], "bot")
+        peer, _addr = listener.accept()
+        listener.close()
+        peer.sendall(":n!u@h PRIVMSG #chan :hello\r\n")
+        deadline = time.time() + 5
+        while not messages and time.time() < deadline:
+            irc.process_once(0.1)
+        self.assertEqual(messages, ["hello"])
+        connection.close()
+        peer.close()
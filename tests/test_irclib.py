@@ -0,0 +1,1277 @@
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Pyhole IRClib Unit Tests"""
+
+import base64
+import os
+import select
+import socket
+import ssl
+import struct
+import tempfile
+import time
+import unittest
+
+from pyhole import irclib
+from tests import fakeircd
+
+
+class TestPollers(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def _available_pollers(self):
+        return [cls() for name, cls in irclib.pollers.items()
+                if name == "select" or hasattr(select, name)]
+
+    def test_poll_readable(self):
+        for poller in self._available_pollers():
+            poller.register(self.a)
+            self.b.send("PING :x\r\n")
+            i, o = poller.poll(1)
+            self.assertEqual(i, [self.a])
+            self.assertEqual(o, [])
+            self.a.recv(512)
+
+    def test_poll_writable(self):
+        for poller in self._available_pollers():
+            poller.register(self.a, readable=False, writable=True)
+            i, o = poller.poll(1)
+            self.assertEqual(o, [self.a])
+
+    def test_unregister(self):
+        for poller in self._available_pollers():
+            poller.register(self.a)
+            poller.unregister(self.a)
+            self.assertEqual(len(poller), 0)
+            self.b.send("PING :x\r\n")
+            self.assertEqual(poller.poll(0), ([], []))
+            self.a.recv(512)
+
+    def test_default_poller(self):
+        poller = irclib.default_poller()
+        self.assertTrue(poller.name in irclib.pollers)
+
+
+def connect_server(irc, nickname="bot"):
+    """Connect a ServerConnection to a local socket standing in for the
+    server and return both ends.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    connection = irc.server()
+    connection.connect("127.0.0.1", listener.getsockname()[1], nickname)
+    peer, _addr = listener.accept()
+    listener.close()
+    deadline = time.time() + 5
+    while not connection.is_established() and time.time() < deadline:
+        irc.process_once(0.1)
+    return connection, peer
+
+
+class FakeConnection(irclib.Connection):
+    def __init__(self, irclibobj, sock):
+        irclib.Connection.__init__(self, irclibobj)
+        self.socket = sock
+        self.reads = 0
+
+    def _get_socket(self):
+        return self.socket
+
+    def process_data(self):
+        self.socket.recv(512)
+        self.reads += 1
+
+
+class TestIRC(unittest.TestCase):
+    def test_fd_to_connection(self):
+        irc = irclib.IRC()
+        a, b = socket.socketpair()
+        c = FakeConnection(irc, a)
+        irc.connections.append(c)
+        irc._add_socket(c, a)
+        self.assertTrue(irc.fd_to_connection[a.fileno()] is c)
+
+        b.send("PING :x\r\n")
+        irc.process_once(1)
+        self.assertEqual(c.reads, 1)
+
+        irc._remove_socket(c, a)
+        irc._remove_connection(c)
+        self.assertEqual(irc.fd_to_connection, {})
+        a.close()
+        b.close()
+
+    def test_poller_by_name(self):
+        irc = irclib.IRC(poller="select")
+        self.assertTrue(isinstance(irc.poller, irclib.SelectPoller))
+
+    def test_next_timeout_delayed_command(self):
+        irc = irclib.IRC()
+        irc.execute_delayed(0.5, lambda: None)
+        self.assertTrue(irc._next_timeout(None) <= 0.5)
+        self.assertEqual(irc._next_timeout(0), 0)
+
+    def test_next_timeout_idle(self):
+        irc = irclib.IRC()
+        self.assertEqual(irc._next_timeout(None), None)
+
+    def test_process_once_runs_due_commands(self):
+        irc = irclib.IRC()
+        ran = []
+        irc.execute_delayed(0.01, ran.append, (1,))
+        start = time.time()
+        irc.process_once(None)
+        self.assertEqual(ran, [1])
+        self.assertTrue(time.time() - start < 1)
+
+
+class TestIdleLoop(unittest.TestCase):
+    def test_waits_without_sockets_or_timers(self):
+        irc = irclib.IRC(poller="select")
+        irc.idle_timeout = 0.05
+        start = time.time()
+        irc.process_once(None)
+        self.assertTrue(time.time() - start >= 0.05)
+
+
+class TestTimers(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC()
+        self.calls = []
+
+    def test_order(self):
+        self.irc.execute_at(100, self.calls.append, (2,))
+        self.irc.execute_at(100, self.calls.append, (3,))
+        self.irc.execute_at(50, self.calls.append, (1,))
+        self.irc.process_timeout()
+        self.assertEqual(self.calls, [1, 2, 3])
+
+    def test_cancel(self):
+        timer = self.irc.execute_delayed(0, self.calls.append, (1,))
+        timer.cancel()
+        self.irc.process_timeout()
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.irc._next_timeout(None), None)
+
+    def test_not_due(self):
+        self.irc.execute_delayed(60, self.calls.append, (1,))
+        self.irc.process_timeout()
+        self.assertEqual(self.calls, [])
+
+    def test_execute_every(self):
+        timer = self.irc.execute_every(0, self.calls.append, (1,))
+        self.assertTrue(timer.is_repeating())
+        self.irc.process_timeout()
+        self.irc.process_timeout()
+        self.assertEqual(self.calls, [1, 1])
+        timer.cancel()
+        self.irc.process_timeout()
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_error_keeps_due_timers(self):
+        def fail():
+            raise ValueError("boom")
+
+        self.irc.execute_at(50, fail)
+        self.irc.execute_at(100, self.calls.append, (1,))
+        self.irc.execute_at(100, self.calls.append, (2,))
+        self.assertRaises(ValueError, self.irc.process_timeout)
+        self.assertEqual(self.calls, [])
+        self.irc.process_timeout()
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(self.irc._next_timeout(None), None)
+
+
+class TestLineBuffer(unittest.TestCase):
+    def setUp(self):
+        self.buffer = irclib.LineBuffer()
+
+    def test_lines(self):
+        self.buffer.feed("PING :a\r\nPING :b\nPI")
+        self.assertEqual(list(self.buffer.lines()), ["PING :a", "PING :b"])
+        self.assertEqual(len(self.buffer), 2)
+
+    def test_partial_line(self):
+        self.buffer.feed("PING :a\r")
+        self.assertEqual(list(self.buffer.lines()), [])
+        self.buffer.feed("\nPING")
+        self.assertEqual(list(self.buffer.lines()), ["PING :a"])
+        self.buffer.feed(" :b\r\n")
+        self.assertEqual(list(self.buffer.lines()), ["PING :b"])
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_empty_lines(self):
+        self.buffer.feed("\r\n\n")
+        self.assertEqual(list(self.buffer.lines()), ["", ""])
+
+    def test_views(self):
+        self.buffer.feed("PING :a\r\n")
+        views = list(self.buffer)
+        self.assertEqual(views[0].tobytes(), "PING :a")
+        # Feeding while a view is still alive must not fail.
+        self.buffer.feed("PING :b\r\n")
+        self.assertEqual(list(self.buffer.lines()), ["PING :b"])
+
+
+class TestParseLine(unittest.TestCase):
+    lines = [
+        ":nick!user@host PRIVMSG #chan :hello :world",
+        ":irc.example.net 001 bot :Welcome",
+        "PING :irc.example.net",
+        ":nick!user@host MODE #chan +ov nick nick2",
+        ":nick!user@host QUIT",
+        ":irc.example.net 353 bot = #chan :@a +b c",
+        "PRIVMSG #chan :",
+    ]
+
+    def test_parse_line(self):
+        self.assertEqual(
+            irclib.parse_line(":nick!user@host PRIVMSG #chan :hi there"),
+            (None, "nick!user@host", "privmsg", ["#chan", "hi there"]))
+
+    def test_numeric(self):
+        tags, prefix, command, arguments = irclib.parse_line(
+            ":irc.example.net 001 bot :Welcome")
+        self.assertEqual(command, "welcome")
+        self.assertEqual(arguments, ["bot", "Welcome"])
+
+    def test_no_arguments(self):
+        self.assertEqual(irclib.parse_line(":nick!user@host QUIT"),
+                         (None, "nick!user@host", "quit", []))
+
+    def test_tags(self):
+        tags, prefix, command, arguments = irclib.parse_line(
+            "@time=2012-06-30T23:59:60.419Z;a=b\\sc\\:d;e "
+            ":nick!user@host PRIVMSG #chan :hi")
+        self.assertEqual(tags, {"time": "2012-06-30T23:59:60.419Z",
+                                "a": "b c;d", "e": ""})
+        self.assertEqual(command, "privmsg")
+
+    def test_matches_regexp_parser(self):
+        for line in self.lines:
+            self.assertEqual(irclib.parse_line(line),
+                             irclib.parse_line_regexp(line))
+
+
+class TestSubscriptions(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC()
+        self.events = []
+
+    def handler(self, connection, event):
+        self.events.append(event.eventtype())
+
+    def test_has_subscribers(self):
+        self.assertTrue(self.irc.has_subscribers("ping"))
+        self.assertFalse(self.irc.has_subscribers("pubmsg"))
+        self.irc.add_global_handler("pubmsg", self.handler)
+        self.assertTrue(self.irc.has_subscribers("pubmsg"))
+        self.irc.remove_global_handler("pubmsg", self.handler)
+        self.assertFalse(self.irc.has_subscribers("pubmsg"))
+
+    def test_all_events_excludes_raw(self):
+        self.irc.add_global_handler("all_events", self.handler)
+        self.assertTrue(self.irc.has_subscribers("pubmsg"))
+        self.assertFalse(self.irc.has_subscribers("all_raw_messages"))
+
+    def test_only_subscribed_events(self):
+        self.irc.add_global_handler("all_events", self.handler)
+        connection, peer = connect_server(self.irc)
+        peer.sendall(":nick!user@host PRIVMSG #chan :hi\r\n")
+        self.irc.process_once(1)
+        self.assertEqual(self.events, ["pubmsg"])
+
+        self.irc.add_global_handler("all_raw_messages", self.handler)
+        peer.sendall(":nick!user@host PRIVMSG #chan :hi\r\n")
+        self.irc.process_once(1)
+        self.assertEqual(self.events, ["pubmsg", "all_raw_messages",
+                                       "pubmsg"])
+        connection.close()
+        peer.close()
+
+    def test_simple_client_subscriptions(self):
+        class Client(irclib.SimpleIRCClient):
+            def on_pubmsg(self, connection, event):
+                pass
+
+        client = Client()
+        self.assertTrue(client.ircobj.has_subscribers("pubmsg"))
+        self.assertFalse(client.ircobj.has_subscribers("privnotice"))
+        self.assertFalse(client.ircobj.has_subscribers("all_raw_messages"))
+
+    def test_simple_clients_share_loop(self):
+        class Client(irclib.SimpleIRCClient):
+            def __init__(self, ircobj):
+                irclib.SimpleIRCClient.__init__(self, ircobj)
+                self.messages = []
+
+            def on_pubmsg(self, connection, event):
+                self.messages.append(event.arguments()[0])
+
+        first = Client(self.irc)
+        second = Client(self.irc)
+        self.assertTrue(first.ircobj is second.ircobj)
+        self.irc._handle_event(first.connection,
+                               irclib.Event("pubmsg", "n!u@h", "#c", ["a"]))
+        self.irc._handle_event(second.connection,
+                               irclib.Event("pubmsg", "n!u@h", "#c", ["b"]))
+        self.assertEqual(first.messages, ["a"])
+        self.assertEqual(second.messages, ["b"])
+
+    def test_simple_client_close(self):
+        class Client(irclib.SimpleIRCClient):
+            def on_pubmsg(self, connection, event):
+                pass
+
+        Client(self.irc).close()
+        self.assertEqual(self.irc.connections, [])
+        self.assertFalse(self.irc.has_subscribers("pubmsg"))
+        self.assertFalse(self.irc.has_subscribers("dcc_disconnect"))
+
+
+class TestDispatch(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC()
+        self.calls = []
+
+    def first(self, connection, event):
+        self.calls.append("first")
+
+    def second(self, connection, event):
+        self.calls.append("second")
+        return "NO MORE"
+
+    def third(self, connection, event):
+        self.calls.append("third")
+
+    def test_priority_and_no_more(self):
+        self.irc.add_global_handler("join", self.third, 5)
+        self.irc.add_global_handler("join", self.second, 1)
+        self.irc.add_global_handler("all_events", self.first, 10)
+        self.irc._handle_event(None, irclib.Event("join", "n!u@h", "#c"))
+        self.assertEqual(self.calls, ["first", "second"])
+
+    def test_table_invalidated(self):
+        event = irclib.Event("join", "n!u@h", "#c")
+        self.irc.add_global_handler("join", self.first)
+        self.irc._handle_event(None, event)
+        self.irc.add_global_handler("join", self.third)
+        self.irc._handle_event(None, event)
+        self.irc.remove_global_handler("join", self.first)
+        self.irc._handle_event(None, event)
+        self.assertEqual(self.calls, ["first", "first", "third", "third"])
+
+
+class TestEvent(unittest.TestCase):
+    def test_accessors(self):
+        event = irclib.Event("pubmsg", "nick!user@host", "#chan", ["hi"],
+                             {"time": "now"})
+        self.assertEqual(event.eventtype(), "pubmsg")
+        self.assertEqual(event.source(), "nick!user@host")
+        self.assertEqual(event.target(), "#chan")
+        self.assertEqual(event.arguments(), ["hi"])
+        self.assertEqual(event.tags(), {"time": "now"})
+
+    def test_defaults(self):
+        event = irclib.Event("ping", None, "irc.example.net")
+        self.assertEqual(event.arguments(), [])
+        self.assertEqual(event.tags(), {})
+        self.assertEqual(event.source_nick(), None)
+
+    def test_slots(self):
+        event = irclib.Event("join", "nick!user@host", "#chan")
+        self.assertFalse(hasattr(event, "__dict__"))
+
+    def test_interned(self):
+        a = irclib.Event("join", "nick!user@host", "".join(["#", "chan"]))
+        b = irclib.Event("part", "nick!user@host", "".join(["#", "chan"]))
+        self.assertTrue(a.target() is b.target())
+        self.assertEqual(a.source_nick(), "nick")
+        self.assertTrue(a.source_nick() is b.source_nick())
+
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.connection, self.peer = connect_server(self.irc)
+        self.peer.settimeout(5)
+
+    def tearDown(self):
+        self.peer.close()
+
+    def read_lines(self, count):
+        data = ""
+        while data.count("\r\n") < count:
+            data += self.peer.recv(2 ** 16)
+        return data.split("\r\n")[:count]
+
+    def test_send_raw(self):
+        self.read_lines(2)
+        self.connection.privmsg("#chan", "hello")
+        self.assertEqual(self.connection.get_send_queue_depth(), 0)
+        self.assertEqual(self.read_lines(1), ["PRIVMSG #chan :hello"])
+
+    def test_send_unicode(self):
+        self.read_lines(2)
+        self.connection.privmsg("#chan", u"caf\xe9 ok")
+        self.connection.privmsg("#chan", "plain")
+        self.assertEqual(self.connection.get_send_queue_depth(), 0)
+        self.assertEqual(self.read_lines(2), ["PRIVMSG #chan :caf\xc3\xa9 ok",
+                                              "PRIVMSG #chan :plain"])
+
+    def test_queues_when_socket_full(self):
+        self.read_lines(2)
+        self.connection.socket.setsockopt(socket.SOL_SOCKET,
+                                          socket.SO_SNDBUF, 4096)
+        line = "x" * 400
+        for i in range(2000):
+            self.connection.privmsg("#chan", line)
+        self.assertTrue(self.connection.get_send_queue_depth() > 0)
+        self.assertTrue(self.connection.get_send_pending_bytes() > 0)
+
+        received = 0
+        while received < 2000:
+            self.irc.process_once(0.1)
+            received += self.peer.recv(2 ** 16).count("\n")
+        self.irc.process_once(0)
+        self.assertEqual(self.connection.get_send_queue_depth(), 0)
+        self.assertEqual(self.connection.get_send_pending_bytes(), 0)
+
+    def test_replies_sent_after_handlers(self):
+        self.read_lines(2)
+        self.irc.add_global_handler(
+            "pubmsg", lambda c, e: c.privmsg("#chan", "pong"))
+        self.peer.sendall(":a!u@h PRIVMSG #chan :ping\r\n" * 3)
+        self.irc.process_once(1)
+        self.assertEqual(self.read_lines(3), ["PRIVMSG #chan :pong"] * 3)
+
+
+class TestFloodControl(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.connection, self.peer = connect_server(self.irc)
+        self.peer.settimeout(5)
+        self.sent = []
+        self.connection._queue_line = self.sent.append
+
+    def tearDown(self):
+        self.peer.close()
+
+    def test_burst(self):
+        self.connection.set_flood_control(0.001, 2)
+        for i in range(4):
+            self.connection.privmsg("#chan", str(i))
+        self.assertEqual(self.sent, ["PRIVMSG #chan :0", "PRIVMSG #chan :1"])
+        self.assertEqual(self.connection.get_flood_queue_depth(), 2)
+
+    def test_protocol_bypasses_bucket(self):
+        self.connection.set_flood_control(0.001, 1)
+        self.connection.privmsg("#chan", "a")
+        self.connection.privmsg("#chan", "b")
+        self.connection.pong("irc.example.net")
+        self.assertEqual(self.sent, ["PRIVMSG #chan :a",
+                                     "PONG irc.example.net"])
+
+    def test_priority_and_fairness(self):
+        self.connection.set_flood_control(0.001, 1)
+        self.connection.privmsg("#a", "first")
+        self.connection.notice("#b", "bulk", irclib.PRIORITY_BULK)
+        for i in range(3):
+            self.connection.privmsg("#a", str(i))
+        self.connection.privmsg("#c", "c")
+        del self.sent[:]
+
+        self.connection.flood_burst = self.connection._flood_tokens = 5
+        self.connection._flood_timer.cancel()
+        self.connection._drain_flood_queue()
+        self.assertEqual(self.sent, ["PRIVMSG #a :0", "PRIVMSG #c :c",
+                                     "PRIVMSG #a :1", "PRIVMSG #a :2",
+                                     "NOTICE #b :bulk"])
+        self.assertEqual(self.connection.get_flood_queue_depth(), 0)
+
+    def test_drained_by_timer(self):
+        self.connection.set_flood_control(50, 1)
+        for i in range(3):
+            self.connection.privmsg("#chan", str(i))
+        deadline = time.time() + 5
+        while len(self.sent) < 3 and time.time() < deadline:
+            self.irc.process_once(0.1)
+        self.assertEqual(self.sent, ["PRIVMSG #chan :%d" % i
+                                     for i in range(3)])
+
+    def test_disable(self):
+        self.connection.set_flood_control(0.001, 1)
+        self.connection.privmsg("#chan", "a")
+        self.connection.privmsg("#chan", "b")
+        self.connection.set_flood_control(None)
+        self.connection.privmsg("#chan", "c")
+        self.assertEqual(self.sent, ["PRIVMSG #chan :a", "PRIVMSG #chan :b",
+                                     "PRIVMSG #chan :c"])
+
+    def test_zero_rate_disables(self):
+        self.connection.set_flood_control(0, 1)
+        self.assertEqual(self.connection.flood_rate, None)
+        for i in range(3):
+            self.connection.privmsg("#chan", str(i))
+        self.assertEqual(self.sent, ["PRIVMSG #chan :%d" % i
+                                     for i in range(3)])
+        self.assertEqual(self.connection.get_flood_queue_depth(), 0)
+
+
+class TestMessageSplitting(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.connection, self.peer = connect_server(self.irc)
+        self.sent = []
+        self.connection._queue_line = self.sent.append
+
+    def tearDown(self):
+        self.peer.close()
+
+    def test_split_words(self):
+        self.assertEqual(irclib.split_message("aaa bbb ccc", 7),
+                         ["aaa bbb", "ccc"])
+        self.assertEqual(irclib.split_message("short", 7), ["short"])
+
+    def test_split_utf8(self):
+        text = "\xc3\xa9" * 5
+        pieces = irclib.split_message(text, 5)
+        self.assertEqual(pieces, ["\xc3\xa9\xc3\xa9", "\xc3\xa9\xc3\xa9",
+                                  "\xc3\xa9"])
+        for piece in pieces:
+            piece.decode("utf-8")
+
+    def test_split_unicode(self):
+        self.assertEqual(irclib.split_message(u"a" * 300, 100),
+                         [u"a" * 100] * 3)
+        pieces = irclib.split_message(u"\xe9" * 5, 5)
+        self.assertEqual(pieces, [u"\xe9\xe9", u"\xe9\xe9", u"\xe9"])
+
+    def test_privmsg_fits_line(self):
+        self.connection.real_userhost = "user@host.example.net"
+        text = " ".join(["word"] * 200)
+        self.connection.privmsg("#chan", text)
+        self.assertTrue(len(self.sent) > 1)
+        mask = ":bot!user@host.example.net "
+        for line in self.sent:
+            self.assertTrue(len(mask + line + "\r\n") <= 512)
+        self.assertEqual(" ".join(line.split(" :", 1)[1]
+                                  for line in self.sent), text)
+
+    def test_ctcp_not_split(self):
+        self.connection.ctcp("ACTION", "#chan", "x" * 600)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_userhost_from_welcome(self):
+        self.connection.features["USERLEN"] = "12"
+        self.assertEqual(len(self.connection.get_nickmask()),
+                         len("bot!") + 13 + 1 + 63)
+        self.peer.sendall(":irc.example.net 001 bot :Welcome bot!u@h\r\n")
+        self.irc.process_once(1)
+        self.assertEqual(self.connection.get_nickmask(), "bot!u@h")
+
+    def test_featurelist(self):
+        self.peer.sendall(":irc.example.net 005 bot NETWORK=Example "
+                          "TARGMAX=PRIVMSG:3,JOIN: SAFELIST "
+                          ":are supported by this server\r\n")
+        self.irc.process_once(1)
+        self.assertEqual(self.connection.features["NETWORK"], "Example")
+        self.assertEqual(self.connection.features["SAFELIST"], None)
+        self.assertEqual(self.connection.get_target_limit("PRIVMSG"), 3)
+        self.assertEqual(self.connection.get_target_limit("JOIN"), None)
+        self.assertEqual(self.connection.get_target_limit("KICK"), 1)
+
+    def test_privmsg_many(self):
+        self.connection.features["TARGMAX"] = "PRIVMSG:2"
+        self.connection.privmsg_many(["#a", "#b", "#c"], "hi")
+        self.assertEqual(self.sent, ["PRIVMSG #a,#b :hi", "PRIVMSG #c :hi"])
+
+    def test_privmsg_many_keeps_room_for_text(self):
+        self.connection.features["TARGMAX"] = "PRIVMSG:"
+        channels = ["#channel%d" % i for i in range(60)]
+        text = "x" * self.connection.min_text_length
+        self.connection.privmsg_many(channels, text)
+        self.assertTrue(len(self.sent) > 1)
+        mask = ":%s " % self.connection.get_nickmask()
+        targets = []
+        for line in self.sent:
+            self.assertTrue(len(mask + line + "\r\n") <= 512)
+            line_targets, line_text = line[len("PRIVMSG "):].split(" :", 1)
+            self.assertEqual(line_text, text)
+            targets.extend(line_targets.split(","))
+        self.assertEqual(targets, channels)
+
+    def test_join_many(self):
+        self.connection.join_many({"#a": "", "#b": "key", "#c": ""})
+        self.assertEqual(len(self.sent), 1)
+        self.assertTrue(self.sent[0].startswith("JOIN #b,"))
+        self.assertTrue(self.sent[0].endswith(" key"))
+        self.assertEqual(sorted(self.sent[0].split()[1].split(",")),
+                         ["#a", "#b", "#c"])
+
+    def test_join_many_fits_line(self):
+        channels = ["#channel%03d" % i for i in range(100)]
+        self.connection.join_many(channels)
+        self.assertTrue(len(self.sent) > 1)
+        for line in self.sent:
+            self.assertTrue(len(line + "\r\n") <= 512)
+        self.assertEqual(sorted(",".join(line[5:] for line in self.sent)
+                                .split(",")), channels)
+
+    def test_join_many_limits(self):
+        self.connection.features["TARGMAX"] = "JOIN:2"
+        self.connection.features["CHANLIMIT"] = "#:3,&:"
+        self.connection.channels["#joined"] = None
+        left_out = self.connection.join_many(["#a", "#b", "#c", "&d"])
+        self.assertEqual(len(left_out), 1)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(len(self.sent[0].split()[1].split(",")), 2)
+        self.assertTrue("&d" in self.sent[1])
+        self.assertEqual(self.connection.get_channel_limit("&x"), None)
+        self.assertEqual(self.connection.get_channel_limit("+x"), None)
+
+
+class TestConnect(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.disconnects = []
+        self.irc.add_global_handler(
+            "disconnect", lambda c, e: self.disconnects.append(e))
+
+    def tearDown(self):
+        self.listener.close()
+
+    def run_until(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            self.irc.process_once(0.1)
+
+    def test_interleave_addresses(self):
+        infos = [(socket.AF_INET6, 1, 6, "", ("::1", 1, 0, 0)),
+                 (socket.AF_INET6, 1, 6, "", ("::2", 1, 0, 0)),
+                 (socket.AF_INET, 1, 6, "", ("10.0.0.1", 1)),
+                 (socket.AF_INET, 1, 6, "", ("10.0.0.1", 1))]
+        self.assertEqual(
+            [address[0] for family, address in
+             irclib._interleave_addresses(infos)],
+            ["::1", "10.0.0.1", "::2"])
+
+    def test_resolve_in_thread(self):
+        connection = self.irc.server()
+        connection.connect("localhost", self.port, "bot")
+        self.assertFalse(connection.is_established())
+        self.run_until(connection.is_established)
+        self.assertTrue(connection.is_established())
+        self.assertTrue("dns" in connection.connect_timings)
+        self.assertTrue("tcp" in connection.connect_timings)
+
+    def test_registration_queued(self):
+        connection = self.irc.server()
+        connection.connect("127.0.0.1", self.port, "bot", password="secret")
+        connection.join("#chan")
+        peer, _addr = self.listener.accept()
+        peer.settimeout(5)
+        self.run_until(connection.is_established)
+        data = ""
+        while data.count("\n") < 4:
+            data += peer.recv(512)
+        self.assertEqual(data.split("\r\n")[:4],
+                         ["PASS secret", "NICK bot", "USER bot 0 * :bot",
+                          "JOIN #chan"])
+        peer.close()
+
+    def test_refused(self):
+        self.listener.close()
+        connection = self.irc.server()
+        connection.connect("127.0.0.1", self.port, "bot")
+        self.run_until(lambda: self.disconnects)
+        self.assertEqual(len(self.disconnects), 1)
+        self.assertFalse(connection.is_connected())
+        self.assertEqual(self.irc.fd_to_connection, {})
+
+    def test_disconnect_while_connecting(self):
+        connection = self.irc.server()
+        connection.connect("localhost", self.port, "bot")
+        connection.disconnect("bye")
+        self.assertFalse(connection.is_connected())
+        self.assertEqual(self.disconnects[0].arguments(), ["bye"])
+        self.irc.process_once(0.2)
+        self.assertFalse(connection.is_connected())
+
+    def test_external_loop(self):
+        sockets = []
+        irc = irclib.IRC(sockets.append, sockets.remove)
+        connection = irc.server()
+        connection.connect("127.0.0.1", self.port, "bot")
+        self.assertTrue(connection.is_established())
+        self.assertEqual(sockets, [connection.socket])
+        connection.disconnect()
+
+
+class TestSSLContext(unittest.TestCase):
+    def test_create_ssl_context(self):
+        context = irclib.create_ssl_context(ciphers="HIGH")
+        self.assertEqual(context.verify_mode, ssl.CERT_NONE)
+
+    def test_verify(self):
+        context = irclib.create_ssl_context(verify=True)
+        self.assertEqual(context.verify_mode, ssl.CERT_REQUIRED)
+
+    def test_context_kept_for_reconnects(self):
+        irc = irclib.IRC(poller="select")
+        connection = irc.server()
+        connection.connect("localhost", 1, "bot", ssl=True)
+        context = connection.ssl_context
+        self.assertTrue(context is not None)
+        connection.disconnect()
+        connection.connect("localhost", 1, "bot", ssl=True)
+        self.assertTrue(connection.ssl_context is context)
+        connection.disconnect()
+
+
+class TestMasks(unittest.TestCase):
+    def test_mask_matches(self):
+        self.assertTrue(irclib.mask_matches("Nick!user@host", "nick!*@*"))
+        self.assertTrue(irclib.mask_matches("nick[a]!u@h", "NICK{A}!?@h"))
+        self.assertTrue(irclib.mask_matches("a.b!u@h", "a.b!u@h"))
+        self.assertFalse(irclib.mask_matches("axb!u@h", "a.b!u@h"))
+        self.assertFalse(irclib.mask_matches("nick!user@host2", "*!*@host"))
+
+    def test_mask_matches_whole_nickmask(self):
+        # Trailing text past the mask used to be ignored.
+        self.assertFalse(irclib.mask_matches("nick!user@host.evil",
+                                             "*!*@host"))
+        self.assertFalse(irclib.mask_matches("abz", "a*b"))
+        self.assertTrue(irclib.mask_matches("abz", "a*b*"))
+        masks = irclib.MaskSet(["*!*@host", "a*b"])
+        self.assertFalse(masks.matches("nick!user@host.evil"))
+        self.assertFalse(masks.matches("abz"))
+
+    def test_cache_bounded(self):
+        for i in range(irclib._mask_cache_size + 10):
+            irclib.mask_matches("nick!u@h", "*!*@host%d" % i)
+        self.assertEqual(len(irclib._mask_cache), irclib._mask_cache_size)
+        self.assertFalse("*!*@host0" in irclib._mask_cache)
+
+    def test_mask_set(self):
+        masks = ["*!*@host.example", "Nick!*@*", "a?c!u@h", "*bad*",
+                 "exact!u@h"]
+        mask_set = irclib.MaskSet(masks)
+        for nick in ["x!y@host.example", "nick!a@b", "abc!u@h", "xbadx!u@h",
+                     "EXACT!u@h", "no!u@h", "nick2!a@b", "x!y@ahost.example",
+                     "a!b@c"]:
+            self.assertEqual(mask_set.matches(nick),
+                             any(irclib.mask_matches(nick, mask)
+                                 for mask in masks), nick)
+
+    def test_mask_set_discard(self):
+        mask_set = irclib.MaskSet(["*bad*", "*!*@host", "exact!u@h"])
+        self.assertTrue(mask_set.matches("xbadx!u@h"))
+        mask_set.discard("*bad*")
+        mask_set.discard("exact!u@h")
+        self.assertFalse(mask_set.matches("xbadx!u@h"))
+        self.assertFalse(mask_set.matches("exact!u@h"))
+        self.assertTrue(mask_set.matches("a!b@host"))
+        self.assertEqual(len(mask_set), 1)
+        self.assertTrue("*!*@host" in mask_set)
+
+
+class TestIRCDict(unittest.TestCase):
+    def test_casemapping(self):
+        d = irclib.IRCDict()
+        d["#Chan[1]"] = "key"
+        self.assertEqual(d["#chan{1}"], "key")
+        self.assertTrue("#CHAN[1]" in d)
+        d["#chan{1}"] = "other"
+        self.assertEqual(list(d), ["#Chan[1]"])
+        self.assertEqual(d.canonical_key("#CHAN{1}"), "#Chan[1]")
+        del d["#CHAN[1]"]
+        self.assertEqual(len(d), 0)
+
+    def test_ascii(self):
+        d = irclib.IRCDict({"Nick[": 1}, casemapping="ascii")
+        self.assertTrue("nick[" in d)
+        self.assertFalse("nick{" in d)
+        d.set_casemapping("rfc1459")
+        self.assertTrue("nick{" in d)
+
+    def test_strict_rfc1459(self):
+        self.assertEqual(irclib.irc_lower("A[]\\^", "strict-rfc1459"),
+                         "a{}|^")
+        self.assertEqual(irclib.irc_lower("A[]\\^"), "a{}|~")
+
+    def test_set(self):
+        s = irclib.IRCSet(["Nick!ident"])
+        self.assertTrue("nick!ident" in s)
+        s.add("NICK!ident")
+        self.assertEqual(len(s), 1)
+        s.discard("nick!IDENT")
+        self.assertEqual(len(s), 0)
+
+    def test_server_casemapping(self):
+        connection = irclib.IRC().server()
+        self.assertEqual(connection.get_casemapping(), "rfc1459")
+        connection.features["CASEMAPPING"] = "ascii"
+        self.assertEqual(connection.get_casemapping(), "ascii")
+        connection.features["CASEMAPPING"] = "unknown"
+        self.assertEqual(connection.get_casemapping(), "rfc1459")
+
+
+class TestChannelTracking(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.connection, self.peer = connect_server(self.irc)
+
+    def tearDown(self):
+        self.peer.close()
+
+    def feed(self, *lines):
+        self.peer.sendall("".join(line + "\r\n" for line in lines))
+        self.irc.process_once(1)
+
+    def join(self):
+        self.feed(":bot!u@h JOIN #Chan",
+                  ":srv 353 bot = #chan :@Op +Voice plain bot",
+                  ":srv 366 bot #chan :End of /NAMES list.")
+        return self.connection.channels["#CHAN"]
+
+    def test_names(self):
+        channel = self.join()
+        self.assertTrue(channel.synced)
+        self.assertEqual(sorted(channel.users()),
+                         ["Op", "Voice", "bot", "plain"])
+        self.assertTrue(channel.is_oper("op"))
+        self.assertTrue(channel.is_voiced("VOICE"))
+        self.assertFalse(channel.is_oper("plain"))
+        self.assertEqual(channel.user_modes("nobody"), None)
+
+    def test_join_part_kick_quit(self):
+        channel = self.join()
+        self.feed(":new!u@h JOIN #chan", ":plain!u@h PART #chan",
+                  ":Op!u@h KICK #chan Voice :bye", ":new!u@h QUIT :gone")
+        self.assertEqual(sorted(channel.users()), ["Op", "bot"])
+        self.assertEqual(sorted(self.connection._nick_names),
+                         ["bot", "op"])
+
+    def test_nick(self):
+        channel = self.join()
+        self.feed(":Op!u@h NICK Boss")
+        self.assertTrue(channel.is_oper("boss"))
+        self.assertFalse("op" in channel)
+        self.assertTrue("Boss" in channel.users())
+
+    def test_modes(self):
+        channel = self.join()
+        self.feed(":Op!u@h MODE #chan +ov-o+lk-v plain plain Op 10 key Voice")
+        self.assertEqual(channel.user_modes("plain"), "ov")
+        self.assertFalse(channel.is_oper("Op"))
+        self.assertFalse(channel.is_voiced("Voice"))
+        self.assertEqual(channel.modes, {"l": "10", "k": "key"})
+        self.feed(":Op!u@h MODE #chan -l+b *!*@h")
+        self.assertEqual(channel.modes, {"k": "key"})
+
+    def test_own_part(self):
+        self.join()
+        self.feed(":bot!u@h PART #chan")
+        self.assertEqual(len(self.connection.channels), 0)
+        self.assertEqual(self.connection._nick_names, {})
+
+    def test_members_interned(self):
+        self.join()
+        self.feed(":bot!u@h JOIN #other", ":plain!u@h JOIN #other")
+        first = [n for n in self.connection.channels["#chan"]._members
+                 if n == "plain"][0]
+        second = [n for n in self.connection.channels["#other"]._members
+                  if n == "plain"][0]
+        self.assertTrue(first is second)
+
+
+class TestKeepalive(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.connection, self.peer = connect_server(self.irc)
+        self.peer.settimeout(5)
+        self.disconnects = []
+        self.irc.add_global_handler(
+            "disconnect", lambda c, e: self.disconnects.append(e))
+
+    def tearDown(self):
+        self.peer.close()
+
+    def read_line(self):
+        data = ""
+        while not data.endswith("\n"):
+            data += self.peer.recv(1)
+        return data.rstrip("\r\n")
+
+    def test_ping_and_lag(self):
+        self.read_line()
+        self.read_line()
+        self.connection.keepalive_interval = 0
+        self.connection._keepalive()
+        line = self.read_line()
+        self.assertTrue(line.startswith("PING LAG"))
+        self.peer.sendall(":srv PONG srv :%s\r\n" % line.split(" ")[1])
+        self.irc.process_once(1)
+        lag = self.connection.get_lag()
+        self.assertTrue(lag is not None and lag >= 0)
+
+    def test_quiet_server_disconnected(self):
+        self.connection.keepalive_interval = 0
+        self.connection.keepalive_timeout = 0
+        self.connection._keepalive()
+        self.connection._keepalive()
+        self.assertEqual(self.disconnects[0].arguments(), ["Ping timeout"])
+
+    def test_traffic_keeps_alive(self):
+        self.connection.keepalive_interval = 0
+        self.connection.keepalive_timeout = 60
+        self.connection._keepalive()
+        self.connection.keepalive_interval = 60
+        self.peer.sendall(":srv NOTICE bot :hi\r\n")
+        self.irc.process_once(1)
+        self.connection._keepalive()
+        self.assertEqual(self.disconnects, [])
+        self.assertTrue(self.connection.is_connected())
+
+    def test_idle_loop_sleeps(self):
+        # Only the keepalive timer is pending.
+        self.assertTrue(self.irc._next_timeout(None) > 30)
+
+
+class TestDCCSend(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.connection, self.peer = connect_server(self.irc)
+        self.peer.settimeout(5)
+        self.data = "".join(chr(i % 251) for i in xrange(200000))
+        self.file = tempfile.NamedTemporaryFile()
+        self.file.write(self.data)
+        self.file.flush()
+        self.disconnects = []
+        self.irc.add_global_handler(
+            "dcc_disconnect", lambda c, e: self.disconnects.append(e))
+
+    def tearDown(self):
+        self.peer.close()
+        self.file.close()
+
+    def read_ctcp(self):
+        data = ""
+        while "\001\r\n" not in data:
+            data += self.peer.recv(1)
+        return data.split("\001")[-2].split(" ")
+
+    def receive(self, port, size, ack=True):
+        client = socket.create_connection(("127.0.0.1", port))
+        client.setblocking(0)
+        data = ""
+        deadline = time.time() + 10
+        while len(data) < size and time.time() < deadline:
+            self.irc.process_once(0.05)
+            try:
+                data += client.recv(2 ** 16)
+            except socket.error:
+                pass
+        if ack:
+            client.sendall(struct.pack("!I", size))
+        return client, data
+
+    def test_send_file(self):
+        transfer = self.irc.dcc_send(self.file.name)
+        transfer.offer(self.connection, "friend")
+        ctcp = self.read_ctcp()
+        self.assertEqual(ctcp[:2], ["DCC", "SEND"])
+        self.assertEqual(ctcp[2], os.path.basename(self.file.name))
+        self.assertEqual(ctcp[3], irclib.ip_quad_to_numstr("127.0.0.1"))
+        self.assertEqual(int(ctcp[5]), len(self.data))
+        client, data = self.receive(int(ctcp[4]), len(self.data))
+        self.assertEqual(data, self.data)
+        self.irc.process_once(1)
+        client.close()
+        self.assertTrue(transfer.is_complete())
+        self.assertEqual(self.disconnects[0].arguments(),
+                         ["Transfer complete"])
+
+    def test_resume(self):
+        transfer = self.irc.dcc_send(self.file.name)
+        transfer.offer(self.connection, "friend", name="file.bin")
+        port = int(self.read_ctcp()[4])
+        self.peer.sendall(":friend!u@h PRIVMSG bot :"
+                          "\001DCC RESUME file.bin %d 150000\001\r\n" % port)
+        self.irc.process_once(1)
+        self.assertEqual(self.read_ctcp(),
+                         ["DCC", "ACCEPT", "file.bin", str(port), "150000"])
+        client, data = self.receive(port, 50000)
+        client.close()
+        self.assertEqual(data, self.data[150000:])
+
+    def test_resume_from_other_nick_ignored(self):
+        transfer = self.irc.dcc_send(self.file.name)
+        transfer.offer(self.connection, "friend", name="file.bin")
+        port = int(self.read_ctcp()[4])
+        self.peer.sendall(":stranger!u@h PRIVMSG bot :"
+                          "\001DCC RESUME file.bin %d 150000\001\r\n" % port)
+        self.irc.process_once(1)
+        self.assertEqual(transfer.position, 0)
+
+    def test_concurrent_transfers_with_rate(self):
+        slow = self.irc.dcc_send(self.file.name, rate=100000)
+        slow.offer(self.connection, "friend")
+        fast = self.irc.dcc_send(self.file.name)
+        fast.offer(self.connection, "friend")
+        slow_port = int(self.read_ctcp()[4])
+        fast_port = int(self.read_ctcp()[4])
+        slow_client = socket.create_connection(("127.0.0.1", slow_port))
+        start = time.time()
+        fast_client, data = self.receive(fast_port, len(self.data))
+        self.assertEqual(data, self.data)
+        self.assertFalse(slow.is_complete())
+        slow_client.close()
+        fast_client.close()
+        self.irc.process_once(0.1)
+        self.irc.process_once(0.1)
+        self.assertEqual(len(self.disconnects), 2)
+        # 200000 bytes at 100000 bytes per second take over a second.
+        self.assertTrue(time.time() - start < 1)
+
+    def test_offer_times_out(self):
+        transfer = self.irc.dcc_send(self.file.name)
+        transfer.offer_timeout = 0
+        transfer.offer(self.connection, "friend")
+        self.irc.process_once(0.1)
+        self.assertEqual(self.disconnects[0].arguments(),
+                         ["DCC SEND offer timed out"])
+        self.assertFalse(transfer in self.irc.connections)
+
+
+
+class TestCapabilities(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.connection = self.irc.server()
+        self.peer = None
+        self.data = ""
+
+    def tearDown(self):
+        if self.peer is not None:
+            self.peer.close()
+
+    def connect(self, **kwargs):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.connection.connect("127.0.0.1", listener.getsockname()[1], "bot",
+                                capabilities=irclib.supported_capabilities,
+                                **kwargs)
+        self.peer, _addr = listener.accept()
+        listener.close()
+        self.peer.settimeout(5)
+
+    def feed(self, *lines):
+        self.peer.sendall("".join(line + "\r\n" for line in lines))
+        self.irc.process_once(1)
+
+    def read_lines(self, count):
+        while self.data.count("\r\n") < count:
+            self.irc.process_once(0.1)
+            self.data += self.peer.recv(2 ** 16)
+        lines = self.data.split("\r\n")
+        self.data = "\r\n".join(lines[count:])
+        return lines[:count]
+
+    def test_negotiation(self):
+        self.connect()
+        self.assertEqual(self.read_lines(3), ["CAP LS 302", "NICK bot",
+                                              "USER bot 0 * :bot"])
+        self.feed(":srv CAP * LS * :multi-prefix sasl",
+                  ":srv CAP * LS :batch server-time=x away-notify")
+        self.assertEqual(self.read_lines(1),
+                         ["CAP REQ :batch multi-prefix server-time"])
+        self.assertEqual(self.connection.server_capabilities["server-time"],
+                         "x")
+        self.feed(":srv CAP bot ACK :batch multi-prefix server-time")
+        self.assertEqual(self.read_lines(1), ["CAP END"])
+        self.assertEqual(self.connection.capabilities,
+                         set(["batch", "multi-prefix", "server-time"]))
+        self.feed(":srv CAP bot DEL :batch")
+        self.assertEqual(self.connection.capabilities,
+                         set(["multi-prefix", "server-time"]))
+
+    def test_refused(self):
+        self.connect()
+        self.read_lines(3)
+        self.feed(":srv CAP * LS :multi-prefix")
+        self.assertEqual(self.read_lines(1), ["CAP REQ :multi-prefix"])
+        self.feed(":srv CAP bot NAK :multi-prefix")
+        self.assertEqual(self.read_lines(1), ["CAP END"])
+        self.assertEqual(self.connection.capabilities, set())
+
+    def test_nothing_wanted(self):
+        self.connect()
+        self.read_lines(3)
+        self.feed(":srv CAP * LS :away-notify")
+        self.assertEqual(self.read_lines(1), ["CAP END"])
+
+    def test_sasl_plain(self):
+        self.connect(sasl_mechanism="plain", sasl_password="secret")
+        self.read_lines(3)
+        self.feed(":srv CAP * LS :sasl=PLAIN,EXTERNAL multi-prefix")
+        self.assertEqual(self.read_lines(1),
+                         ["CAP REQ :multi-prefix sasl"])
+        self.feed(":srv CAP bot ACK :multi-prefix sasl")
+        self.assertEqual(self.read_lines(1), ["AUTHENTICATE PLAIN"])
+        self.feed("AUTHENTICATE +")
+        self.assertEqual(self.read_lines(1), ["AUTHENTICATE %s" %
+                         base64.b64encode("bot\0bot\0secret")])
+        self.feed(":srv 900 bot bot!u@h bot :You are now logged in as bot",
+                  ":srv 903 bot :SASL authentication successful")
+        self.assertEqual(self.read_lines(1), ["CAP END"])
+        self.assertTrue(self.connection.sasl_authenticated)
+        self.assertTrue("sasl" in self.connection.connect_timings)
+
+    def test_sasl_external(self):
+        self.connect(sasl_mechanism="EXTERNAL")
+        self.read_lines(3)
+        self.feed(":srv CAP * LS :sasl")
+        self.feed(":srv CAP bot ACK :sasl", "AUTHENTICATE +")
+        self.assertEqual(self.read_lines(3),
+                         ["CAP REQ :sasl", "AUTHENTICATE EXTERNAL",
+                          "AUTHENTICATE +"])
+
+    def test_sasl_failed(self):
+        self.connect(sasl_mechanism="PLAIN", sasl_password="wrong")
+        self.read_lines(3)
+        self.feed(":srv CAP * LS :sasl", ":srv CAP bot ACK :sasl",
+                  "AUTHENTICATE +")
+        self.read_lines(3)
+        self.feed(":srv 904 bot :SASL authentication failed")
+        self.assertEqual(self.read_lines(1), ["CAP END"])
+        self.assertFalse(self.connection.sasl_authenticated)
+
+    def test_sasl_mechanism_not_offered(self):
+        self.connect(sasl_mechanism="EXTERNAL")
+        self.read_lines(3)
+        self.feed(":srv CAP * LS :sasl=PLAIN")
+        self.assertEqual(self.read_lines(1), ["CAP END"])
+
+
+class TestBatches(unittest.TestCase):
+    def setUp(self):
+        self.irc = irclib.IRC(poller="select")
+        self.connection, self.peer = connect_server(self.irc)
+        self.joins = []
+        self.batches = []
+        self.irc.add_global_handler("join", lambda c, e: self.joins.append(e))
+        self.irc.add_global_handler(
+            "batch", lambda c, e: self.batches.append(e.batch()))
+
+    def tearDown(self):
+        self.peer.close()
+
+    def feed(self, *lines):
+        self.peer.sendall("".join(line + "\r\n" for line in lines))
+        self.irc.process_once(1)
+
+    def test_held_until_end(self):
+        self.feed(":srv BATCH +1 netjoin irc.a irc.b",
+                  "@batch=1 :a!u@h JOIN #chan", "@batch=1 :b!u@h JOIN #chan",
+                  ":c!u@h JOIN #chan")
+        self.assertEqual([e.source_nick() for e in self.joins], ["c"])
+        self.feed(":srv BATCH -1")
+        self.assertEqual([e.source_nick() for e in self.joins],
+                         ["c", "a", "b"])
+        batch = self.batches[0]
+        self.assertEqual((batch.type, batch.parameters, len(batch.events)),
+                         ("netjoin", ["irc.a", "irc.b"], 2))
+
+    def test_handled_in_bulk(self):
+        def take_all(connection, event):
+            event.batch().handled = True
+        self.irc.add_global_handler("batch", take_all)
+        self.feed(":srv BATCH +x netsplit irc.a irc.b",
+                  "@batch=x :a!u@h QUIT :irc.a irc.b",
+                  "@batch=x;time=2012-06-01T12:30:45Z :b!u@h JOIN #chan",
+                  ":srv BATCH -x")
+        self.assertEqual(self.joins, [])
+        self.assertEqual(len(self.batches[0].events), 1)
+
+    def test_nested(self):
+        self.feed(":srv BATCH +outer netjoin irc.a irc.b",
+                  "@batch=outer :srv BATCH +inner netjoin irc.c irc.d",
+                  "@batch=inner :a!u@h JOIN #chan",
+                  "@batch=outer :srv BATCH -inner")
+        self.assertEqual(self.joins, [])
+        self.feed(":srv BATCH -outer")
+        self.assertEqual(len(self.joins), 1)
+        self.assertEqual([batch.reference for batch in self.batches],
+                         ["outer", "inner"])
+
+    def test_server_time(self):
+        event = irclib.Event("pubmsg", "a!u@h", "#chan", ["hi"],
+                             {"time": "2012-06-01T12:30:45.250Z"})
+        self.assertEqual(event.server_time(), 1338553845.25)
+        self.assertEqual(irclib.Event("pubmsg", "a!u@h", "#chan",
+                                      ["hi"]).server_time(), None)
+
+class TestFakeIRCd(unittest.TestCase):
+    def setUp(self):
+        self.server = fakeircd.FakeIRCd()
+        self.server.start()
+        self.irc = irclib.IRC(poller="select")
+        self.events = []
+        for event in ("welcome", "join", "pubmsg", "privmsg"):
+            self.irc.add_global_handler(
+                event, lambda c, e: self.events.append((c, e)))
+
+    def tearDown(self):
+        self.irc.disconnect_all()
+        self.server.stop()
+
+    def run_until(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            self.irc.process_once(0.1)
+
+    def seen(self, connection, event_type):
+        return [e for c, e in self.events
+                if c is connection and e.eventtype() == event_type]
+
+    def test_fan_out(self):
+        bot = self.irc.server()
+        bot.connect("127.0.0.1", self.server.port, "bot")
+        friend = self.irc.server()
+        friend.connect("127.0.0.1", self.server.port, "friend")
+        self.run_until(lambda: self.seen(bot, "welcome") and
+                       self.seen(friend, "welcome"))
+        bot.join("#chan")
+        self.run_until(lambda: self.seen(bot, "join"))
+        friend.privmsg("#chan", "hello")
+        friend.privmsg("bot", "psst")
+        self.run_until(lambda: self.seen(bot, "privmsg"))
+        self.assertEqual(self.seen(bot, "pubmsg")[0].arguments(), ["hello"])
+        self.assertEqual(self.seen(bot, "privmsg")[0].arguments(), ["psst"])
+        self.assertEqual(self.seen(friend, "pubmsg"), [])
+        self.assertEqual(self.server.get_channels("bot"), set(["#chan"]))
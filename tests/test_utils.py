@@ -17,6 +17,8 @@
 import os
 import unittest
 
+import eventlet
+
 from pyhole import utils
 
 
@@ -42,6 +44,31 @@ class TestUtils(unittest.TestCase):
     def test_ensure_int_3(self):
         self.assertEqual(utils.ensure_int("a"), None)
 
+    def test_spawn_keeps_network(self):
+        seen = []
+
+        class Plugin(object):
+            @utils.spawn
+            def poll(self):
+                seen.append(utils.get_network())
+
+        utils.set_network("FreeNode")
+        try:
+            Plugin().poll()
+            utils.set_network("EFnet")
+            eventlet.sleep(0)
+            self.assertEqual(seen, ["FreeNode"])
+            self.assertEqual(utils.get_network(), "EFnet")
+        finally:
+            utils.set_network(None)
+
+    def test_run_for_network_restores_network(self):
+        seen = []
+        utils.run_for_network("FreeNode", lambda: seen.append(
+                utils.get_network()))
+        self.assertEqual(seen, ["FreeNode"])
+        self.assertEqual(utils.get_network(), None)
+
     def test_build_options(self):
         options, _args = utils.build_options()
         self.assertTrue(isinstance(options, object))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Measure the memory used by channel state tracking.
+
+Joins a number of channels with a number of users each, drawn from a
+common pool of nicks (so most users share several channels), by
+feeding JOIN and NAMES replies to a ServerConnection.  Reports the
+growth of the process' resident set (Linux only) and the time
+taken.
+
+"naive" keeps the same state as a dictionary per channel from a
+lowercased nick copy to a (nick, modes) tuple, for comparison.
+
+Usage: python tools/benchmark_channels.py [channels] [users] [pool]
+"""
+
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyhole import irclib
+
+
+def rss():
+    """Resident set size in bytes (Linux)."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def make_lines(channels, users, pool):
+    rand = random.Random(42)
+    nicks = ["User%06d" % i for i in range(pool)]
+    lines = []
+    for i in range(channels):
+        name = "#channel%03d" % i
+        lines.append(":bot!bot@host JOIN %s" % name)
+        members = rand.sample(nicks, users)
+        for j in range(0, users, 50):
+            names = " ".join(rand.choice(("", "", "", "+", "@")) + nick
+                             for nick in members[j:j + 50])
+            lines.append(":srv 353 bot = %s :%s" % (name, names))
+        lines.append(":srv 366 bot %s :End of /NAMES list." % name)
+    return lines
+
+
+def connect(irc):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    connection = irc.server()
+    connection.connect("127.0.0.1", listener.getsockname()[1], "bot")
+    peer, _addr = listener.accept()
+    listener.close()
+    while not connection.is_established():
+        irc.process_once(0.1)
+    return connection, peer
+
+
+def bench_tracker(lines):
+    irc = irclib.IRC()
+    connection, peer = connect(irc)
+    data = "".join(line + "\r\n" for line in lines)
+    before = rss()
+    start = time.time()
+    connection.buffer.feed(data)
+    connection._process_lines()
+    connection.buffer = irclib.LineBuffer()
+    elapsed = time.time() - start
+    grown = rss() - before
+    members = sum(len(c) for c in connection.channels.values())
+    peer.close()
+    return members, grown, elapsed, connection
+
+
+def bench_naive(lines):
+    before = rss()
+    start = time.time()
+    channels = {}
+    for line in lines:
+        _tags, _prefix, command, arguments = irclib.parse_line(line)
+        if command == "join":
+            channels[arguments[0].lower()] = {}
+        elif command == "namreply":
+            channel = channels[arguments[2].lower()]
+            for name in arguments[3].split():
+                modes = ""
+                if name[0] in "@+":
+                    modes, name = name[0], name[1:]
+                channel[name.lower()] = (name, modes)
+    elapsed = time.time() - start
+    grown = rss() - before
+    members = sum(len(c) for c in channels.values())
+    return members, grown, elapsed, channels
+
+
+def main():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    pool = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+
+    lines = make_lines(channels, users, pool)
+    print "%d channels x %d users (%d distinct nicks)" % (channels, users,
+                                                          pool)
+    print "%-8s %10s %12s %14s %10s" % ("", "members", "rss growth",
+                                         "bytes/member", "time")
+    for name, bench in (("tracker", bench_tracker), ("naive", bench_naive)):
+        # Each run in a fresh process, so freed memory isn't reused.
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            continue
+        members, grown, elapsed, state = bench(lines)
+        print "%-8s %10d %11.1fM %14.1f %9.3fs" % (
+            name, members, grown / 1048576.0, float(grown) / members,
+            elapsed)
+        sys.stdout.flush()
+        os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""End-to-end load benchmark for the pyhole bot.
+
+The real bot, with the admin plugin loaded, runs in its own process
+against the fake IRC server from tests/fakeircd.py:
+
+  * M synthetic clients flood N channels the bot sits in with chatter,
+    at an offered rate that doubles every step.
+  * A probe client in a quiet channel of its own sends .version and
+    .help, one at a time, and times the bot's first reply line.
+
+A step is sustained while the probe's median latency stays under
+--max-latency and the server holds less than --max-backlog bytes for
+the bot at the end of it.  The ramp stops at the first step that
+isn't.  The results are written out as JSON for tracking over time.
+
+Usage: python tools/benchmark_e2e.py [options]
+"""
+
+import json
+import optparse
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+from tests import fakeircd
+from pyhole import version
+
+
+BOT_NICK = "pyhole"
+PROBE_CHANNEL = "#probe"
+# Command -> lines in its reply.
+PROBES = [(".version", 1), (".help", 3)]
+
+CONFIG = """[Pyhole]
+admins: nobody!nobody
+command_prefix: .
+reconnect_delay: 60
+rejoin_delay: 5
+debug: False
+plugins: admin
+networks: Bench
+engine: %(engine)s
+
+[Bench]
+server: 127.0.0.1
+port: %(port)d
+nick: %(nick)s
+channels: %(channels)s
+"""
+
+
+def build_options():
+    """Generate command line options"""
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n", "--channels", type="int", default=10,
+            help="channels flooded (default: %default)")
+    parser.add_option("-m", "--clients", type="int", default=10,
+            help="flooding clients (default: %default)")
+    parser.add_option("-r", "--start-rate", type="int", default=250,
+            help="messages/sec offered in the first step (default: "
+                 "%default)")
+    parser.add_option("--max-rate", type="int", default=64000,
+            help="stop ramping past this rate (default: %default)")
+    parser.add_option("-t", "--step-time", type="float", default=5,
+            help="seconds per step (default: %default)")
+    parser.add_option("--max-latency", type="float", default=0.25,
+            help="median probe latency, in seconds, beyond which a step "
+                 "isn't sustained (default: %default)")
+    parser.add_option("--max-backlog", type="int", default=2 ** 16,
+            help="bytes held for the bot beyond which a step isn't "
+                 "sustained (default: %default)")
+    parser.add_option("-e", "--engine", default="select",
+            help="bot event loop engine (default: %default)")
+    parser.add_option("--flood-control", action="store_true",
+            help="keep the bot's outbound flood control on")
+    parser.add_option("-o", "--output",
+            help="write the JSON results to a file instead of stdout")
+    parser.add_option("--bot", action="store_true",
+            help=optparse.SUPPRESS_HELP)
+
+    return parser.parse_args()
+
+
+def run_bot(flood_control):
+    """Run the bot (in the child process) until it is killed"""
+    sys.argv = sys.argv[:1]
+    from pyhole import irc
+
+    client = irc.IRC("Bench")
+    if not flood_control:
+        client.connection.set_flood_control(None)
+    client.start()
+
+
+def start_bot(home, port, channels, options):
+    """Start the bot in a process of its own, with its own home"""
+    config_dir = os.path.join(home, ".pyhole")
+    os.makedirs(config_dir)
+    with open(os.path.join(config_dir, "pyhole.conf"), "w") as config:
+        config.write(CONFIG % {"engine": options.engine, "port": port,
+                               "nick": BOT_NICK,
+                               "channels": ", ".join(channels)})
+
+    args = [sys.executable, os.path.abspath(__file__), "--bot"]
+    if options.flood_control:
+        args.append("--flood-control")
+    env = dict(os.environ, HOME=home)
+    devnull = open(os.devnull, "w")
+    return subprocess.Popen(args, env=env, cwd=ROOT, stdout=devnull,
+                            stderr=devnull)
+
+
+class Client(object):
+    """A synthetic IRC client"""
+
+    def __init__(self, port, nick):
+        self.nick = nick
+        self.socket = socket.create_connection(("127.0.0.1", port))
+        self.data = ""
+        self.send("NICK %s\r\nUSER %s 0 * :%s\r\n" % (nick, nick, nick))
+        self.wait_for(lambda line: " 376 " in line, 10)
+
+    def send(self, data):
+        self.socket.sendall(data)
+
+    def wait_for(self, match, timeout):
+        """Read lines until one matches, returning it (or None on
+        timeout)
+        """
+        deadline = time.time() + timeout
+        while True:
+            while "\r\n" in self.data:
+                line, self.data = self.data.split("\r\n", 1)
+                if line.startswith("PING "):
+                    self.send("PONG %s\r\n" % line[5:])
+                elif match(line):
+                    return line
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            self.socket.settimeout(remaining)
+            try:
+                data = self.socket.recv(2 ** 16)
+            except socket.timeout:
+                return None
+            if not data:
+                raise IOError("%s was disconnected" % self.nick)
+            self.data += data
+
+    def close(self):
+        self.socket.close()
+
+
+class Flooder(threading.Thread):
+    """Send chatter to channels at a steady rate"""
+
+    # Seconds between bursts.
+    tick = 0.01
+
+    def __init__(self, client, channels):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.channels = channels
+        self.rate = 0
+        self.sent = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        last = time.time()
+        owed = 0.0
+        while not self.stopped.is_set():
+            now = time.time()
+            owed += (now - last) * self.rate
+            last = now
+            due = int(owed)
+            if due > 0:
+                lines = []
+                for i in xrange(self.sent, self.sent + due):
+                    lines.append("PRIVMSG %s :chatter line %d from %s\r\n" % (
+                            self.channels[i % len(self.channels)], i,
+                            self.client.nick))
+                self.client.send("".join(lines))
+                self.sent += due
+                owed -= due
+            time.sleep(self.tick)
+
+
+def from_bot(line):
+    return line.startswith(":%s!" % BOT_NICK) and \
+            (" PRIVMSG %s :" % PROBE_CHANNEL) in line
+
+
+def probe(prober, command, lines, timeout):
+    """Time the first line of the bot's reply to a command, then wait
+    for the rest of it
+    """
+    start = time.time()
+    prober.send("PRIVMSG %s :%s\r\n" % (PROBE_CHANNEL, command))
+    if prober.wait_for(from_bot, timeout) is None:
+        return None
+    latency = time.time() - start
+    for _i in xrange(lines - 1):
+        prober.wait_for(from_bot, timeout)
+    return latency
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return None
+
+    def pick(fraction):
+        return round(samples[min(int(len(samples) * fraction),
+                                 len(samples) - 1)] * 1000, 3)
+
+    return {"count": len(samples), "p50_ms": pick(0.5), "p90_ms": pick(0.9),
+            "p99_ms": pick(0.99), "max_ms": round(samples[-1] * 1000, 3)}
+
+
+def run_probes(prober, duration, timeout):
+    """Probe the bot for a while, returning the latencies per command"""
+    latencies = dict((command, []) for command, _lines in PROBES)
+    timeouts = 0
+    deadline = time.time() + duration
+    i = 0
+    while time.time() < deadline:
+        command, lines = PROBES[i % len(PROBES)]
+        latency = probe(prober, command, lines, timeout)
+        if latency is None:
+            # Late replies would be taken for answers to later probes.
+            timeouts += 1
+            break
+        latencies[command].append(latency)
+        i += 1
+    return latencies, timeouts
+
+
+def drain(server, prober):
+    """Wait for the bot to catch up with everything sent so far"""
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.get_pending_bytes(BOT_NICK) == 0:
+            # Throw away replies to probes that timed out.
+            prober.wait_for(lambda line: False, 1)
+            if probe(prober, ".version", 1, 5) is not None:
+                return True
+        else:
+            time.sleep(0.1)
+    return False
+
+
+def run_step(server, prober, flooders, rate, options):
+    """Offer a rate for a step, probing the bot meanwhile"""
+    sent = sum(flooder.sent for flooder in flooders)
+    for flooder in flooders:
+        flooder.rate = float(rate) / len(flooders)
+    start = time.time()
+    latencies, timeouts = run_probes(prober, options.step_time,
+                                     max(options.max_latency * 4, 2))
+    elapsed = time.time() - start
+    for flooder in flooders:
+        flooder.rate = 0
+    backlog = server.get_pending_bytes(BOT_NICK)
+
+    sent = sum(flooder.sent for flooder in flooders) - sent
+    everything = sum(latencies.values(), [])
+    median = percentiles(everything)
+    sustained = not timeouts and median is not None and \
+            median["p50_ms"] <= options.max_latency * 1000 and \
+            backlog <= options.max_backlog
+    return {"offered_rate": rate,
+            "achieved_rate": round(sent / elapsed, 1),
+            "backlog_bytes": backlog,
+            "probe_timeouts": timeouts,
+            "latency": dict((command, percentiles(samples))
+                            for command, samples in latencies.items()),
+            "sustained": sustained}
+
+
+def run(options, home):
+    server = fakeircd.FakeIRCd()
+    server.start()
+    channels = ["#bench%d" % i for i in xrange(options.channels)]
+    bot = start_bot(home, server.port, [PROBE_CHANNEL] + channels, options)
+    clients = []
+    try:
+        deadline = time.time() + 30
+        wanted = set([PROBE_CHANNEL] + channels)
+        while server.get_channels(BOT_NICK) != wanted:
+            if time.time() > deadline or bot.poll() is not None:
+                raise RuntimeError("The bot never joined its channels")
+            time.sleep(0.1)
+
+        prober = Client(server.port, "prober")
+        clients.append(prober)
+        prober.send("JOIN %s\r\n" % PROBE_CHANNEL)
+        prober.wait_for(lambda line: " 366 " in line, 10)
+
+        idle, timeouts = run_probes(prober, options.step_time, 5)
+        results = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "version": version.version_hash(),
+            "parameters": {"channels": options.channels,
+                           "clients": options.clients,
+                           "engine": options.engine,
+                           "flood_control": bool(options.flood_control),
+                           "step_time": options.step_time,
+                           "max_latency": options.max_latency,
+                           "max_backlog": options.max_backlog},
+            "idle_latency": dict((command, percentiles(samples))
+                                 for command, samples in idle.items()),
+            "steps": [],
+            "max_sustained_rate": None,
+        }
+
+        flooders = []
+        for i in xrange(options.clients):
+            client = Client(server.port, "flood%d" % i)
+            clients.append(client)
+            flooder = Flooder(client, channels[i::options.clients] or
+                              channels)
+            flooder.start()
+            flooders.append(flooder)
+
+        rate = options.start_rate
+        while rate <= options.max_rate:
+            step = run_step(server, prober, flooders, rate, options)
+            results["steps"].append(step)
+            if not step["sustained"]:
+                break
+            results["max_sustained_rate"] = step["achieved_rate"]
+            if not drain(server, prober):
+                break
+            rate *= 2
+
+        for flooder in flooders:
+            flooder.stopped.set()
+        return results
+    finally:
+        for client in clients:
+            client.close()
+        bot.kill()
+        bot.wait()
+        server.stop()
+
+
+def main():
+    options, _args = build_options()
+    if options.bot:
+        run_bot(options.flood_control)
+        return
+
+    home = tempfile.mkdtemp(prefix="pyhole-bench-")
+    try:
+        results = run(options, home)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print output
+
+
+if __name__ == "__main__":
+    main()
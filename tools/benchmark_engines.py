@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compare the pyhole event loop engines side by side.
+
+Both engines run the way pyhole runs them, with eventlet monkey
+patching in place, against a fake server running in a greenthread:
+
+  * throughput: how fast a burst of PRIVMSG lines is turned into
+    pubmsg events.
+  * latency: round trip times of a server line answered by a handler,
+    one at a time, while a second idle connection is open.
+
+Usage: python tools/benchmark_engines.py [lines] [round trips]
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyhole import engine
+
+
+class FakeServer(threading.Thread):
+    """Accept one client, then blast lines at it or ping it."""
+
+    def __init__(self, lines=0, pings=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.lines = lines
+        self.pings = pings
+        self.round_trips = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.client = None
+
+    def run(self):
+        self.client = client = self.listener.accept()[0]
+        line = ":nick!user@host PRIVMSG #chan :hello world, this is a test\r\n"
+        chunk = line * 100
+        sent = 0
+        while sent < self.lines:
+            client.sendall(chunk)
+            sent += 100
+
+        data = ""
+        for i in xrange(self.pings):
+            start = time.time()
+            client.sendall(":nick!user@host PRIVMSG bench :ping %d\r\n" % i)
+            while ("pong %d\r\n" % i) not in data:
+                data += client.recv(4096)
+            self.round_trips.append(time.time() - start)
+            data = ""
+        if self.pings:
+            # Wake the loop up to notice the last round trip.
+            client.sendall(":server NOTICE bench :done\r\n")
+
+
+def connect(irc, server):
+    server.start()
+    connection = irc.server()
+    connection.connect("127.0.0.1", server.port, "bench")
+    return connection
+
+
+def bench_throughput(name, lines):
+    irc = engine.create_irc(name)
+    received = [0]
+
+    def on_pubmsg(connection, event):
+        received[0] += 1
+
+    irc.add_global_handler("pubmsg", on_pubmsg)
+    server = FakeServer(lines=lines)
+    connect(irc, server)
+
+    start = time.time()
+    while received[0] < lines:
+        irc.process_once(None)
+    elapsed = time.time() - start
+    irc.disconnect_all()
+    return lines / elapsed
+
+
+def bench_latency(name, pings):
+    irc = engine.create_irc(name)
+
+    def on_privmsg(connection, event):
+        connection.privmsg("nick", event.arguments()[0].replace("ping",
+                                                                "pong"))
+
+    irc.add_global_handler("privmsg", on_privmsg)
+    idle = FakeServer()
+    connect(irc, idle)
+    server = FakeServer(pings=pings)
+    connect(irc, server)
+
+    while len(server.round_trips) < pings:
+        irc.process_once(None)
+    irc.disconnect_all()
+    round_trips = sorted(server.round_trips)
+    return (round_trips[len(round_trips) / 2],
+            round_trips[len(round_trips) * 99 / 100])
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    pings = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    print "%-8s %12s %12s %12s" % ("engine", "lines/sec", "p50 rtt",
+                                   "p99 rtt")
+    for name in engine.engines:
+        rate = bench_throughput(name, lines)
+        p50, p99 = bench_latency(name, pings)
+        print "%-8s %12.0f %10.1fus %10.1fus" % (name, rate, p50 * 1e6,
+                                                 p99 * 1e6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compare irclib.LineBuffer with the old regexp line splitting.
+
+A burst of NAMES and MOTD lines is fed through both framers in chunks
+the size of a single recv() call.
+
+Usage: python tools/benchmark_framer.py [megabytes] [chunk size]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyhole import irclib
+
+
+_linesep_regexp = re.compile("\r?\n")
+
+
+def build_burst(megabytes):
+    names = " ".join("@nick%d" % i for i in range(40))
+    lines = [
+        ":irc.example.net 353 bot = #channel :%s\r\n" % names,
+        ":irc.example.net 372 bot :- Welcome to the example network, "
+        "please read the rules.\r\n",
+        ":nick!user@host.example.com PRIVMSG #channel :hello\r\n",
+    ]
+    block = "".join(lines)
+    return block * (megabytes * 1024 * 1024 / len(block))
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def legacy(pieces):
+    count = 0
+    previous_buffer = ""
+    for data in pieces:
+        lines = _linesep_regexp.split(previous_buffer + data)
+        previous_buffer = lines.pop()
+        for line in lines:
+            count += 1
+    return count
+
+
+def line_buffer(pieces):
+    count = 0
+    buf = irclib.LineBuffer()
+    for data in pieces:
+        buf.feed(data)
+        for line in buf.lines():
+            count += 1
+    return count
+
+
+def views(pieces):
+    count = 0
+    buf = irclib.LineBuffer()
+    for data in pieces:
+        buf.feed(data)
+        for line in buf:
+            count += 1
+    return count
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 2 ** 14
+    burst = build_burst(megabytes)
+    pieces = chunks(burst, size)
+
+    print "%d MB in %d byte chunks" % (megabytes, size)
+    for name, framer in [("regexp split", legacy),
+                         ("LineBuffer.lines", line_buffer),
+                         ("LineBuffer views", views)]:
+        start = time.time()
+        count = framer(pieces)
+        elapsed = time.time() - start
+        print "%-18s %8d lines %8.3fs %10.1f MB/s" % (
+            name, count, elapsed, megabytes / elapsed)
+
+
+if __name__ == "__main__":
+    main()
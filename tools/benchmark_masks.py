@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compare ways of checking nickmasks against a large mask list.
+
+  * legacy: the old mask_matches, compiling the mask on every call.
+  * cached: mask_matches with its LRU cache of compiled masks.
+  * maskset: one MaskSet.matches call per nickmask.
+
+The first two loop over every mask, so they only check the first
+20 nickmasks.
+
+Usage: python tools/benchmark_masks.py [masks] [nickmasks]
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyhole import irclib
+
+
+def legacy_mask_matches(nick, mask):
+    nick = irclib.irc_lower(nick)
+    mask = irclib.irc_lower(mask)
+    mask = mask.replace("\\", "\\\\")
+    for ch in ".$|[](){}+":
+        mask = mask.replace(ch, "\\" + ch)
+    mask = mask.replace("?", ".")
+    mask = mask.replace("*", ".*")
+    r = re.compile(mask, re.IGNORECASE)
+    return r.match(nick)
+
+
+def word(rand, length=8):
+    return "".join(rand.choice("abcdefghijklmnopqrstuvwxyz")
+                   for i in range(length))
+
+
+def make_masks(rand, count):
+    masks = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            masks.append("%s!%s@%s.example.net" % (word(rand), word(rand),
+                                                   word(rand)))
+        elif kind == 1:
+            masks.append("*!*@%s.example.org" % word(rand))
+        elif kind == 2:
+            masks.append("%s*!*@*" % word(rand, 6))
+        else:
+            masks.append("*!%s@*.example.com" % word(rand))
+    return masks
+
+
+def make_nicks(rand, masks, count):
+    nicks = []
+    for i in range(count):
+        if i % 10 == 0:
+            # A few of them match.
+            mask = rand.choice(masks)
+            nicks.append(mask.replace("*", "x").replace("?", "y"))
+        else:
+            nicks.append("%s!%s@%s.example.net" % (word(rand), word(rand),
+                                                   word(rand)))
+    return nicks
+
+
+def bench(name, function, nicks):
+    start = time.time()
+    found = sum(1 for nick in nicks if function(nick))
+    elapsed = time.time() - start
+    print "%-8s %8d matches %12.0f checks/sec" % (name, found,
+                                                  len(nicks) / elapsed)
+    return found
+
+
+def main():
+    mask_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    nick_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    rand = random.Random(42)
+    masks = make_masks(rand, mask_count)
+    nicks = make_nicks(rand, masks, nick_count)
+
+    print "%d masks, %d nickmasks" % (mask_count, nick_count)
+    start = time.time()
+    mask_set = irclib.MaskSet(masks)
+    # Groups are compiled when first needed.
+    for nick in nicks:
+        mask_set.matches(nick)
+    print "MaskSet built and compiled in %.3fs" % (time.time() - start)
+
+    few = nicks[:20]
+    results = [
+        bench("legacy", lambda nick: any(legacy_mask_matches(nick, mask)
+                                         for mask in masks), few),
+        bench("cached", lambda nick: any(irclib.mask_matches(nick, mask)
+                                         for mask in masks), few),
+        bench("maskset", mask_set.matches, few),
+    ]
+    if len(set(results)) != 1:
+        print "MISMATCH: %r" % results
+    bench("maskset", mask_set.matches, nicks)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compare the irclib line parsers.
+
+Parses a corpus of raw IRC lines with every parser in irclib.parsers,
+checks that they agree and reports lines per second.  The corpus is a
+file with one raw line per line; without one a built-in sample of
+typical traffic is used.
+
+Usage: python tools/benchmark_parser.py [corpus file] [passes]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyhole import irclib
+
+
+SAMPLE = [
+    ":nick!~user@host.example.com PRIVMSG #pyhole :.help version",
+    ":nick!~user@host.example.com PRIVMSG #pyhole :see http://pyhole.org",
+    ":nick!~user@host.example.com PRIVMSG pyhole :\x01VERSION\x01",
+    ":nick!~user@host.example.com NOTICE #pyhole :build finished",
+    ":nick!~user@host.example.com JOIN #pyhole",
+    ":nick!~user@host.example.com PART #pyhole :bye",
+    ":nick!~user@host.example.com QUIT :Ping timeout: 240 seconds",
+    ":nick!~user@host.example.com NICK :nick_",
+    ":nick!~user@host.example.com MODE #pyhole +ov nick other",
+    ":irc.example.net 353 pyhole = #pyhole :@nick +other a b c d e f",
+    ":irc.example.net 366 pyhole #pyhole :End of /NAMES list.",
+    ":irc.example.net 372 pyhole :- Welcome to the example network",
+    ":irc.example.net 005 pyhole CHANTYPES=# PREFIX=(ov)@+ NETWORK=Ex "
+        ":are supported by this server",
+    "PING :irc.example.net",
+    "@time=2012-06-30T23:59:60.419Z;account=nick :nick!~user@host "
+        "PRIVMSG #pyhole :tagged message",
+]
+
+
+def load_corpus(path):
+    with open(path) as corpus:
+        return [line.rstrip("\r\n") for line in corpus if line.strip()]
+
+
+def main():
+    corpus = load_corpus(sys.argv[1]) if len(sys.argv) > 1 else SAMPLE
+    passes = int(sys.argv[2]) if len(sys.argv) > 2 else 20000 / len(corpus)
+    lines = corpus * max(passes, 1)
+
+    results = {}
+    for name, parse in sorted(irclib.parsers.items()):
+        start = time.time()
+        parsed = [parse(line) for line in lines]
+        elapsed = time.time() - start
+        results[name] = parsed[:len(corpus)]
+        print "%-8s %8d lines %8.3fs %12.0f lines/sec" % (
+            name, len(lines), elapsed, len(lines) / elapsed)
+
+    if results["fast"] != results["regexp"]:
+        for line, a, b in zip(corpus, results["fast"], results["regexp"]):
+            if a != b:
+                print "MISMATCH: %r\n  fast:   %r\n  regexp: %r" % (line, a, b)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+#   Copyright 2012 Josh Kearney
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compare the irclib event loop backends.
+
+Two measurements are taken for each backend:
+
+  * idle: how many times the loop wakes up, and how much CPU it burns,
+    while connected to a server that sends nothing.
+  * throughput: how fast a burst of PRIVMSG lines is turned into
+    pubmsg events.
+
+"legacy" is the old behaviour: select() with a fixed 0.2s tick.
+
+Usage: python tools/benchmark_poller.py [idle seconds] [lines]
+"""
+
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pyhole import irclib
+
+
+class FakeServer(threading.Thread):
+    """Accept one client and optionally blast lines at it."""
+
+    def __init__(self, lines=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.lines = lines
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.client = None
+
+    def run(self):
+        self.client, _addr = self.listener.accept()
+        if not self.lines:
+            return
+        line = ":nick!user@host PRIVMSG #chan :hello world, this is a test\r\n"
+        chunk = line * 100
+        sent = 0
+        while sent < self.lines:
+            self.client.sendall(chunk)
+            sent += 100
+
+
+def run_loop(irc, timeout, until):
+    wakeups = 0
+    while not until():
+        irc.process_once(timeout)
+        wakeups += 1
+    return wakeups
+
+
+def bench_idle(name, timeout, seconds):
+    poller = "select" if name == "legacy" else name
+    irc = irclib.IRC(poller=poller)
+    server = FakeServer()
+    server.start()
+    irc.server().connect("127.0.0.1", server.port, "bench")
+
+    cpu_start = sum(os.times()[:2])
+    deadline = time.time() + seconds
+    # Make sure a loop with no tick still wakes up to end the run.
+    irc.execute_at(deadline, lambda: None)
+    wakeups = run_loop(irc, timeout, lambda: time.time() >= deadline)
+    cpu = sum(os.times()[:2]) - cpu_start
+    irc.disconnect_all()
+    return wakeups, cpu
+
+
+def bench_throughput(name, timeout, lines):
+    poller = "select" if name == "legacy" else name
+    irc = irclib.IRC(poller=poller)
+    received = [0]
+
+    def on_pubmsg(connection, event):
+        received[0] += 1
+
+    irc.add_global_handler("pubmsg", on_pubmsg)
+    server = FakeServer(lines)
+    server.start()
+    irc.server().connect("127.0.0.1", server.port, "bench")
+
+    start = time.time()
+    run_loop(irc, timeout, lambda: received[0] >= lines)
+    elapsed = time.time() - start
+    irc.disconnect_all()
+    return lines / elapsed
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    lines = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+
+    backends = [("legacy", 0.2)]
+    for name in ("select", "poll", "epoll"):
+        if name == "select" or hasattr(select, name):
+            backends.append((name, None))
+
+    print "%-8s %12s %10s %14s" % ("backend", "idle wakeups", "idle cpu",
+                                   "lines/sec")
+    for name, timeout in backends:
+        wakeups, cpu = bench_idle(name, timeout, seconds)
+        rate = bench_throughput(name, timeout, lines)
+        print "%-8s %12d %9.3fs %14.0f" % (name, wakeups, cpu, rate)
+
+
+if __name__ == "__main__":
+    main()